@@ -1,31 +1,209 @@
-import time
 import json
+import os
 from service_fabrik_backup_restore import parse_options, create_iaas_client
+from options import parse_extended_options
+from blobstore import IaasBlobstore
+from incremental import IncrementalBackup
+from blocks import blocks_directory_to_blobstore
+from dedup import ChunkStore, dedup_directory_to_blobstore, load_chunk_key
+from provisioning import ProvisioningError, VolumeChain, provision_volume_chains, prepare_mount, run_in_parallel, \
+    scratch_volume_chain, mount_scratch_volume, release_scratch_volume
+from streaming import create_encrypted_archive, stream_directory_to_blobstore
+from compression import archive_name, create_codec
+from timings import InstrumentedClient, Timings, export_timings
+from waiting import LibraryClock, PollingClient, SerializedClient, wait_for_service_job_status
+from journal import Journal, JournalingClient
+from volumepool import VolumePool
+from throttling import Throttling
+from transfer import ParallelTransfer
+import progress
 
 
 def main():
-    # +-> Definition of constants
-    DIRECTORY_PERSISTENT = '/var/vcap/store'
-    DIRECTORY_SNAPSHOT = '/tmp/service-fabrik-backup/snapshot'
-    DIRECTORY_UPLOADS = '/tmp/service-fabrik-backup/uploads'
+    # +-> Definition of constants; all directories are below the root directory, which is only changed by the benchmark
+    DIRECTORY_ROOT = os.environ.get('SF_BACKUP_RESTORE_ROOT_DIRECTORY', '')
+    DIRECTORY_PERSISTENT = DIRECTORY_ROOT + '/var/vcap/store'
+    DIRECTORY_SNAPSHOT = DIRECTORY_ROOT + '/tmp/service-fabrik-backup/snapshot'
+    DIRECTORY_UPLOADS = DIRECTORY_ROOT + '/tmp/service-fabrik-backup/uploads'
+    DIRECTORY_SPOOL = DIRECTORY_ROOT + '/tmp/service-fabrik-backup/spool'
+    DIRECTORY_STATE = DIRECTORY_ROOT + '/var/vcap/data/blueprint-backup'
+    DIRECTORY_VOLUME_POOL = DIRECTORY_ROOT + '/var/vcap/store/blueprint-volume-pool'
+    DIRECTORY_VOLUME_POOL_PREVIOUS = DIRECTORY_ROOT + '/var/vcap/data/blueprint-volume-pool'
 
     # +-> Initialization: Argument Parsing, IaaS-Client Creation
+    options = parse_extended_options('backup')
     configuration = parse_options('backup')
     iaas_client = create_iaas_client('backup', configuration, DIRECTORY_PERSISTENT, [
-                                     DIRECTORY_SNAPSHOT, DIRECTORY_UPLOADS], 10, 18000)
+                                     DIRECTORY_SNAPSHOT, DIRECTORY_UPLOADS], options['iaas_poll_interval'] or 10, 18000)
+    # +-> The status polls of the library back off from a fraction of a second up to the poll interval; calls made from
+    #     several threads (e.g. to provision volumes concurrently) are made one at a time, their waits overlap
+    clock = LibraryClock()
+    clock.install()
+    iaas_client = PollingClient(SerializedClient(iaas_client, clock), clock)
+    # +-> Every call of the IaaS client is timed, the timings are exported when the backup ends (also on failure)
+    timings = Timings('backup')
+    iaas_client = InstrumentedClient(iaas_client, timings)
+    # +-> Upload volumes can be leased from a pool of warm volumes; they outlive the backup, so they are not journaled
+    volume_pool = None
+    if options['volume_pool_size']:
+        volume_pool = VolumePool(iaas_client, configuration['instance_id'], DIRECTORY_VOLUME_POOL,
+                                 options['volume_pool_size'], options['volume_pool_idle'],
+                                 DIRECTORY_VOLUME_POOL_PREVIOUS)
+    # +-> Created resources and finished transfers are journaled, a retry with the same backup guid resumes from there
+    journal = Journal(DIRECTORY_STATE, 'backup', configuration['backup_guid'])
+    iaas_client = JournalingClient(iaas_client, journal)
+
+    def wait_for_service_job(status):
+        # +-> Polls monit with a backoff that starts at a fraction of a second instead of the library's poll interval
+        return wait_for_service_job_status(iaas_client, configuration.get('job_name', 'blueprint'), status, timings)
 
     # ------------------------------------------ BACKUP START ----------------------------------------------------------
     backup_guid = configuration['backup_guid']
     backup_type = configuration['type']
     instance_id = configuration['instance_id']
     landscape = configuration['iaas'].title()
+    streaming = options['archive_format'] in ('streaming', 'resumable', 'dedup', 'blocks')
+    codec = create_codec(options['compression'], options['compression_level'], options['compression_threads'])
+    # +-> Online and incremental backups run next to the live service, hence reading, uploading and their priority may
+    #     be limited; an offline backup runs at full speed, the service job is stopped anyway
+    throttling = Throttling(DIRECTORY_PERSISTENT)
+    if backup_type != 'offline':
+        throttling = Throttling(DIRECTORY_PERSISTENT, options['read_rate_limit'], options['upload_rate_limit'],
+                                options['max_load'], options['max_disk_queue'], options['nice'], options['io_class'])
     iaas_client.initialize()
+    # +-> The progress of the running step is published next to the last operation state while the backup runs
+    progress.start('backup', options['stall_timeout'], iaas_client.logger)
 
     try:
-        tarball_files_name = 'blueprint-files.tar.gz.gpg'
+        if iaas_client.recover():
+            iaas_client.logger.info(
+                'Resuming the backup {} from its journal.'.format(backup_guid))
+        iaas_client.release_stale_resources()
+        if volume_pool:
+            volume_pool.reconcile()
+        throttling.lower_priority(iaas_client.logger)
+
+        tarball_files_name = archive_name(codec)
         tarball_files_path = DIRECTORY_UPLOADS + '/' + tarball_files_name
         metadata_files_name = 'blueprint-metadata.json'
-        metadata_files_path = '/tmp' + '/' + metadata_files_name
+        metadata_files_path = DIRECTORY_ROOT + '/tmp' + '/' + metadata_files_name
+        blobstore = IaasBlobstore(iaas_client, DIRECTORY_SPOOL, throttling.upload)
+        # +-> Digest, size and number of files of the tarball, kept in its metadata
+        tarball_summary = {}
+
+        def create_and_encrypt_tarball():
+            # +-> The own pipeline writes the tarball (with the default gzip codec byte-compatible to the one of the
+            #     library) and computes its digest while it writes it, the tarball is never read a second time; a
+            #     tarball of an earlier attempt is reused with the summary journaled for it
+            # +-> If enabled, a tarball larger than a part is written as part files right away, which are uploaded by
+            #     concurrent transfers and listed in its metadata; by default it stays one blob, which restores of
+            #     earlier versions expect
+            summary = journal.file_summary('tarball')
+            if summary:
+                iaas_client.logger.info('Reusing the tarball {}.'.format(tarball_files_path))
+                tarball_summary.update(summary)
+                return True
+            part_size = options['part_size'] * 1024 * 1024 if options['tarball_parallelism'] > 1 else None
+            try:
+                with timings.step('create_encrypted_archive') as step:
+                    progress.expect(directory='{}/blueprint/files'.format(DIRECTORY_PERSISTENT))
+                    tarball_summary.update(create_encrypted_archive('{}/blueprint/files'.format(DIRECTORY_PERSISTENT),
+                                                                    tarball_files_path, configuration['secret'], codec,
+                                                                    throttle=throttling.read, part_size=part_size))
+                    step.bytes = tarball_summary['size']
+                # +-> The last file written stands for the tarball in the journal
+                parts = tarball_summary.get('parts')
+                journal.add_file('tarball', os.path.join(DIRECTORY_UPLOADS, parts[-1]['name']) if parts
+                                 else tarball_files_path, dict(tarball_summary))
+            except Exception as error:
+                iaas_client.logger.error(
+                    'Could not create the tarball {}: {}'.format(tarball_files_path, error))
+                return False
+            return True
+
+        def upload_tarball():
+            if tarball_summary.get('parts'):
+                try:
+                    with timings.step('upload_tarball_parts') as step:
+                        step.bytes = ParallelTransfer(blobstore, options['tarball_parallelism']).upload(
+                            DIRECTORY_UPLOADS, backup_guid, tarball_summary['parts'])
+                except Exception as error:
+                    iaas_client.exit('Could not upload the tarball {}: {}'.format(tarball_files_path, error))
+            elif not iaas_client.upload_to_blobstore(tarball_files_path, '{}/{}'.format(backup_guid, tarball_files_name)):
+                iaas_client.exit(
+                    'Could not upload the tarball {}.'.format(tarball_files_path))
+            upload_tarball_metadata()
+
+        def upload_tarball_metadata():
+            # +-> Record the codec of the tarball, so that the restore picks the matching decompressor, and its digest
+            if not blobstore.upload_json(dict({'format': 'tarball', 'archive': tarball_files_name,
+                                               'compression': codec.describe()}, **tarball_summary),
+                                         '{}/{}'.format(backup_guid, metadata_files_name)):
+                iaas_client.exit(
+                    'Could not upload the metadata {}.'.format(metadata_files_name))
+
+        def stream_files_to_blobstore():
+            # +-> Stream the contents of the persistent volume through tar, gzip and gpg directly into a multipart upload,
+            #     no upload volume is needed; the parts are described in the metadata of the backup
+            # +-> In the resumable format the parts are encrypted one by one, the parts uploaded by an earlier attempt
+            #     are skipped
+            # +-> In the dedup format the tar stream is split into content-defined chunks instead, of which only the
+            #     ones not yet in the blob store are uploaded; the backup's folder only holds the recipe
+            # +-> In the blocks format the files are archived in independent blocks with an index of the blocks, from
+            #     which single files can be restored
+            try:
+                with timings.step('stream_directory_to_blobstore') as step:
+                    progress.expect(directory='{}/blueprint/files'.format(DIRECTORY_PERSISTENT))
+                    if options['archive_format'] == 'dedup':
+                        store = ChunkStore(blobstore, load_chunk_key(
+                            DIRECTORY_STATE), DIRECTORY_STATE)
+                        if store.check_known():
+                            iaas_client.logger.warning('Known chunks are missing in the blob store, all chunks are '
+                                                       'uploaded again.')
+                        archive = dedup_directory_to_blobstore(blobstore, store,
+                                                               '{}/blueprint/files'.format(DIRECTORY_PERSISTENT),
+                                                               configuration['secret'], backup_guid,
+                                                               options['parallelism'], throttle=throttling.read)
+                        step.bytes = archive['uploadedBytes']
+                    elif options['archive_format'] == 'blocks':
+                        archive = blocks_directory_to_blobstore(blobstore,
+                                                                '{}/blueprint/files'.format(DIRECTORY_PERSISTENT),
+                                                                configuration['secret'], backup_guid,
+                                                                tarball_files_name,
+                                                                options['block_size'] * 1024 * 1024,
+                                                                options['part_size'] * 1024 * 1024,
+                                                                options['parallelism'], codec, throttling.read,
+                                                                journal)
+                        step.bytes = archive['size']
+                    else:
+                        archive = stream_directory_to_blobstore(blobstore,
+                                                                '{}/blueprint/files'.format(DIRECTORY_PERSISTENT),
+                                                                configuration['secret'],
+                                                                '{}/{}'.format(backup_guid, tarball_files_name),
+                                                                options['part_size'] * 1024 * 1024, codec=codec,
+                                                                throttle=throttling.read, journal=journal,
+                                                                resumable=options['archive_format'] == 'resumable')
+                        step.bytes = archive['size']
+            except Exception as error:
+                iaas_client.exit('Could not stream an encrypted tarball of the directory {} to the blob store: {}'
+                                 .format(DIRECTORY_PERSISTENT, error))
+            if not blobstore.upload_json(dict(format=options['archive_format'], **archive),
+                                         '{}/{}'.format(backup_guid, metadata_files_name)):
+                iaas_client.exit(
+                    'Could not upload the metadata {}.'.format(metadata_files_name))
+
+            # +-> Remove the chunks no backup references anymore, a backup is live as long as its metadata exists; the
+            #     backup is complete at this point, if this fails the garbage is left for the next one
+            if options['archive_format'] == 'dedup':
+                try:
+                    with timings.step('collect_garbage'):
+                        removed = store.collect_garbage(
+                            lambda guid: blobstore.download_json('{}/{}'.format(guid, metadata_files_name)) is not None,
+                            options['parallelism'])
+                    iaas_client.logger.info('Removed {} chunks no backup references anymore.'.format(removed))
+                except Exception as error:
+                    iaas_client.logger.warning('Could not remove the chunks no backup references anymore: {}'
+                                               .format(error))
 
         # +-> Get the id of the persistent volume attached to this instance
         volume_persistent = iaas_client.get_persistent_volume_for_instance(
@@ -42,86 +220,46 @@ def main():
                                  .format(DIRECTORY_PERSISTENT))
 
             if landscape != 'Aws' and landscape != 'Azure' and landscape != 'Gcp' and landscape != 'Ali':
-                # +-> Create a volume from this snapshot whose contents will be backed-up
-                volume_snapshot = iaas_client.create_volume(
-                    snapshot_store.size, snapshot_store.id)
-                if not volume_snapshot:
-                    iaas_client.exit(
-                        'Could not create a volume from the {} snapshot.'.format(DIRECTORY_PERSISTENT))
-
-                # +-> Create a volume where the encrypted tarballs/files will be stored on (to be uploaded)
-                volume_uploads = iaas_client.create_volume(snapshot_store.size)
-                if not volume_uploads:
-                    iaas_client.exit(
-                        'Could not create a volume for the uploads.')
-
-                # +-> Attach the snapshot volume to the instance
-                attachment_volume_snapshot = iaas_client.create_attachment(
-                    volume_snapshot.id, instance_id)
-                if not attachment_volume_snapshot:
-                    iaas_client.exit('Could not attach the snapshot volume with id {} to instance with id {}.'
-                                     .format(volume_snapshot.id, instance_id))
-
-                # +-> Attach the upload volume to the instance
-                attachment_volume_uploads = iaas_client.create_attachment(
-                    volume_uploads.id, instance_id)
-                if not attachment_volume_uploads:
-                    iaas_client.exit('Could not attach the upload volume with id {} to instance with id {}.'
-                                     .format(volume_uploads.id, instance_id))
-
-                # +-> Find the mountpoint of the snapshot volume
-                mountpoint_volume_snapshot = iaas_client.get_mountpoint(
-                    volume_snapshot.id, '1')
-                if not mountpoint_volume_snapshot:
-                    iaas_client.exit('Could not determine the mountpoint for the snapshot volume (id: {}).'
-                                     .format(volume_snapshot.id))
-
-                # +-> Find the mountpoint of the upload volume
-                mountpoint_volume_uploads = iaas_client.get_mountpoint(
-                    volume_uploads.id)
-                if not mountpoint_volume_uploads:
-                    iaas_client.exit('Could not determine the mountpoint for the upload volume (id: {}).'
-                                     .format(volume_uploads.id))
+                # +-> Create a volume from this snapshot whose contents will be backed-up and a volume where the
+                #     encrypted tarballs/files will be stored on (to be uploaded), attach both to the instance and find
+                #     their mountpoints; both chains are independent of each other and are provisioned concurrently
+                # +-> A streamed backup does not need the upload volume
+                chain_snapshot = VolumeChain(
+                    'snapshot', snapshot_store.size, snapshot_store.id, '1')
+                chain_uploads = scratch_volume_chain('upload', snapshot_store.size, volume_pool)
+                try:
+                    provision_volume_chains(
+                        iaas_client, instance_id, [chain_snapshot] if streaming else [chain_snapshot, chain_uploads])
+                except ProvisioningError as error:
+                    iaas_client.exit(str(error))
+                volume_snapshot = chain_snapshot.volume
+                attachment_volume_snapshot = chain_snapshot.attachment
+                mountpoint_volume_snapshot = chain_snapshot.mountpoint
+                mountpoint_volume_uploads = chain_uploads.mountpoint
 
                 # +-> Create temporary directories, format the upload volume and mount them to these directories
-                if not iaas_client.delete_directory(DIRECTORY_SNAPSHOT):
-                    iaas_client.exit(
-                        'Could not remove the following directory: {}.'.format(DIRECTORY_SNAPSHOT))
-                if not iaas_client.delete_directory(DIRECTORY_UPLOADS):
-                    iaas_client.exit(
-                        'Could not remove the following directory: {}.'.format(DIRECTORY_UPLOADS))
-
-                if not iaas_client.create_directory(DIRECTORY_SNAPSHOT):
-                    iaas_client.exit(
-                        'Could not create the following directory: {}'.format(DIRECTORY_SNAPSHOT))
-                if not iaas_client.create_directory(DIRECTORY_UPLOADS):
-                    iaas_client.exit(
-                        'Could not create the following directory: {}'.format(DIRECTORY_UPLOADS))
-
-                if not iaas_client.format_device(mountpoint_volume_uploads):
-                    iaas_client.exit('Could not format the following device: {}'.format(
-                        mountpoint_volume_uploads))
-
-                if not iaas_client.mount_device(mountpoint_volume_snapshot, DIRECTORY_SNAPSHOT):
-                    iaas_client.exit('Could not mount the device {} to the directory {}.'
-                                     .format(mountpoint_volume_snapshot, DIRECTORY_SNAPSHOT))
-                if not iaas_client.mount_device(mountpoint_volume_uploads, DIRECTORY_UPLOADS):
-                    iaas_client.exit('Could not mount the device {} to the directory {}.'
-                                     .format(mountpoint_volume_uploads, DIRECTORY_UPLOADS))
+                mounts = [lambda: prepare_mount(
+                    iaas_client, mountpoint_volume_snapshot, DIRECTORY_SNAPSHOT)]
+                if not streaming:
+                    mounts.append(lambda: mount_scratch_volume(
+                        iaas_client, chain_uploads, DIRECTORY_UPLOADS))
+                try:
+                    run_in_parallel(mounts)
+                except ProvisioningError as error:
+                    iaas_client.exit(str(error))
 
                 # +-> Create tarball of the contents of the persistent volume, encrypt it, and upload it to blob store
                 # +-> Service Fabrik forces the services to store their blobs in a pseudo-folder named with the backup_guid
-                if not iaas_client.create_and_encrypt_tarball_of_directory('{}/blueprint/files'
-                                                                           .format(DIRECTORY_PERSISTENT),
-                                                                           tarball_files_path):
-                    iaas_client.exit('Could not create and encrypt a tarball of the directory {}'
-                                     .format(DIRECTORY_PERSISTENT))
-                if not iaas_client.upload_to_blobstore(tarball_files_path, '{}/{}'.format(backup_guid, tarball_files_name)):
-                    iaas_client.exit(
-                        'Could not upload the tarball {}.'.format(tarball_files_path))
+                if streaming:
+                    stream_files_to_blobstore()
+                else:
+                    if not create_and_encrypt_tarball():
+                        iaas_client.exit('Could not create and encrypt a tarball of the directory {}'
+                                         .format(DIRECTORY_PERSISTENT))
+                    upload_tarball()
 
                 # +-> Unmount the volumes and remove the temporary directories
-                if not iaas_client.unmount_device(mountpoint_volume_uploads):
+                if not streaming and not iaas_client.unmount_device(mountpoint_volume_uploads):
                     iaas_client.exit('Could not unmount the device {}.'.format(
                         mountpoint_volume_uploads))
                 if not iaas_client.unmount_device(mountpoint_volume_snapshot):
@@ -131,22 +269,23 @@ def main():
                 if not iaas_client.delete_directory(DIRECTORY_SNAPSHOT):
                     iaas_client.exit(
                         'Could not remove the following directory: {}.'.format(DIRECTORY_SNAPSHOT))
-                if not iaas_client.delete_directory(DIRECTORY_UPLOADS):
+                if not streaming and not iaas_client.delete_directory(DIRECTORY_UPLOADS):
                     iaas_client.exit(
                         'Could not remove the following directory: {}.'.format(DIRECTORY_UPLOADS))
 
-                # +-> Detach the snapshot volume and the upload volume from the instance
-                if not iaas_client.delete_attachment(attachment_volume_uploads.volume_id, instance_id):
-                    iaas_client.exit('Could not detach the upload volume with id {} to instance with id {}.'
-                                     .format(attachment_volume_uploads.volume_id, instance_id))
+                # +-> Detach and delete the upload volume, or give it back to the pool
+                if not streaming:
+                    try:
+                        release_scratch_volume(iaas_client, instance_id, chain_uploads)
+                    except ProvisioningError as error:
+                        iaas_client.exit(str(error))
+
+                # +-> Detach the snapshot volume from the instance
                 if not iaas_client.delete_attachment(attachment_volume_snapshot.volume_id, instance_id):
                     iaas_client.exit('Could not detach the snapshot with id {} to instance with id {}.'
                                      .format(attachment_volume_snapshot.volume_id, instance_id))
 
-                # +-> Delete the upload volume and the snapshot volume
-                if not iaas_client.delete_volume(volume_uploads.id):
-                    iaas_client.exit(
-                        'Could not delete the upload volume with id {}.'.format(volume_uploads.id))
+                # +-> Delete the snapshot volume
                 if not iaas_client.delete_volume(volume_snapshot.id):
                     iaas_client.exit(
                         'Could not delete the snapshot volume with id {}.'.format(volume_snapshot.id))
@@ -188,74 +327,53 @@ def main():
             iaas_client.stop_service_job()
 
             if landscape != 'Aws' and landscape != 'Azure' and landscape != 'Gcp' and landscape != 'Ali':
-                # +-> Create a volume where the encrypted tarballs/files will be stored on (to be uploaded)
-                volume_uploads = iaas_client.create_volume(
-                    volume_persistent.size)
-                if not volume_uploads:
-                    iaas_client.exit(
-                        'Could not create a volume for the uploads.')
-
-                # +-> Attach the upload volume to the instance
-                attachment_volume_uploads = iaas_client.create_attachment(
-                    volume_uploads.id, instance_id)
-                if not attachment_volume_uploads:
-                    iaas_client.exit('Could not attach the upload volume with id {} to instance with id {}.'
-                                     .format(volume_uploads.id, instance_id))
-
-                # +-> Find the mountpoint of the upload volume
-                mountpoint_volume_uploads = iaas_client.get_mountpoint(
-                    volume_uploads.id)
-                if not mountpoint_volume_uploads:
-                    iaas_client.exit('Could not determine the mountpoint for the upload volume (id: {}).'
-                                     .format(volume_uploads.id))
-
-                # +-> Create temporary directory, format the upload volume and mount it to this directory
-                if not iaas_client.delete_directory(DIRECTORY_UPLOADS):
-                    iaas_client.exit(
-                        'Could not remove the following directory: {}.'.format(DIRECTORY_UPLOADS))
-                if not iaas_client.create_directory(DIRECTORY_UPLOADS):
-                    iaas_client.exit(
-                        'Could not create the following directory: {}'.format(DIRECTORY_UPLOADS))
-                if not iaas_client.format_device(mountpoint_volume_uploads):
-                    iaas_client.exit('Could not format the following device: {}'.format(
-                        mountpoint_volume_uploads))
-                if not iaas_client.mount_device(mountpoint_volume_uploads, DIRECTORY_UPLOADS):
-                    iaas_client.exit('Could not mount the device {} to the directory {}.'
-                                     .format(mountpoint_volume_uploads, DIRECTORY_UPLOADS))
-
-                # +-> Wait for the service job to be stopped before starting the content encryption
-                if not iaas_client.wait_for_service_job_status('not monitored'):
-                    iaas_client.exit('Could not stop the service job.')
-
-                # +-> Create tarball of the contents of the persistent volume and encrypt it
-                if not iaas_client.create_and_encrypt_tarball_of_directory('{}/blueprint/files'
-                                                                           .format(DIRECTORY_PERSISTENT),
-                                                                           tarball_files_path):
-                    iaas_client.exit('Could not create and encrypt a tarball of the directory {}'
-                                     .format(DIRECTORY_PERSISTENT))
-
-                # +-> Upload the tarball to the blob store
-                if not iaas_client.upload_to_blobstore(tarball_files_path, '{}/{}'.format(backup_guid, tarball_files_name)):
-                    iaas_client.exit(
-                        'Could not upload the tarball {}.'.format(tarball_files_path))
+                if streaming:
+                    # +-> Wait for the service job to be stopped before starting the content encryption
+                    if not wait_for_service_job('not monitored'):
+                        iaas_client.exit('Could not stop the service job.')
+
+                    stream_files_to_blobstore()
+                else:
+                    # +-> Create (or lease) a volume where the encrypted tarballs/files will be stored on (to be
+                    #     uploaded), attach it to the instance and find its mountpoint
+                    chain_uploads = scratch_volume_chain('upload', volume_persistent.size, volume_pool)
+                    try:
+                        chain_uploads.provision(iaas_client, instance_id)
+                    except ProvisioningError as error:
+                        iaas_client.exit(str(error))
+                    mountpoint_volume_uploads = chain_uploads.mountpoint
+
+                    # +-> Create temporary directory, format (or wipe) the upload volume and mount it to this directory
+                    try:
+                        mount_scratch_volume(iaas_client, chain_uploads, DIRECTORY_UPLOADS)
+                    except ProvisioningError as error:
+                        iaas_client.exit(str(error))
+
+                    # +-> Wait for the service job to be stopped before starting the content encryption
+                    if not wait_for_service_job('not monitored'):
+                        iaas_client.exit('Could not stop the service job.')
+
+                    # +-> Create tarball of the contents of the persistent volume and encrypt it
+                    if not create_and_encrypt_tarball():
+                        iaas_client.exit('Could not create and encrypt a tarball of the directory {}'
+                                         .format(DIRECTORY_PERSISTENT))
 
-                # +-> Unmount the volumes and remove the temporary directories
-                if not iaas_client.unmount_device(mountpoint_volume_uploads):
-                    iaas_client.exit('Could not unmount the device {}.'.format(
-                        mountpoint_volume_uploads))
-                if not iaas_client.delete_directory(DIRECTORY_UPLOADS):
-                    iaas_client.exit(
-                        'Could not remove the following directory: {}.'.format(DIRECTORY_UPLOADS))
+                    # +-> Upload the tarball to the blob store
+                    upload_tarball()
 
-                # +-> Detach the upload volume from the instance
-                if not iaas_client.delete_attachment(attachment_volume_uploads.volume_id, instance_id):
-                    iaas_client.exit('Could not detach the upload volume with id {} to instance with id {}.'
-                                     .format(attachment_volume_uploads.volume_id, instance_id))
+                    # +-> Unmount the volumes and remove the temporary directories
+                    if not iaas_client.unmount_device(mountpoint_volume_uploads):
+                        iaas_client.exit('Could not unmount the device {}.'.format(
+                            mountpoint_volume_uploads))
+                    if not iaas_client.delete_directory(DIRECTORY_UPLOADS):
+                        iaas_client.exit(
+                            'Could not remove the following directory: {}.'.format(DIRECTORY_UPLOADS))
 
-                # +-> Delete the upload volume and the snapshot volume
-                if not iaas_client.delete_volume(volume_uploads.id):
-                    iaas_client.exit(
-                        'Could not delete the upload volume with id {}.'.format(volume_uploads.id))
+                    # +-> Detach and delete the upload volume, or give it back to the pool
+                    try:
+                        release_scratch_volume(iaas_client, instance_id, chain_uploads)
+                    except ProvisioningError as error:
+                        iaas_client.exit(str(error))
 
             if landscape == 'Aws' or landscape == 'Azure' or landscape == 'Gcp' or landscape == 'Ali':
                 snapshot_store = None
@@ -287,13 +405,76 @@ def main():
             iaas_client.start_service_job()
 
             # +-> Wait for the service job to be running again
-            if not iaas_client.wait_for_service_job_status('running'):
+            if not wait_for_service_job('running'):
                 iaas_client.exit(
                     'Could not get the service job to be running again.')
 
+        elif backup_type == 'incremental':
+            # +-> Upload only the files that are new or changed since the last backup together with a manifest of the
+            #     whole directory and tombstones for the deleted files; the archive has the same format on every landscape
+            incremental_backup = IncrementalBackup(blobstore, '{}/blueprint/files'.format(DIRECTORY_PERSISTENT),
+                                                   DIRECTORY_STATE, options['max_chain_length'], throttling.read)
+            parent = incremental_backup.load_parent()
+            chain_snapshot = None
+            if not parent:
+                iaas_client.logger.info('Taking a full backup (level 0), there is no parent backup to build upon.')
+            if landscape != 'Aws' and landscape != 'Azure' and landscape != 'Gcp' and landscape != 'Ali':
+                # +-> Every level is archived from a volume created from a snapshot of the persistent volume, which is
+                #     consistent in itself; on the other landscapes the snapshot cannot be mounted and the live directory
+                #     is read, the service has to be quiesced for a consistent backup there
+                snapshot_store = iaas_client.create_snapshot(volume_persistent.id)
+                if not snapshot_store:
+                    iaas_client.exit('Could not find the snapshot of the persistent volume {}.'
+                                     .format(DIRECTORY_PERSISTENT))
+                chain_snapshot = VolumeChain('snapshot', snapshot_store.size, snapshot_store.id, '1')
+                try:
+                    chain_snapshot.provision(iaas_client, instance_id)
+                    prepare_mount(iaas_client, chain_snapshot.mountpoint, DIRECTORY_SNAPSHOT)
+                except ProvisioningError as error:
+                    iaas_client.exit(str(error))
+
+            try:
+                with timings.step('incremental_backup') as step:
+                    metadata = incremental_backup.run(backup_guid, configuration['secret'], tarball_files_name,
+                                                      options['part_size'] * 1024 * 1024, codec, journal, parent,
+                                                      '{}/blueprint/files'.format(DIRECTORY_SNAPSHOT)
+                                                      if chain_snapshot else None)
+                    step.bytes = metadata['size']
+            except Exception as error:
+                iaas_client.exit('Could not create an incremental backup of the directory {}: {}'
+                                 .format(DIRECTORY_PERSISTENT, error))
+
+            if chain_snapshot:
+                # +-> Unmount, detach and delete the snapshot volume and delete the snapshot
+                if not iaas_client.unmount_device(chain_snapshot.mountpoint):
+                    iaas_client.exit('Could not unmount the device {}.'.format(chain_snapshot.mountpoint))
+                if not iaas_client.delete_directory(DIRECTORY_SNAPSHOT):
+                    iaas_client.exit(
+                        'Could not remove the following directory: {}.'.format(DIRECTORY_SNAPSHOT))
+                if not iaas_client.delete_attachment(chain_snapshot.attachment.volume_id, instance_id):
+                    iaas_client.exit('Could not detach the snapshot with id {} to instance with id {}.'
+                                     .format(chain_snapshot.attachment.volume_id, instance_id))
+                if not iaas_client.delete_volume(chain_snapshot.volume.id):
+                    iaas_client.exit(
+                        'Could not delete the snapshot volume with id {}.'.format(chain_snapshot.volume.id))
+                if not iaas_client.delete_snapshot(snapshot_store.id):
+                    iaas_client.exit(
+                        'Could not delete the snapshot with id {}.'.format(snapshot_store.id))
+
+            # +-> Keep agent metadata, the backup only becomes the parent of the next one once it is complete
+            if not blobstore.upload_json(metadata, '{}/{}'.format(backup_guid, metadata_files_name)):
+                iaas_client.exit(
+                    'Could not upload the metadata {}.'.format(metadata_files_name))
+            incremental_backup.commit()
+
         iaas_client.finalize()
+        journal.remove()
+        timings.succeeded = True
     except Exception as error:
         iaas_client.exit('An unexpected exception occurred: {}'.format(error))
+    finally:
+        progress.stop()
+        export_timings(timings, iaas_client.logger, options['metrics_directory'], throttling=throttling.to_json())
     # ------------------------------------------- BACKUP END -----------------------------------------------------------
 
 
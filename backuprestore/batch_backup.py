@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from service_fabrik_backup_restore import parse_options, create_iaas_client
+from options import parse_extended_options, parse_batch_options
+from blobstore import IaasBlobstore
+from timings import UNTIMED_METHODS, InstrumentedClient, Timings
+from waiting import LibraryClock, PollingClient, RateLimiter, SerializedClient
+
+# +-> Landscapes whose backups are snapshots only, i.e. can be taken without access to the instance's file system
+SNAPSHOT_LANDSCAPES = ('Aws', 'Azure', 'Gcp', 'Ali')
+METADATA_FILES_NAME = 'blueprint-metadata.json'
+
+
+class BatchJobError(Exception):
+    pass
+
+
+class RateLimitedClient:
+    """Forwards everything to the IaaS client, but starts a call only once the rate limiter hands out a slot."""
+
+    def __init__(self, iaas_client, limiter):
+        self._iaas_client = iaas_client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._iaas_client, name)
+        if not callable(attribute) or name.startswith('_') or name in UNTIMED_METHODS:
+            return attribute
+
+        def limited(*args, **kwargs):
+            self._limiter.acquire()
+            return attribute(*args, **kwargs)
+        return limited
+
+
+def load_jobs(path):
+    with open(path) as f:
+        jobs = json.load(f)
+    for job in jobs:
+        if not all(key in job for key in ('instance_id', 'backup_guid')):
+            raise ValueError('Every job needs an instance_id and a backup_guid: {}'.format(job))
+        job.setdefault('type', 'online')
+    return jobs
+
+
+def backup_snapshot(iaas_client, blobstore, landscape, job):
+    """Takes the snapshot backup of one instance like `backup.py` does online; returns the metadata of the backup."""
+    if job['type'] != 'online':
+        raise BatchJobError('Backups of type {} stop the service job on the instance, they cannot be batched.'
+                            .format(job['type']))
+
+    # +-> Get the id of the persistent volume attached to the instance and create a snapshot of it
+    volume_persistent = iaas_client.get_persistent_volume_for_instance(job['instance_id'])
+    if not volume_persistent:
+        raise BatchJobError('Could not find the persistent volume attached to the instance: {}.'
+                            .format(job['instance_id']))
+    snapshot_store = iaas_client.create_snapshot(volume_persistent.id)
+    if not snapshot_store:
+        raise BatchJobError('Could not create the snapshot of the persistent volume {}.'.format(volume_persistent.id))
+
+    # +-> On AWS the backup is an encrypted copy of the snapshot, the snapshot itself is deleted afterwards
+    snapshot_backup = snapshot_store
+    if landscape == 'Aws':
+        snapshot_backup = iaas_client.copy_snapshot(snapshot_store.id)
+        if not snapshot_backup:
+            raise BatchJobError('Could not create the encrypted copy of the snapshot {}.'.format(snapshot_store.id))
+
+    # +-> Keep agent metadata
+    metadata = {'snapshotId': snapshot_backup.id}
+    if not blobstore.upload_json(metadata, '{}/{}'.format(job['backup_guid'], METADATA_FILES_NAME)):
+        raise BatchJobError('Could not upload the metadata {}.'.format(METADATA_FILES_NAME))
+
+    if landscape == 'Aws' and not iaas_client.delete_snapshot(snapshot_store.id):
+        raise BatchJobError('Could not delete the snapshot with id {}.'.format(snapshot_store.id))
+    return metadata
+
+
+class JobRecord:
+    """Keeps the last operation state and the log of one job apart from the ones of the batch and of the other jobs.
+
+    The state is written to `<last operation directory>/batch_backup-<backup guid>.lastoperation.json` like the agent
+    writes it, as a symlink to the alternately written `.blue.json` and `.green.json`. What the thread running the job
+    logs through the logger of the library also goes to `<log directory>/batch_backup-<backup guid>.log`.
+    """
+
+    def __init__(self, logger, backup_guid):
+        self.logger = logger
+        self.operation = 'batch_backup-{}'.format(backup_guid)
+        self.directory = os.environ.get('SF_BACKUP_RESTORE_LAST_OPERATION_DIRECTORY')
+        self.log_directory = os.environ.get('SF_BACKUP_RESTORE_LOG_DIRECTORY')
+        self.color = 'blue'
+        self.handler = None
+
+    def __enter__(self):
+        if self.log_directory:
+            thread = threading.get_ident()
+            self.handler = logging.FileHandler(os.path.join(self.log_directory, '{}.log'.format(self.operation)))
+            self.handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            self.handler.addFilter(lambda record: record.thread == thread)
+            self.logger.addHandler(self.handler)
+        self.update('processing', 'Taking the snapshot backup.')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.handler:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+
+    def update(self, state, stage):
+        if not self.directory:
+            return
+        self.color = 'green' if self.color == 'blue' else 'blue'
+        target = os.path.join(self.directory, '{}.lastoperation.{}.json'.format(self.operation, self.color))
+        link = os.path.join(self.directory, '{}.lastoperation.json'.format(self.operation))
+        try:
+            with open(target, 'w') as f:
+                f.write(json.dumps({'state': state, 'stage': stage,
+                                    'updated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}))
+            if os.path.lexists(link + '.new'):
+                os.remove(link + '.new')
+            os.symlink(os.path.basename(target), link + '.new')
+            os.replace(link + '.new', link)
+        except OSError as error:
+            self.logger.warning('Could not write the last operation state of {}: {}'.format(self.operation, error))
+
+
+def run_job(iaas_client, landscape, job, spool_directory, results_directory):
+    """Runs one job and writes its result to `<results directory>/<backup guid>.json`; returns the result."""
+    timings = Timings('batch_backup')
+    result = {'instanceId': job['instance_id'], 'backupGuid': job['backup_guid'], 'type': job['type']}
+    with JobRecord(iaas_client.logger, job['backup_guid']) as record:
+        try:
+            job_client = InstrumentedClient(iaas_client, timings)
+            metadata = backup_snapshot(job_client, IaasBlobstore(job_client, spool_directory), landscape, job)
+            timings.succeeded = True
+            result.update(state='succeeded', **metadata)
+            record.update('succeeded', 'The snapshot backup has been taken.')
+        except (Exception, SystemExit) as error:
+            # +-> A failed call of the library exits after it logged why, which must only end this job
+            message = str(error) if isinstance(error, Exception) else \
+                'The library exited with code {}, see the log of the job.'.format(error.code)
+            iaas_client.logger.error('The backup {} of the instance {} failed: {}'
+                                     .format(job['backup_guid'], job['instance_id'], message))
+            result.update(state='failed', error=message)
+            record.update('failed', message)
+    result['timings'] = timings.to_json()
+    path = os.path.join(results_directory, '{}.json'.format(job['backup_guid']))
+    with open(path + '.new', 'w') as f:
+        f.write(json.dumps(result))
+    os.replace(path + '.new', path)
+    return result
+
+
+def main():
+    # +-> Definition of constants; all directories are below the root directory, which is only changed by the benchmark
+    DIRECTORY_ROOT = os.environ.get('SF_BACKUP_RESTORE_ROOT_DIRECTORY', '')
+    DIRECTORY_PERSISTENT = DIRECTORY_ROOT + '/var/vcap/store'
+    DIRECTORY_SPOOL = DIRECTORY_ROOT + '/tmp/service-fabrik-backup/spool'
+
+    # +-> Initialization: Argument Parsing, one IaaS-Client for all jobs, i.e. one authentication and one session; the
+    #     batch is an operation of its own, so its last operation state and log never replace the ones of a backup
+    #     taken by the agent, every job has its own besides (see `JobRecord`)
+    options = parse_extended_options('batch_backup')
+    batch_options = parse_batch_options()
+    configuration = parse_options('backup')
+    poll_arguments = [options['iaas_poll_interval'], 18000] if options['iaas_poll_interval'] else []
+    iaas_client = create_iaas_client('batch_backup', configuration, DIRECTORY_PERSISTENT, [], *poll_arguments)
+    # +-> The bound on the calls per second also covers the status polls the library makes while it waits for a
+    #     snapshot to be created; there is no call that polls the snapshots of several jobs at once
+    # +-> The jobs share the client, but make their calls one at a time; their waits for the snapshots overlap
+    clock = LibraryClock()
+    iaas_client = SerializedClient(iaas_client, clock)
+    if batch_options['max_call_rate']:
+        clock.limiter = RateLimiter(batch_options['max_call_rate'])
+        iaas_client = RateLimitedClient(iaas_client, clock.limiter)
+    clock.install()
+    iaas_client = PollingClient(iaas_client, clock)
+
+    # ------------------------------------------ BATCH START -----------------------------------------------------------
+    landscape = configuration['iaas'].title()
+    iaas_client.initialize()
+
+    try:
+        if landscape not in SNAPSHOT_LANDSCAPES:
+            iaas_client.exit('Backups on {} are taken through the instance itself, they cannot be batched.'
+                             .format(configuration['iaas']))
+        jobs = load_jobs(batch_options['jobs'])
+        os.makedirs(batch_options['results_directory'], exist_ok=True)
+
+        # +-> Every job writes its own result, a failed job does not stop the others
+        with ThreadPoolExecutor(max_workers=max(1, batch_options['concurrency'])) as executor:
+            results = list(executor.map(lambda job: run_job(iaas_client, landscape, job, DIRECTORY_SPOOL,
+                                                             batch_options['results_directory']), jobs))
+
+        iaas_client.logger.info('The library polled the status of snapshots {} times.'.format(clock.polls))
+        failed = [result['backupGuid'] for result in results if result['state'] == 'failed']
+        if failed:
+            iaas_client.exit('{} of {} backups of the batch failed: {}'.format(len(failed), len(results),
+                                                                             ', '.join(failed)))
+        iaas_client.finalize()
+    except Exception as error:
+        iaas_client.exit('An unexpected exception occurred: {}'.format(error))
+    # ------------------------------------------- BATCH END ------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Benchmark of the backup and restore flows against a local stand-in of the IaaS and the blob store.
+
+Every scenario takes a backup of a synthetic dataset with `backup.py` and restores it with `restore.py`, each in its
+own process, and verifies the restored files. Wall time, peak RSS and the per-step timings of every run are written as
+JSON, so results of different commits can be compared:
+
+    python3 backuprestore/benchmark/run.py --dataset mixed --size 256 --output results.json
+
+The real library is replaced by `service_fabrik_backup_restore.py` of this directory; see there for the simulation.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+sys.path.insert(0, SCRIPT_DIRECTORY)
+
+from manifest import compute_digest, scan_directory  # noqa: E402
+from blocks import matches  # noqa: E402
+
+MEBIBYTE = 1024 * 1024
+
+# +-> Every path through the landscape and backup type branches of backup.py and restore.py; the Ali landscape is only
+#     backed up, restore.py has no snapshot restore for it. Scenarios with `changes` take a second backup after that
+#     fraction of the files was modified, which is the case incremental and deduplicated backups are made for.
+#     Scenarios with `rollback` restore over the files after that fraction was modified instead of into an empty
+#     directory, i.e. roll back recent changes. Scenarios with `fail` let the first backup fail in that IaaS call (or
+#     in its n-th call, `<method>:<n>`) and retry it with the same backup guid, which resumes from the journal.
+#     Scenarios with a `volume_pool_size` lease the scratch volumes of all their runs from the pool of warm volumes.
+#     Every backup is verified with `verify.py` before it is restored; scenarios with `corrupt` flip a byte of the
+#     largest blob of the backup instead and expect the verification and the restore to fail without touching the
+#     files. Scenarios with `partial` change every file and remove the first directory after the backup and then only
+#     restore these paths, all other changes have to remain.
+SCENARIOS = {
+    'openstack-online-tarball': {'iaas': 'openstack', 'type': 'online'},
+    'openstack-online-streaming': {'iaas': 'openstack', 'type': 'online', 'options': {'archive_format': 'streaming'}},
+    'openstack-online-dedup': {'iaas': 'openstack', 'type': 'online', 'options': {'archive_format': 'dedup'},
+                               'changes': 0.05},
+    'openstack-offline-tarball': {'iaas': 'openstack', 'type': 'offline'},
+    'openstack-offline-tarball-pooled': {'iaas': 'openstack', 'type': 'offline', 'options': {'volume_pool_size': 1},
+                                         'changes': 0.05},
+    'openstack-online-tarball-parallel': {'iaas': 'openstack', 'type': 'online',
+                                          'options': {'part_size': 1, 'tarball_parallelism': 4}},
+    'openstack-online-tarball-resume': {'iaas': 'openstack', 'type': 'online', 'fail': 'upload_to_blobstore'},
+    'openstack-online-resumable-resume': {'iaas': 'openstack', 'type': 'online',
+                                          'options': {'archive_format': 'resumable', 'part_size': 1},
+                                          'fail': 'upload_to_blobstore:3'},
+    'openstack-online-streaming-throttled': {'iaas': 'openstack', 'type': 'online',
+                                             'options': {'archive_format': 'streaming', 'read_rate_limit': 32,
+                                                         'upload_rate_limit': 16, 'nice': 5, 'max_load': 64}},
+    'openstack-online-streaming-corrupt': {'iaas': 'openstack', 'type': 'online',
+                                           'options': {'archive_format': 'streaming'}, 'corrupt': True},
+    'openstack-online-tarball-corrupt': {'iaas': 'openstack', 'type': 'online', 'corrupt': True},
+    'openstack-online-blocks': {'iaas': 'openstack', 'type': 'online',
+                                'options': {'archive_format': 'blocks', 'block_size': 1}},
+    'openstack-online-blocks-partial': {'iaas': 'openstack', 'type': 'online',
+                                        'options': {'archive_format': 'blocks', 'block_size': 1},
+                                        'partial': ['d000', 'd001/f00000*']},
+    'openstack-offline-streaming': {'iaas': 'openstack', 'type': 'offline',
+                                    'options': {'archive_format': 'streaming'}},
+    'aws-online': {'iaas': 'aws', 'type': 'online'},
+    'aws-offline': {'iaas': 'aws', 'type': 'offline'},
+    'aws-online-rollback': {'iaas': 'aws', 'type': 'online', 'rollback': 0.05},
+    'azure-online': {'iaas': 'azure', 'type': 'online'},
+    'gcp-offline': {'iaas': 'gcp', 'type': 'offline'},
+    'ali-online': {'iaas': 'ali', 'type': 'online', 'restore': False},
+    'incremental': {'iaas': 'openstack', 'type': 'incremental', 'changes': 0.05},
+}
+
+DATASETS = ('small_files', 'large_files', 'mixed')
+
+
+def write_file(path, size, generator):
+    """Writes a file whose content is half random and half repeated text, i.e. compresses to about a half."""
+    with open(path, 'wb') as f:
+        while size > 0:
+            block = min(size, MEBIBYTE)
+            random_part = block // 2
+            f.write(generator.getrandbits(8 * random_part).to_bytes(random_part, 'little') if random_part else b'')
+            f.write((b'blueprint ' * (block // 10 + 1))[:block - random_part])
+            size -= block
+
+
+def create_dataset(directory, kind, size, seed=0):
+    """Many files of 4 KiB, a few files of a quarter of the size each, or a mix of both (by volume)."""
+    generator = random.Random(seed)
+    sizes = []
+    if kind in ('small_files', 'mixed'):
+        small = size if kind == 'small_files' else size // 2
+        sizes += [4096] * (small // 4096)
+    if kind in ('large_files', 'mixed'):
+        large = size if kind == 'large_files' else size - sum(sizes)
+        sizes += [large // 4] * 4
+    for index, file_size in enumerate(sizes):
+        subdirectory = os.path.join(directory, 'd{:03d}'.format(index // 256))
+        os.makedirs(subdirectory, exist_ok=True)
+        write_file(os.path.join(subdirectory, 'f{:06d}'.format(index)), file_size, generator)
+
+
+def change_files(directory, fraction, seed=1):
+    generator = random.Random(seed)
+    files = [entry.path for entry in scan_directory(directory) if entry.type == 'f']
+    for path in generator.sample(files, max(1, int(len(files) * fraction))):
+        with open(os.path.join(directory, path), 'r+b') as f:
+            f.write(generator.getrandbits(8 * 64).to_bytes(64, 'little'))
+
+
+def describe_tree(directory):
+    return [(entry.path, entry.type, entry.size if entry.type == 'f' else None,
+             compute_digest(directory, entry)) for entry in scan_directory(directory)]
+
+
+def corrupt_backup(root, container, backup_guid):
+    """Flips a byte in the middle of the largest blob of the backup."""
+    folder = os.path.join(root, 'iaas', 'blobstore', container, backup_guid)
+    path = max((os.path.join(folder, name) for name in os.listdir(folder)), key=os.path.getsize)
+    with open(path, 'r+b') as f:
+        f.seek(os.path.getsize(path) // 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+
+def run_script(root, operation, arguments, environment):
+    """Runs backup.py, verify.py or restore.py; returns its wall time, peak RSS, exit code and the timings it exported."""
+    log_directory = os.path.join(root, 'logs')
+    output_path = os.path.join(log_directory, '{}.output.json'.format(operation))
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    with open(os.path.join(log_directory, '{}.log'.format(operation)), 'ab') as log:
+        started = time.monotonic()
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIRECTORY, '{}.py'.format(operation))] +
+                                   ['--{}={}'.format(key, value) for key, value in arguments.items()],
+                                   env=environment, stdout=log, stderr=log)
+        _, status, usage = os.wait4(process.pid, 0)
+        duration = time.monotonic() - started
+    output = {}
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            output = json.load(f)
+    return {
+        'exitCode': os.waitstatus_to_exitcode(status),
+        'duration': round(duration, 3),
+        'maxRss': usage.ru_maxrss * 1024,
+        'steps': output.get('timings', {}).get('steps', {}),
+        'throttling': output.get('throttling')
+    }
+
+
+def run_scenario(name, scenario, dataset_directory, root, arguments):
+    files_directory = os.path.join(root, 'var/vcap/store/blueprint/files')
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(os.path.join(root, 'logs'))
+    os.makedirs(os.path.join(root, 'lastoperation'))
+    shutil.copytree(dataset_directory, files_directory, symlinks=True)
+    environment = dict(os.environ,
+                       PYTHONPATH=os.pathsep.join([BENCHMARK_DIRECTORY, SCRIPT_DIRECTORY]),
+                       SF_BACKUP_RESTORE_ROOT_DIRECTORY=root,
+                       SF_BACKUP_RESTORE_LOG_DIRECTORY=os.path.join(root, 'logs'),
+                       SF_BACKUP_RESTORE_LAST_OPERATION_DIRECTORY=os.path.join(root, 'lastoperation'),
+                       BENCHMARK_LATENCY_SCALE=str(arguments.latency_scale),
+                       BENCHMARK_BANDWIDTH=str(arguments.bandwidth))
+    configuration = dict(scenario.get('options', {}), iaas=scenario['iaas'], type=scenario['type'],
+                         instance_id='benchmark', container='benchmark', secret=uuid.uuid4().hex)
+    result = {'scenario': name, 'runs': []}
+
+    def backup(label, backup_environment=environment):
+        run = dict(run_script(root, 'backup', configuration, backup_environment), operation=label)
+        result['runs'].append(run)
+        return run['exitCode'] == 0
+
+    configuration['backup_guid'] = str(uuid.uuid4())
+    if scenario.get('fail'):
+        # +-> The failure is expected, hence the run does not count as failed
+        if backup('backup_failed', dict(environment, BENCHMARK_FAIL=scenario['fail'])):
+            return result
+        result['runs'][-1]['exitCode'] = 0
+        if not backup('backup_resumed'):
+            return result
+    elif not backup('backup'):
+        return result
+    if scenario.get('changes'):
+        change_files(files_directory, scenario['changes'])
+        configuration['backup_guid'] = str(uuid.uuid4())
+        if not backup('backup_after_changes'):
+            return result
+    if scenario.get('restore', True) and scenario.get('corrupt'):
+        # +-> Both failures are expected, hence the runs do not count as failed; the files must be left as they are
+        corrupt_backup(root, configuration['container'], configuration['backup_guid'])
+        expected = describe_tree(files_directory)
+        for operation in ('verify', 'restore'):
+            run = dict(run_script(root, operation, configuration, environment), operation=operation + '_corrupt')
+            result['runs'].append(run)
+            result['verified'] = result.get('verified', True) and run['exitCode'] != 0 and \
+                describe_tree(files_directory) == expected
+            run['exitCode'] = 0
+    elif scenario.get('partial'):
+        patterns = scenario['partial']
+        expected = [entry for entry in describe_tree(files_directory) if matches(entry[0], patterns)]
+        change_files(files_directory, 1.0, seed=2)
+        shutil.rmtree(os.path.join(files_directory, patterns[0]))
+        expected = sorted(expected + [entry for entry in describe_tree(files_directory)
+                                      if not matches(entry[0], patterns)], key=lambda entry: entry[0].split('/'))
+        run = dict(run_script(root, 'restore', dict(configuration, restore_mode='partial',
+                                                    restore_paths=json.dumps(patterns)), environment),
+                   operation='restore_partial')
+        result['runs'].append(run)
+        result['verified'] = run['exitCode'] == 0 and describe_tree(files_directory) == expected
+    elif scenario.get('restore', True):
+        run = dict(run_script(root, 'verify', configuration, environment), operation='verify')
+        result['runs'].append(run)
+        if run['exitCode'] != 0:
+            return result
+        expected = describe_tree(files_directory)
+        if scenario.get('rollback'):
+            change_files(files_directory, scenario['rollback'], seed=2)
+        else:
+            shutil.rmtree(files_directory)
+            os.makedirs(files_directory)
+        run = dict(run_script(root, 'restore', configuration, environment), operation='restore')
+        result['runs'].append(run)
+        result['verified'] = run['exitCode'] == 0 and describe_tree(files_directory) == expected
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, can be repeated; defaults to all')
+    parser.add_argument('--dataset', action='append', choices=DATASETS, help='Dataset to use, defaults to all')
+    parser.add_argument('--size', type=int, default=64, help='Size of each dataset in MiB')
+    parser.add_argument('--latency_scale', type=float, default=0.01,
+                        help='Factor applied to the typical latencies of the IaaS calls, 0 disables them')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='Bandwidth of the blob store in MiB/s, 0 means unlimited')
+    parser.add_argument('--directory', help='Working directory, defaults to a temporary one')
+    parser.add_argument('--output', help='File to write the results to, defaults to standard output')
+    arguments = parser.parse_args()
+
+    working_directory = arguments.directory or tempfile.mkdtemp(prefix='blueprint-benchmark-')
+    results = []
+    try:
+        for dataset in arguments.dataset or DATASETS:
+            dataset_directory = os.path.join(working_directory, 'datasets', dataset)
+            if not os.path.isdir(dataset_directory):
+                create_dataset(dataset_directory, dataset, arguments.size * MEBIBYTE)
+            for name in arguments.scenario or sorted(SCENARIOS):
+                result = run_scenario(name, SCENARIOS[name], dataset_directory,
+                                      os.path.join(working_directory, 'root'), arguments)
+                result.update(dataset=dataset, size=arguments.size * MEBIBYTE)
+                results.append(result)
+                print('{:<30} {:<12} {}'.format(name, dataset, ' '.join(
+                    '{}={}s'.format(run['operation'], run['duration']) if run['exitCode'] == 0 else
+                    '{}=failed'.format(run['operation']) for run in result['runs'])), file=sys.stderr)
+    finally:
+        if not arguments.directory:
+            shutil.rmtree(working_directory, ignore_errors=True)
+
+    document = json.dumps({'latencyScale': arguments.latency_scale, 'bandwidth': arguments.bandwidth,
+                           'results': results}, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            f.write(document)
+    else:
+        print(document)
+    return 0 if all(run['exitCode'] == 0 for result in results for run in result['runs']) and \
+        all(result.get('verified', True) for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""Local stand-in for the backup & restore library, used by the benchmark.
+
+It provides `parse_options` and `create_iaas_client` under the module name of the library, so `backup.py` and
+`restore.py` run unchanged when this directory comes first on the `PYTHONPATH`. The IaaS is simulated below
+`<root>/iaas` of the benchmark's root directory: volumes and snapshots are plain directories, mounting a volume replaces
+the mount directory by a symbolic link to the volume and the blob store is a `DirectoryBlobstore`. Every call sleeps
+for a typical latency of the real IaaS call (scaled by `BENCHMARK_LATENCY_SCALE`) and every blob transfer is throttled
+to `BENCHMARK_BANDWIDTH` MiB/s, if set, like a single stream to an object store. The method named by `BENCHMARK_FAIL` fails, to benchmark retries;
+with `<method>:<n>` only its n-th call fails, e.g. an upload in the middle of a streamed archive.
+"""
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from blobstore import DirectoryBlobstore
+from compression import GzipCodec
+from streaming import create_encrypted_archive, extract_encrypted_archive
+
+# +-> Typical duration of the IaaS calls in seconds
+LATENCIES = {
+    'get_persistent_volume_for_instance': 0.5,
+    'create_snapshot': 20.0,
+    'copy_snapshot': 30.0,
+    'get_snapshot': 0.5,
+    'delete_snapshot': 2.0,
+    'create_volume': 10.0,
+    'delete_volume': 5.0,
+    'create_attachment': 15.0,
+    'delete_attachment': 10.0,
+    'get_mountpoint': 1.0,
+    'format_device': 2.0,
+    'mount_device': 0.2,
+    'unmount_device': 0.2,
+    'upload_to_blobstore': 0.1,
+    'download_from_blobstore': 0.1,
+    'stop_service_job': 0.5,
+    'start_service_job': 0.5,
+    'wait_for_service_job_status': 5.0,
+}
+
+Volume = namedtuple('Volume', ['id', 'size'])
+Snapshot = namedtuple('Snapshot', ['id', 'size'])
+Attachment = namedtuple('Attachment', ['volume_id', 'instance_id'])
+
+PERSISTENT_VOLUME_ID = 'vol-persistent'
+
+
+def parse_options(operation_name):
+    configuration = {}
+    for argument in sys.argv[1:]:
+        key, _, value = argument.lstrip('-').partition('=')
+        configuration[key] = value
+    return configuration
+
+
+# +-> Seconds between two status polls while a resource is created or deleted, unless the caller sets it
+POLL_INTERVAL = 2.0
+POLLING_METHODS = ('create_snapshot', 'copy_snapshot', 'delete_snapshot', 'create_volume', 'delete_volume',
+                   'create_attachment', 'delete_attachment')
+
+
+def create_iaas_client(operation_name, configuration, directory_persistent, directories=None, *args):
+    return FakeIaasClient(operation_name, configuration, directory_persistent, *args)
+
+
+class FakeIaasClient:
+    def __init__(self, operation_name, configuration, directory_persistent, poll_interval=None, *_):
+        self.operation_name = operation_name
+        self.poll_interval = poll_interval or POLL_INTERVAL
+        self.configuration = configuration
+        self.directory_persistent = directory_persistent
+        self.root = os.path.join(os.environ['SF_BACKUP_RESTORE_ROOT_DIRECTORY'], 'iaas')
+        self.blobstore = DirectoryBlobstore(
+            os.path.join(self.root, 'blobstore', configuration.get('container', 'benchmark')),
+            os.path.join(self.root, 'spool'))
+        self.latency_scale = float(os.environ.get('BENCHMARK_LATENCY_SCALE', '1'))
+        self.bandwidth = float(os.environ.get('BENCHMARK_BANDWIDTH', '0')) * 1024 * 1024
+        self.failing_method, _, failing_call = os.environ.get('BENCHMARK_FAIL', '').partition(':')
+        self.failing_call = int(failing_call or 1)
+        self.calls = {}
+        self.mounts_path = os.path.join(self.root, 'mounts.json')
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(operation_name)
+        for directory in ('volumes', 'snapshots', 'blobstore'):
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+
+    def _wait(self, name, size=0):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            failing = name == self.failing_method and self.calls[name] == self.failing_call
+        if failing:
+            self.exit('Simulated failure of {}.'.format(name))
+        delay = LATENCIES.get(name, 0) * self.latency_scale
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        if name in POLLING_METHODS:
+            # +-> Like the library, poll the status of the resource until it is ready, sleeping in between
+            deadline = time.monotonic() + delay
+            while time.monotonic() < deadline:
+                time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+            return
+        time.sleep(delay)
+
+    def _volume_directory(self, volume_id):
+        if volume_id == PERSISTENT_VOLUME_ID:
+            return self.directory_persistent
+        return os.path.join(self.root, 'volumes', volume_id)
+
+    # +-> Lifecycle
+
+    def initialize(self):
+        self.logger.info('Starting the {}.'.format(self.operation_name))
+
+    def finalize(self):
+        self.logger.info('The {} has finished.'.format(self.operation_name))
+
+    def exit(self, message):
+        self.logger.error(message)
+        sys.exit(1)
+
+    # +-> Volumes and snapshots
+
+    def get_persistent_volume_for_instance(self, instance_id):
+        self._wait('get_persistent_volume_for_instance')
+        return Volume(PERSISTENT_VOLUME_ID, 10)
+
+    def create_snapshot(self, volume_id):
+        self._wait('create_snapshot')
+        snapshot = Snapshot('snap-{}'.format(uuid.uuid4().hex[:8]), 10)
+        shutil.copytree(self._volume_directory(volume_id), os.path.join(self.root, 'snapshots', snapshot.id),
+                        symlinks=True)
+        return snapshot
+
+    def copy_snapshot(self, snapshot_id):
+        self._wait('copy_snapshot')
+        source = os.path.join(self.root, 'snapshots', snapshot_id)
+        if not os.path.isdir(source):
+            source = self._volume_directory(snapshot_id)
+        snapshot = Snapshot('snap-{}'.format(uuid.uuid4().hex[:8]), 10)
+        shutil.copytree(source, os.path.join(self.root, 'snapshots', snapshot.id), symlinks=True)
+        return snapshot
+
+    def get_snapshot(self, snapshot_id):
+        self._wait('get_snapshot')
+        if not os.path.isdir(os.path.join(self.root, 'snapshots', snapshot_id)):
+            return None
+        return Snapshot(snapshot_id, 10)
+
+    def delete_snapshot(self, snapshot_id):
+        self._wait('delete_snapshot')
+        shutil.rmtree(os.path.join(self.root, 'snapshots', snapshot_id), ignore_errors=True)
+        return True
+
+    def create_volume(self, size, snapshot_id=None):
+        self._wait('create_volume')
+        volume = Volume('vol-{}'.format(uuid.uuid4().hex[:8]), size)
+        if snapshot_id:
+            shutil.copytree(os.path.join(self.root, 'snapshots', snapshot_id), self._volume_directory(volume.id),
+                            symlinks=True)
+        else:
+            os.makedirs(self._volume_directory(volume.id))
+        return volume
+
+    def delete_volume(self, volume_id):
+        self._wait('delete_volume')
+        shutil.rmtree(self._volume_directory(volume_id), ignore_errors=True)
+        return True
+
+    def create_attachment(self, volume_id, instance_id):
+        self._wait('create_attachment')
+        return Attachment(volume_id, instance_id)
+
+    def delete_attachment(self, volume_id, instance_id):
+        self._wait('delete_attachment')
+        return True
+
+    def get_mountpoint(self, volume_id, partition=None):
+        self._wait('get_mountpoint')
+        directory = self._volume_directory(volume_id)
+        return directory if os.path.isdir(directory) else None
+
+    def format_device(self, device):
+        self._wait('format_device')
+        shutil.rmtree(device)
+        os.makedirs(device)
+        return True
+
+    def _update_mounts(self, device, directory=None):
+        # +-> The mount table outlives the process like real mounts do; returns the directory the device was mounted to
+        with self.lock:
+            mounts = {}
+            if os.path.exists(self.mounts_path):
+                with open(self.mounts_path) as f:
+                    mounts = json.load(f)
+            previous = mounts.pop(device, None)
+            if directory:
+                mounts[device] = directory
+            with open(self.mounts_path, 'w') as f:
+                json.dump(mounts, f)
+            return previous
+
+    def mount_device(self, device, directory):
+        self._wait('mount_device')
+        os.rmdir(directory)
+        os.symlink(device, directory)
+        self._update_mounts(device, directory)
+        return True
+
+    def unmount_device(self, device):
+        self._wait('unmount_device')
+        directory = self._update_mounts(device)
+        if directory is None or not os.path.islink(directory):
+            return False
+        os.unlink(directory)
+        os.mkdir(directory)
+        return True
+
+    # +-> Files and directories
+
+    def delete_directory(self, pattern):
+        for path in glob.glob(pattern):
+            if os.path.islink(path) or not os.path.isdir(path):
+                os.remove(path)
+            else:
+                shutil.rmtree(path)
+        return True
+
+    def create_directory(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        return True
+
+    def copy_directory(self, pattern, directory):
+        for path in glob.glob(pattern):
+            target = os.path.join(directory, os.path.basename(path))
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.copytree(path, target, symlinks=True)
+            else:
+                shutil.copy2(path, target, follow_symlinks=False)
+        return True
+
+    def create_and_encrypt_tarball_of_directory(self, directory, path):
+        try:
+            create_encrypted_archive(directory, path, self.configuration['secret'], GzipCodec())
+        except Exception as error:
+            self.logger.error(error)
+            return False
+        return True
+
+    def decrypt_and_extract_tarball_of_directory(self, path, directory):
+        try:
+            extract_encrypted_archive(path, directory, self.configuration['secret'], GzipCodec())
+        except Exception as error:
+            self.logger.error(error)
+            return False
+        return True
+
+    # +-> Blob store
+
+    def upload_to_blobstore(self, path, blob_name):
+        self._wait('upload_to_blobstore', os.path.getsize(path))
+        return self.blobstore.upload_file(path, blob_name)
+
+    def download_from_blobstore(self, blob_name, path):
+        source = self.blobstore.blob_path(blob_name)
+        if not os.path.exists(source):
+            return False
+        self._wait('download_from_blobstore', os.path.getsize(source))
+        return self.blobstore.download_file(blob_name, path)
+
+    # +-> Service job
+
+    def stop_service_job(self):
+        self._wait('stop_service_job')
+
+    def start_service_job(self):
+        self._wait('start_service_job')
+
+    def wait_for_service_job_status(self, status):
+        self._wait('wait_for_service_job_status')
+        return True
@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import tempfile
+from urllib.parse import quote
+
+
+class IaasBlobstore:
+    """Thin adapter around the blob store operations of an IaaS client.
+
+    The library only moves whole files between the local disk and the container; this adapter adds the small
+    conveniences (JSON documents, spool files) the blueprint specific backup formats need on top of that. Uploads wait
+    for the `upload_throttle` if given.
+    """
+
+    def __init__(self, iaas_client, spool_directory, upload_throttle=None):
+        self.iaas_client = iaas_client
+        self.spool_directory = spool_directory
+        self.upload_throttle = upload_throttle
+        os.makedirs(spool_directory, exist_ok=True)
+
+    def upload_file(self, path, blob_name):
+        if self.upload_throttle:
+            self.upload_throttle.consume(os.path.getsize(path))
+        return self.iaas_client.upload_to_blobstore(path, blob_name)
+
+    def download_file(self, blob_name, path):
+        return self.iaas_client.download_from_blobstore(blob_name, path)
+
+    def is_cached(self, blob_name):
+        return False
+
+    def has_file(self, blob_name):
+        """Whether the blob exists and is not empty, i.e. was not removed (see `remove_file`)."""
+        path = self.spool_file()
+        try:
+            return bool(self.download_file(blob_name, path)) and os.path.getsize(path) > 0
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def remove_file(self, blob_name):
+        # +-> The library cannot delete blobs; an empty blob takes the place of the removed one and frees its space
+        path = self.spool_file()
+        try:
+            return self.upload_file(path, blob_name)
+        finally:
+            os.remove(path)
+
+    def spool_file(self, suffix=''):
+        handle, path = tempfile.mkstemp(suffix=suffix, dir=self.spool_directory)
+        os.close(handle)
+        return path
+
+    def upload_json(self, document, blob_name):
+        path = self.spool_file('.json')
+        try:
+            with open(path, 'w') as f:
+                f.write(json.dumps(document))
+            return self.upload_file(path, blob_name)
+        finally:
+            os.remove(path)
+
+    def download_json(self, blob_name):
+        path = self.spool_file('.json')
+        try:
+            if not self.download_file(blob_name, path):
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            return None
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class DirectoryBlobstore(IaasBlobstore):
+    """A blob store in a local directory, which stands in for the one of the IaaS in tests and in the benchmark.
+
+    Blob names are paths relative to the directory. An upload is written to a temporary file that is renamed when it
+    is complete, so a blob is either there in full or not at all, like in an object store.
+    """
+
+    def __init__(self, directory, spool_directory, upload_throttle=None):
+        super().__init__(None, spool_directory, upload_throttle)
+        self.directory = directory
+
+    def blob_path(self, blob_name):
+        if blob_name.startswith('/') or '..' in blob_name.split('/'):
+            raise ValueError('Invalid blob name: {}'.format(blob_name))
+        return os.path.join(self.directory, blob_name)
+
+    def upload_file(self, path, blob_name):
+        if self.upload_throttle:
+            self.upload_throttle.consume(os.path.getsize(path))
+        target = self.blob_path(blob_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(prefix='.upload-', dir=os.path.dirname(target))
+        os.close(handle)
+        try:
+            shutil.copyfile(path, temporary_path)
+            os.replace(temporary_path, target)
+        except OSError:
+            os.remove(temporary_path)
+            return False
+        return True
+
+    def download_file(self, blob_name, path):
+        source = self.blob_path(blob_name)
+        if not os.path.exists(source):
+            return False
+        shutil.copyfile(source, path)
+        return True
+
+    def has_file(self, blob_name):
+        target = self.blob_path(blob_name)
+        return os.path.exists(target) and os.path.getsize(target) > 0
+
+    def remove_file(self, blob_name):
+        target = self.blob_path(blob_name)
+        if os.path.exists(target):
+            os.remove(target)
+        return True
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class CachingBlobstore:
+    """Keeps every blob downloaded through it in a directory, so that a second pass over the same blobs reads them from
+    the local disk instead of the blob store.
+
+    The restore uses it to download a backup only once when its blobs are checked before the service is stopped and
+    extracted afterwards. Blobs are hard-linked into and out of the cache, which is kept next to the spool files, so
+    nothing is copied; a blob is only cached once it was downloaded completely. Everything else is forwarded to the
+    blob store.
+    """
+
+    def __init__(self, blobstore, directory):
+        self.blobstore = blobstore
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __getattr__(self, name):
+        return getattr(self.blobstore, name)
+
+    def _cache_path(self, blob_name):
+        return os.path.join(self.directory, quote(blob_name, safe=''))
+
+    def is_cached(self, blob_name):
+        return os.path.exists(self._cache_path(blob_name))
+
+    def download_file(self, blob_name, path):
+        cached = self._cache_path(blob_name)
+        if os.path.exists(cached):
+            if os.path.lexists(path):
+                os.remove(path)
+            _link_or_copy(cached, path)
+            return True
+        if not self.blobstore.download_file(blob_name, path):
+            return False
+        _link_or_copy(path, cached + '.new')
+        os.replace(cached + '.new', cached)
+        return True
+
+    def download_json(self, blob_name):
+        return IaasBlobstore.download_json(self, blob_name)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,217 @@
+import fnmatch
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import progress
+from dedup import ordered_map
+from manifest import TYPE_DIRECTORY, scan_directory
+from streaming import decrypt_file, encrypt_file, stream_blobstore_to_directory, stream_directory_to_blobstore, \
+    verify_streamed_archive
+
+INDEX_NAME = 'blueprint-index.json.gz.gpg'
+
+
+class BlockArchiveError(Exception):
+    pass
+
+
+class IndexEntry(namedtuple('IndexEntry', ['path', 'type', 'size', 'block'])):
+    """One line of the index of a block archive; `block` is the number of the block the entry is archived in."""
+
+
+def _group_entries(entries, block_size):
+    """Groups the entries into lists whose files add up to `block_size` bytes; files are never split, hence a list
+    ends with the file that reaches the size.
+    """
+    group = []
+    size = 0
+    for entry in entries:
+        group.append(entry)
+        size += entry.size
+        if size >= block_size:
+            yield group
+            group = []
+            size = 0
+    if group:
+        yield group
+
+
+def blocks_directory_to_blobstore(blobstore, directory, passphrase, backup_guid, archive_name, block_size, part_size,
+                                  workers, codec, throttle=None, journal=None):
+    """Archives the directory as independent blocks of whole files plus an encrypted index of all entries.
+
+    Every block is a streamed archive of its own (see `stream_directory_to_blobstore`) of the entries listed for it,
+    so a single file is restored by fetching and extracting only its block. Blocks are archived and uploaded
+    concurrently by `workers` threads. Returns the metadata of the backup. With a `journal`, the parts of the blocks that
+    were uploaded by an earlier attempt are skipped.
+    """
+    index_path = blobstore.spool_file('.json.gz')
+    try:
+        with gzip.open(index_path, 'wt', encoding='utf-8') as index:
+            def listed_blocks():
+                for number, entries in enumerate(_group_entries(scan_directory(directory), block_size)):
+                    list_path = blobstore.spool_file('.list')
+                    with open(list_path, 'wb') as listing:
+                        for entry in entries:
+                            index.write(json.dumps([entry.path, entry.type, entry.size, number]) + '\n')
+                            listing.write(os.fsencode(entry.path) + b'\0')
+                    yield number, list_path
+
+            def store_block(item):
+                number, list_path = item
+                try:
+                    return stream_directory_to_blobstore(blobstore, directory, passphrase,
+                                                         '{}/{}.block-{:05d}'.format(backup_guid, archive_name, number),
+                                                         part_size, files_from=list_path, codec=codec,
+                                                         throttle=throttle, journal=journal, resumable=True)
+                finally:
+                    os.remove(list_path)
+
+            blocks = list(ordered_map(store_block, listed_blocks(), workers))
+
+        encrypted_path = blobstore.spool_file('.gpg')
+        try:
+            encrypt_file(index_path, encrypted_path, passphrase)
+            if not blobstore.upload_file(encrypted_path, '{}/{}'.format(backup_guid, INDEX_NAME)):
+                raise BlockArchiveError('Could not upload the index of backup {}.'.format(backup_guid))
+        finally:
+            os.remove(encrypted_path)
+    finally:
+        os.remove(index_path)
+    return {
+        'archive': archive_name,
+        'compression': codec.describe(),
+        'index': INDEX_NAME,
+        'blockSize': block_size,
+        'size': sum(block['size'] for block in blocks),
+        'fileCount': sum(block['fileCount'] for block in blocks),
+        'blocks': blocks
+    }
+
+
+def restore_block_archive(blobstore, backup_guid, metadata, passphrase, directory, workers):
+    """Extracts every block of the backup into the (empty) directory; blocks hold distinct entries, so concurrently."""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(lambda block: stream_blobstore_to_directory(blobstore, backup_guid, block, directory,
+                                                                      passphrase), metadata['blocks']))
+
+
+def verify_block_archive(blobstore, backup_guid, metadata, workers):
+    """Checks the digests of every block of the backup; returns the number of bytes checked."""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return sum(executor.map(lambda block: verify_streamed_archive(blobstore, backup_guid, block),
+                                metadata['blocks']))
+
+
+def read_index(blobstore, backup_guid, metadata, passphrase):
+    encrypted_path = blobstore.spool_file('.gpg')
+    index_path = blobstore.spool_file('.json.gz')
+    try:
+        if not blobstore.download_file('{}/{}'.format(backup_guid, metadata['index']), encrypted_path):
+            raise BlockArchiveError('Could not download the index of backup {}.'.format(backup_guid))
+        decrypt_file(encrypted_path, index_path, passphrase)
+        with gzip.open(index_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield IndexEntry(*json.loads(line))
+    finally:
+        os.remove(encrypted_path)
+        os.remove(index_path)
+
+
+def normalize_patterns(patterns, directory):
+    """Returns the patterns relative to the directory; raises a `BlockArchiveError` if one reaches outside of it."""
+    normalized = []
+    for pattern in patterns:
+        pattern = pattern.strip().lstrip('/')
+        while pattern.startswith('./'):
+            pattern = pattern[2:]
+        pattern = pattern.rstrip('/')
+        if not pattern or '..' in pattern.split('/'):
+            raise BlockArchiveError('Invalid path to restore: {}'.format(pattern))
+        _resolve_within(directory, pattern)
+        normalized.append(pattern)
+    return normalized
+
+
+def _resolve_within(directory, path):
+    """Returns the path in the directory with its parent directories resolved, e.g. through symbolic links."""
+    root = os.path.realpath(directory)
+    resolved = os.path.join(root, path)
+    resolved = os.path.join(os.path.realpath(os.path.dirname(resolved)), os.path.basename(resolved))
+    if not resolved.startswith(root + os.sep):
+        raise BlockArchiveError('Refusing to restore {} outside of {}.'.format(path, directory))
+    return resolved
+
+
+def matches(path, patterns):
+    """Tells whether the path or one of its parent directories equals or matches (as a glob) one of the patterns."""
+    components = path.split('/')
+    for length in range(1, len(components) + 1):
+        prefix = '/'.join(components[:length])
+        if any(prefix == pattern or fnmatch.fnmatchcase(prefix, pattern) for pattern in patterns):
+            return True
+    return False
+
+
+def _move_into_place(staging, directory, entry):
+    """Moves an extracted entry over the one in the directory; returns False if the block did not contain it."""
+    if '..' in entry.path.split('/') or entry.path.startswith('/'):
+        raise BlockArchiveError('Refusing to restore {} outside of {}.'.format(entry.path, directory))
+    source = os.path.join(staging, entry.path)
+    target = _resolve_within(directory, entry.path)
+    if not os.path.lexists(source):
+        return False
+    if entry.type == TYPE_DIRECTORY:
+        os.makedirs(target, exist_ok=True)
+        shutil.copystat(source, target, follow_symlinks=False)
+        return True
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.isdir(target) and not os.path.islink(target):
+        shutil.rmtree(target)
+    os.replace(source, target)
+    return True
+
+
+def restore_paths(blobstore, backup_guid, metadata, passphrase, directory, patterns, workers):
+    """Restores only the entries matching the patterns into the directory and leaves all other entries untouched.
+
+    Only the blocks holding matching entries are downloaded. Each block is extracted into a temporary sibling of the
+    directory (on the same filesystem) and the matching entries are renamed over the ones in the directory, so every
+    file is replaced at once while the service keeps running. Returns a summary of the restore.
+    """
+    patterns = normalize_patterns(patterns, directory)
+    selected = {}
+    for entry in read_index(blobstore, backup_guid, metadata, passphrase):
+        if matches(entry.path, patterns):
+            selected.setdefault(entry.block, []).append(entry)
+    if not selected:
+        raise BlockArchiveError('None of the paths {} is in backup {}.'.format(', '.join(patterns), backup_guid))
+    progress.expect(sum(metadata['blocks'][number]['size'] for number in selected))
+
+    parent = os.path.dirname(directory.rstrip('/'))
+    prefix = os.path.basename(directory.rstrip('/')) + '.partial-'
+
+    def restore_block(number):
+        block = metadata['blocks'][number]
+        staging = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        try:
+            stream_blobstore_to_directory(blobstore, backup_guid, block, staging, passphrase)
+            restored = sum(1 for entry in selected[number] if _move_into_place(staging, directory, entry))
+            return restored, block['size']
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(restore_block, sorted(selected)))
+    return {
+        'paths': patterns,
+        'entries': sum(restored for restored, _ in results),
+        'missing': sum(len(entries) for entries in selected.values()) - sum(restored for restored, _ in results),
+        'blocks': len(selected),
+        'bytes': sum(size for _, size in results)
+    }
@@ -0,0 +1,99 @@
+import abc
+import collections
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class Codec(abc.ABC):
+    """A compression stage of the archive pipeline.
+
+    A codec either names the commands that (de-)compress standard input to standard output, or compresses in-process
+    via `compress(source, sink)`; decompression is always done by a command.
+    """
+
+    name = None
+    extension = None
+    default_level = None
+
+    def __init__(self, level=None, threads=None):
+        self.level = level if level is not None else self.default_level
+        self.threads = threads or os.cpu_count() or 1
+
+    def compress_command(self):
+        return None
+
+    @abc.abstractmethod
+    def decompress_command(self):
+        pass
+
+    def describe(self):
+        return {'codec': self.name, 'level': self.level, 'threads': self.threads}
+
+
+class GzipCodec(Codec):
+    """Single-threaded gzip, the format of all archives that have no compression recorded in their metadata."""
+
+    name = 'gzip'
+    extension = 'gz'
+    default_level = 6
+
+    def compress_command(self):
+        return ['gzip', '-{}'.format(self.level), '-c']
+
+    def decompress_command(self):
+        return ['gzip', '-d', '-c']
+
+
+class ParallelGzipCodec(GzipCodec):
+    """Compresses independent blocks on all threads and writes them as consecutive gzip members.
+
+    A sequence of gzip members is a valid gzip file, hence the output can be decompressed by every gzip implementation
+    including `tar -z`. zlib releases the GIL while compressing, so the blocks are compressed in parallel.
+    """
+
+    name = 'pgzip'
+
+    def compress_command(self):
+        return None
+
+    def compress(self, source, sink):
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = collections.deque()
+            for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+                pending.append(executor.submit(gzip.compress, block, self.level, mtime=0))
+                if len(pending) >= 2 * self.threads:
+                    sink.write(pending.popleft().result())
+            while pending:
+                sink.write(pending.popleft().result())
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    extension = 'zst'
+    default_level = 3
+
+    def compress_command(self):
+        return ['zstd', '-q', '-{}'.format(self.level), '-T{}'.format(self.threads), '-c']
+
+    def decompress_command(self):
+        return ['zstd', '-q', '-d', '-c']
+
+
+CODECS = {codec.name: codec for codec in (GzipCodec, ParallelGzipCodec, ZstdCodec)}
+
+
+def create_codec(name='gzip', level=None, threads=None):
+    return CODECS[name](level, threads)
+
+
+def codec_from_metadata(metadata):
+    """Returns the codec an archive was written with; archives without a record were compressed by gzip."""
+    compression = metadata.get('compression') or {}
+    return create_codec(compression.get('codec', 'gzip'), compression.get('level'), compression.get('threads'))
+
+
+def archive_name(codec):
+    return 'blueprint-files.tar.{}.gpg'.format(codec.extension)
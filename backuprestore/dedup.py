@@ -0,0 +1,454 @@
+import collections
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import progress
+from streaming import READ_SIZE, Pipeline, StreamingError, check_digest, decrypt_text, encrypt_command, encrypt_text, \
+    gpg_command
+
+CHUNK_PREFIX = 'blueprint-chunks'
+RECIPE_NAME = 'blueprint-recipe.json.gz'
+LOCAL_KEY_NAME = 'chunk.key'
+# +-> A backup whose metadata could not be downloaded this many times in a row is taken as deleted, a single failed
+#     download must not free the chunks of a backup that still exists
+GC_GRACE_CHECKS = 3
+# +-> Number of known chunks whose blobs are looked up before a backup relies on the local index
+KNOWN_CHUNK_SAMPLES = 8
+# +-> New chunks are uploaded in packs of about this many compressed bytes; every record of a pack is the binary address
+#     and the size of a compressed chunk followed by the chunk
+PACK_SIZE = 8 * 1024 * 1024
+PACK_RECORD = struct.Struct('>32sI')
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# +-> A boundary is placed behind an anchor whose preceding window matches the mask; the anchor occurs every 64 KiB in
+#     random data and every 16th occurrence matches, which results in chunks of about 1 MiB beyond the minimum size
+ANCHOR = b'\x5a\xa5'
+WINDOW = 64
+MASK = 0xf
+
+
+def find_boundary(buffer):
+    end = min(len(buffer), MAX_CHUNK_SIZE)
+    position = buffer.find(ANCHOR, MIN_CHUNK_SIZE, end)
+    while position != -1:
+        if zlib.crc32(buffer[position - WINDOW:position]) & MASK == 0:
+            return position + len(ANCHOR)
+        position = buffer.find(ANCHOR, position + 1, end)
+    return end
+
+
+def chunk_stream(stream):
+    """Splits a stream into content-defined chunks of `MIN_CHUNK_SIZE` to `MAX_CHUNK_SIZE` bytes.
+
+    Boundaries only depend on the bytes right in front of them, so an insertion or deletion only changes the chunks
+    around it and all other chunks keep their content (and therefore their key). Searching is done by `bytes.find` and
+    `zlib.crc32`, which keeps the per-byte work out of the interpreter.
+    """
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_CHUNK_SIZE:
+            data = stream.read(READ_SIZE)
+            if data:
+                buffer += data
+            else:
+                eof = True
+        if not buffer:
+            return
+        boundary = find_boundary(buffer)
+        yield bytes(buffer[:boundary])
+        del buffer[:boundary]
+
+
+def load_chunk_key(state_directory):
+    """Returns the key of this instance's chunk store and creates it on first use.
+
+    Chunks have to be encrypted with the same key in every backup to be shareable, while secrets are generated per
+    backup. Every backup therefore keeps this key encrypted with its own secret.
+    """
+    os.makedirs(state_directory, mode=0o700, exist_ok=True)
+    path = os.path.join(state_directory, LOCAL_KEY_NAME)
+    if not os.path.exists(path):
+        descriptor = os.open(path + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as f:
+            f.write(os.urandom(32).hex())
+        os.replace(path + '.new', path)
+    with open(path) as f:
+        return f.read().strip()
+
+
+class ChunkStore:
+    """Content-addressed, encrypted chunks in the blob store.
+
+    The address of a chunk is the HMAC-SHA256 of its content keyed with the chunk key, so equal content is stored once
+    without revealing hashes of the plain data. Which chunks already exist is looked up in a local index of the
+    chunks this instance uploaded with the key.
+
+    New chunks are compressed one by one and collected in packs of about `PACK_SIZE` bytes, each of which is encrypted
+    by a single gpg process and uploaded as one blob; the recipe and the index tell the pack of every chunk. Chunks
+    stored before packs were introduced are blobs of their own and are read as such. A restore keeps the last
+    `cache_packs` decrypted packs in memory, as the chunks of a pack are mostly referenced one after the other.
+    """
+
+    def __init__(self, blobstore, key, state_directory=None, cache_packs=4):
+        self.blobstore = blobstore
+        self.key = key
+        self.key_id = hashlib.sha256(key.encode('ascii')).hexdigest()[:16]
+        self.lock = threading.Lock()
+        # +-> Address of every known chunk to the id of its pack, or None for a chunk in a blob of its own
+        self.known = {}
+        self.index_path = None
+        self.recipes_directory = None
+        self.retained = set()
+        self.packing = {}
+        self.pack_id = None
+        self.pack = []
+        self.pack_size = 0
+        self.cache_packs = cache_packs
+        self.cache = collections.OrderedDict()
+        self.loading = {}
+        if state_directory:
+            self.index_path = os.path.join(state_directory, 'chunks-{}.idx'.format(self.key_id))
+            if os.path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    for line in f:
+                        fields = line.split()
+                        self.known[fields[0]] = fields[1] if len(fields) > 1 else None
+            self.recipes_directory = os.path.join(state_directory, 'recipes-{}'.format(self.key_id))
+            retained_path = os.path.join(self.recipes_directory, 'retained.idx')
+            if not os.path.isdir(self.recipes_directory):
+                # +-> The recipes of the backups taken before they were kept here are unknown, so the chunks known by
+                #     then are never collected
+                os.makedirs(self.recipes_directory, mode=0o700)
+                self._write_lines(retained_path, self.known)
+            with open(retained_path) as f:
+                self.retained = set(line.strip() for line in f)
+
+    @staticmethod
+    def _write_lines(path, lines):
+        with open(path + '.new', 'w') as f:
+            f.writelines(line + '\n' for line in sorted(lines))
+        os.replace(path + '.new', path)
+
+    @staticmethod
+    def _index_line(address, pack_id):
+        return '{} {}'.format(address, pack_id) if pack_id else address
+
+    def _write_index(self):
+        if self.index_path:
+            self._write_lines(self.index_path, (self._index_line(address, pack_id)
+                                                for address, pack_id in self.known.items()))
+
+    def address(self, data):
+        return hmac.new(self.key.encode('ascii'), data, hashlib.sha256).hexdigest()
+
+    def blob_name(self, address, pack_id=None):
+        if pack_id:
+            return '{}/{}/packs/{}'.format(CHUNK_PREFIX, self.key_id, pack_id)
+        return '{}/{}/{}/{}'.format(CHUNK_PREFIX, self.key_id, address[:2], address)
+
+    def store(self, data):
+        """Adds the chunk to a pack unless it is known already.
+
+        Returns its address, the id of its pack and the number of bytes added; the pack is uploaded once it is full or
+        by `flush`, so the chunk only exists in the blob store after that.
+        """
+        address = self.address(data)
+        with self.lock:
+            if address in self.known:
+                return address, self.known[address], 0
+            if address in self.packing:
+                return address, self.packing[address], 0
+        compressed = zlib.compress(data, 6)
+        sealed = None
+        with self.lock:
+            if address in self.packing:
+                return address, self.packing[address], 0
+            if not self.pack_id:
+                self.pack_id = uuid.uuid4().hex
+            pack_id = self.pack_id
+            self.packing[address] = pack_id
+            self.pack.append((address, compressed))
+            self.pack_size += len(compressed)
+            if self.pack_size >= PACK_SIZE:
+                sealed = (self.pack_id, self.pack)
+                self.pack_id, self.pack, self.pack_size = None, [], 0
+        if sealed:
+            self._upload_pack(*sealed)
+        return address, pack_id, len(compressed)
+
+    def flush(self):
+        """Uploads the pack that is not full yet."""
+        with self.lock:
+            sealed = (self.pack_id, self.pack)
+            self.pack_id, self.pack, self.pack_size = None, [], 0
+        if sealed[1]:
+            self._upload_pack(*sealed)
+
+    def _upload_pack(self, pack_id, records):
+        plain = b''.join(PACK_RECORD.pack(bytes.fromhex(address), len(compressed)) + compressed
+                         for address, compressed in records)
+        pipeline = Pipeline(self.key)
+        passphrase_fd = pipeline.passphrase_pipe()
+        process = pipeline.spawn(encrypt_command(passphrase_fd), stdin=subprocess.PIPE, pass_fds=(passphrase_fd,))
+        encrypted, _ = process.communicate(plain)
+        pipeline.wait()
+        path = self.blobstore.spool_file('.pack')
+        try:
+            with open(path, 'wb') as f:
+                f.write(encrypted)
+            if not self.blobstore.upload_file(path, self.blob_name(None, pack_id)):
+                raise StreamingError('Could not upload the pack {}.'.format(pack_id))
+        finally:
+            os.remove(path)
+        with self.lock:
+            for address, _ in records:
+                self.known[address] = pack_id
+                del self.packing[address]
+            if self.index_path:
+                with open(self.index_path, 'a') as f:
+                    f.writelines(self._index_line(address, pack_id) + '\n' for address, _ in records)
+
+    def check_known(self, samples=KNOWN_CHUNK_SAMPLES):
+        """Looks up a random sample of the blobs of the known chunks in the blob store; returns the number of missing
+        ones.
+
+        The index only tells which chunks this instance uploaded; if the blob store lost some of them since (e.g. it
+        was emptied or replaced), a backup would reference chunks that do not exist. If any sampled blob is missing,
+        the index is dropped, so that every chunk of the next backup is uploaded again.
+        """
+        with self.lock:
+            blob_names = sorted(set(self.blob_name(address, pack_id) for address, pack_id in self.known.items()))
+        sample = random.sample(blob_names, min(samples, len(blob_names)))
+        missing = sum(1 for blob_name in sample if not self.blobstore.has_file(blob_name))
+        if missing:
+            with self.lock:
+                self.known = {}
+                self._write_index()
+        return missing
+
+    def keep_recipe(self, backup_guid, recipe_path):
+        """Keeps a copy of the backup's recipe, which tells the chunks it references to `collect_garbage`."""
+        if self.recipes_directory:
+            path = os.path.join(self.recipes_directory, '{}.json.gz'.format(backup_guid))
+            shutil.copyfile(recipe_path, path + '.new')
+            os.replace(path + '.new', path)
+
+    def collect_garbage(self, is_live, workers=1):
+        """Removes the chunks that no live backup references anymore; returns the number of chunks removed.
+
+        A backup is live as long as `is_live` holds for its guid, i.e. its metadata can still be downloaded; the recipe
+        of a backup that was not live `GC_GRACE_CHECKS` times in a row is dropped. The chunks referenced by the
+        remaining recipes, and the ones uploaded before recipes were kept, are marked. A pack is removed from the blob
+        store once none of its chunks is marked, a chunk of its own once it is not marked; their chunks are removed
+        from the index as well.
+        """
+        if not self.recipes_directory:
+            return 0
+        misses_path = os.path.join(self.recipes_directory, 'misses.json')
+        misses = {}
+        if os.path.exists(misses_path):
+            with open(misses_path) as f:
+                misses = json.load(f)
+        marked = set(self.retained)
+        for path in glob.glob(os.path.join(self.recipes_directory, '*.json.gz')):
+            backup_guid = os.path.basename(path)[:-len('.json.gz')]
+            if is_live(backup_guid):
+                misses.pop(backup_guid, None)
+            else:
+                misses[backup_guid] = misses.get(backup_guid, 0) + 1
+                if misses[backup_guid] >= GC_GRACE_CHECKS:
+                    os.remove(path)
+                    del misses[backup_guid]
+                    continue
+            with gzip.open(path, 'rt', encoding='utf-8') as recipe:
+                marked.update(json.loads(line)[0] for line in recipe)
+        with open(misses_path + '.new', 'w') as f:
+            f.write(json.dumps(misses))
+        os.replace(misses_path + '.new', misses_path)
+
+        with self.lock:
+            marked_packs = set(self.known.get(address) for address in marked)
+            garbage = collections.defaultdict(list)
+            for address, pack_id in self.known.items():
+                if address not in marked and (pack_id is None or pack_id not in marked_packs):
+                    garbage[self.blob_name(address, pack_id)].append(address)
+
+        def remove(blob_name):
+            if not self.blobstore.remove_file(blob_name):
+                raise StreamingError('Could not remove the blob {}.'.format(blob_name))
+            with self.lock:
+                for address in garbage[blob_name]:
+                    del self.known[address]
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                list(executor.map(remove, list(garbage)))
+        finally:
+            with self.lock:
+                self._write_index()
+        return sum(len(addresses) for addresses in garbage.values())
+
+    def _decrypt(self, blob_name):
+        path = self.blobstore.spool_file('.chunk')
+        try:
+            if not self.blobstore.download_file(blob_name, path):
+                raise StreamingError('Could not download the blob {}.'.format(blob_name))
+            pipeline = Pipeline(self.key)
+            passphrase_fd = pipeline.passphrase_pipe()
+            process = pipeline.spawn(gpg_command(passphrase_fd, '--decrypt', path), pass_fds=(passphrase_fd,))
+            decrypted, _ = process.communicate()
+            pipeline.wait()
+        finally:
+            os.remove(path)
+        return decrypted
+
+    def _load_pack(self, pack_id):
+        with self.lock:
+            if pack_id in self.cache:
+                self.cache.move_to_end(pack_id)
+                return self.cache[pack_id]
+            loading = self.loading.setdefault(pack_id, threading.Lock())
+        with loading:
+            with self.lock:
+                if pack_id in self.cache:
+                    return self.cache[pack_id]
+            decrypted = memoryview(self._decrypt(self.blob_name(None, pack_id)))
+            records = {}
+            position = 0
+            while position < len(decrypted):
+                address, size = PACK_RECORD.unpack_from(decrypted, position)
+                position += PACK_RECORD.size
+                records[address.hex()] = decrypted[position:position + size]
+                position += size
+            with self.lock:
+                self.cache[pack_id] = records
+                self.loading.pop(pack_id, None)
+                while len(self.cache) > self.cache_packs:
+                    self.cache.popitem(last=False)
+        return records
+
+    def load(self, address, pack_id=None):
+        if pack_id:
+            compressed = self._load_pack(pack_id).get(address)
+            if compressed is None:
+                raise StreamingError('The chunk {} is not in the pack {}.'.format(address, pack_id))
+        else:
+            compressed = self._decrypt(self.blob_name(address))
+        data = zlib.decompress(compressed)
+        if not hmac.compare_digest(self.address(data), address):
+            raise StreamingError('The content of the chunk {} does not match its address.'.format(address))
+        return data
+
+
+def ordered_map(function, items, workers):
+    """Like `executor.map`, but never runs more than twice as many items ahead as there are workers."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def dedup_directory_to_blobstore(blobstore, store, directory, passphrase, backup_guid, workers, throttle=None):
+    """Stores the tar stream of the directory as chunks and uploads the recipe to the backup's folder.
+
+    Returns the metadata of the backup, with the SHA-256 digest of the whole tar stream (the chunks are verified by
+    their addresses already). With a `throttle`, the tar stream is read at its pace.
+    """
+    recipe_path = blobstore.spool_file('.json.gz')
+    summary = collections.Counter()
+    digest = hashlib.sha256()
+    try:
+        with gzip.open(recipe_path, 'wt', encoding='utf-8') as recipe:
+            pipeline = Pipeline(passphrase)
+            tar = pipeline.spawn_archiver(directory)
+            try:
+                def store_chunk(data):
+                    return store.store(data) + (len(data),)
+
+                def hashed(chunks):
+                    for data in chunks:
+                        digest.update(data)
+                        progress.advance()
+                        yield data
+
+                stream = throttle.reader(tar.stdout) if throttle else tar.stdout
+                for address, pack_id, uploaded, size in ordered_map(store_chunk, hashed(chunk_stream(stream)),
+                                                                    workers):
+                    recipe.write(json.dumps([address, size, pack_id]) + '\n')
+                    summary['chunks'] += 1
+                    summary['size'] += size
+                    summary['uploadedChunks'] += 1 if uploaded else 0
+                    summary['uploadedBytes'] += uploaded
+            except Exception:
+                pipeline.kill()
+                raise
+            tar.stdout.close()
+            pipeline.wait({'tar': (1,)})
+            store.flush()
+        if not blobstore.upload_file(recipe_path, '{}/{}'.format(backup_guid, RECIPE_NAME)):
+            raise StreamingError('Could not upload the recipe of backup {}.'.format(backup_guid))
+        store.keep_recipe(backup_guid, recipe_path)
+    finally:
+        os.remove(recipe_path)
+    return dict(summary, recipe=RECIPE_NAME, sha256=digest.hexdigest(), fileCount=pipeline.entries,
+                chunkKey=encrypt_text(store.key, passphrase), chunkKeyId=store.key_id)
+
+
+def load_chunks(blobstore, backup_guid, metadata, passphrase, workers):
+    """Yields the chunks of the backup's recipe in order, fetched concurrently.
+
+    The digest of the whole stream is checked before the generator ends, i.e. before the consumer sees the end of it.
+    """
+    store = ChunkStore(blobstore, decrypt_text(metadata['chunkKey'], passphrase), cache_packs=workers + 1)
+    recipe_path = blobstore.spool_file('.json.gz')
+    digest = hashlib.sha256()
+    try:
+        if not blobstore.download_file('{}/{}'.format(backup_guid, metadata['recipe']), recipe_path):
+            raise StreamingError('Could not download the recipe of backup {}.'.format(backup_guid))
+        with gzip.open(recipe_path, 'rt', encoding='utf-8') as recipe:
+            # +-> Recipes of backups taken before packs were introduced have no pack in their lines
+            chunks = (json.loads(line) for line in recipe)
+            for data in ordered_map(lambda chunk: store.load(chunk[0], *chunk[2:]), chunks, workers):
+                digest.update(data)
+                progress.advance(len(data))
+                yield data
+        check_digest('the tar stream of backup {}'.format(backup_guid), metadata.get('sha256'), digest.hexdigest())
+    finally:
+        os.remove(recipe_path)
+
+
+def restore_dedup_backup(blobstore, backup_guid, metadata, passphrase, directory, workers):
+    """Fetches the chunks of the recipe concurrently and extracts them in order into the directory."""
+    pipeline = Pipeline(passphrase)
+    tar = pipeline.spawn(['tar', '-xf', '-', '-C', directory], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    try:
+        for data in load_chunks(blobstore, backup_guid, metadata, passphrase, workers):
+            tar.stdin.write(data)
+        tar.stdin.close()
+    except Exception:
+        pipeline.kill()
+        raise
+    pipeline.wait()
+
+
+def verify_dedup_backup(blobstore, backup_guid, metadata, passphrase, workers):
+    """Fetches and checks every chunk of the recipe and the digest of the whole stream; returns its size."""
+    return sum(len(data) for data in load_chunks(blobstore, backup_guid, metadata, passphrase, workers))
@@ -0,0 +1,135 @@
+import collections
+import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import progress
+from manifest import TYPE_DIRECTORY, TYPE_FILE, TYPE_SYMLINK, compute_digest, scan_directory
+
+TEMPORARY_PREFIX = '.deltasync-'
+
+
+class DeltaSync:
+    """Makes the target directory an exact copy of the source directory by copying only what differs.
+
+    Both trees are walked in manifest order and merged. Files of equal size and mtime are taken as unchanged; if only
+    the mtime differs, the contents are compared by digest. Changed files are copied by a pool of threads, entries
+    that only exist in the target are deleted, and mode, ownership and mtime are taken over from the source for all
+    entries. Copies are written next to their target and renamed over it, so no file is ever left half-written.
+    """
+
+    def __init__(self, source, target, workers):
+        self.source = source
+        self.target = target
+        self.workers = workers
+        self.preserve_owner = os.geteuid() == 0
+        self.lock = threading.Lock()
+        self.summary = collections.Counter()
+
+    def run(self):
+        directories = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = collections.deque()
+            for source_entry, target_entry in self._merge():
+                if source_entry is None:
+                    self._remove(target_entry)
+                    continue
+                if target_entry is not None and target_entry.type != source_entry.type:
+                    self._remove(target_entry)
+                    target_entry = None
+                if source_entry.type == TYPE_DIRECTORY:
+                    if target_entry is None:
+                        os.mkdir(os.path.join(self.target, source_entry.path))
+                    directories.append(source_entry.path)
+                    continue
+                futures.append(executor.submit(self._sync_entry, source_entry, target_entry))
+                # +-> Collect finished work regularly, so errors surface early and the queue stays bounded
+                while futures and (futures[0].done() or len(futures) > 1024 * self.workers):
+                    futures.popleft().result()
+            while futures:
+                futures.popleft().result()
+        # +-> Directory attributes last, from the bottom up, as syncing their contents changes their mtime
+        for path in reversed(directories):
+            self._copy_attributes(os.path.join(self.source, path), os.path.join(self.target, path))
+        self._copy_attributes(self.source, self.target)
+        return dict(self.summary)
+
+    def _merge(self):
+        sources = scan_directory(self.source)
+        # +-> A directory of the target is listed before anything is copied into it, so temporary files of this run are
+        #     never seen here, only leftovers of an aborted run, which are removed like every other extraneous entry
+        targets = scan_directory(self.target)
+        source_entry, target_entry = next(sources, None), next(targets, None)
+        while source_entry is not None or target_entry is not None:
+            if target_entry is None or (source_entry is not None and source_entry.key() < target_entry.key()):
+                yield source_entry, None
+                source_entry = next(sources, None)
+            elif source_entry is None or target_entry.key() < source_entry.key():
+                yield None, target_entry
+                target_entry = next(targets, None)
+            else:
+                yield source_entry, target_entry
+                source_entry, target_entry = next(sources, None), next(targets, None)
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.summary[key] += value
+
+    def _remove(self, entry):
+        path = os.path.join(self.target, entry.path)
+        if entry.type == TYPE_DIRECTORY:
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        self._count('deleted')
+
+    def _sync_entry(self, source_entry, target_entry):
+        source_path = os.path.join(self.source, source_entry.path)
+        target_path = os.path.join(self.target, source_entry.path)
+        if source_entry.type == TYPE_SYMLINK:
+            if target_entry is None or os.readlink(source_path) != os.readlink(target_path):
+                temporary_path = self._temporary_path(target_path)
+                os.symlink(os.readlink(source_path), temporary_path)
+                os.replace(temporary_path, target_path)
+                self._count('copied')
+            else:
+                self._count('unchanged')
+        elif source_entry.type == TYPE_FILE:
+            if target_entry is None or not self._same_content(source_entry, target_entry):
+                temporary_path = self._temporary_path(target_path)
+                shutil.copyfile(source_path, temporary_path)
+                os.replace(temporary_path, target_path)
+                self._count('copied')
+                self._count('copiedBytes', source_entry.size)
+                progress.advance(source_entry.size)
+            else:
+                self._count('unchanged')
+        self._copy_attributes(source_path, target_path)
+        progress.advance()
+
+    def _same_content(self, source_entry, target_entry):
+        if source_entry.size != target_entry.size:
+            return False
+        if source_entry.mtime == target_entry.mtime:
+            return True
+        self._count('compared')
+        return compute_digest(self.source, source_entry) == compute_digest(self.target, target_entry)
+
+    def _temporary_path(self, path):
+        # +-> A thread syncs one entry at a time, so its id makes the name unique
+        return os.path.join(os.path.dirname(path), '{}{}'.format(TEMPORARY_PREFIX, threading.get_ident()))
+
+    def _copy_attributes(self, source_path, target_path):
+        info = os.lstat(source_path)
+        if self.preserve_owner:
+            os.lchown(target_path, info.st_uid, info.st_gid)
+        if not stat.S_ISLNK(info.st_mode):
+            os.chmod(target_path, stat.S_IMODE(info.st_mode))
+        os.utime(target_path, ns=(info.st_atime_ns, info.st_mtime_ns), follow_symlinks=False)
+
+
+def sync_directories(source, target, workers):
+    """Syncs the target directory with the source directory; returns counters of what was copied and deleted."""
+    return DeltaSync(source, target, workers).run()
@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+
+import progress
+from manifest import ManifestWriter, TYPE_FILE, compare, read_manifest, scan_directory
+from streaming import decrypt_file, decrypt_text, encrypt_file, encrypt_text, stream_blobstore_to_directory, \
+    stream_directory_to_blobstore, verify_streamed_archive
+
+MANIFEST_NAME = 'blueprint-manifest.json.gz.gpg'
+TOMBSTONES_NAME = 'blueprint-tombstones.json.gz.gpg'
+
+LOCAL_STATE_NAME = 'incremental.json'
+LOCAL_MANIFEST_NAME = 'manifest.json.gz'
+
+
+class IncrementalError(Exception):
+    pass
+
+
+class IncrementalBackup:
+    """File-level incremental backup of a directory.
+
+    Every backup uploads a manifest of the whole directory (path, type, size, mtime and SHA-256 per entry), an archive
+    with the entries that are new or changed compared to the parent backup and tombstones for the deleted ones. The
+    manifest of the last backup and its secret are kept in the state directory on this instance; if they are missing,
+    the last backup is no longer in the blob store or the chain has reached its maximum length, a full backup (level 0)
+    is taken instead.
+
+    Secrets are generated per backup, hence every backup keeps the secret of its parent encrypted with its own one.
+    """
+
+    def __init__(self, blobstore, directory, state_directory, max_chain_length, throttle=None):
+        self.blobstore = blobstore
+        self.throttle = throttle
+        self.directory = directory
+        self.state_directory = state_directory
+        self.max_chain_length = max_chain_length
+        self.state_path = os.path.join(state_directory, LOCAL_STATE_NAME)
+        self.manifest_path = os.path.join(state_directory, LOCAL_MANIFEST_NAME)
+        self.pending = None
+        os.makedirs(state_directory, mode=0o700, exist_ok=True)
+
+    def load_parent(self):
+        if not os.path.exists(self.state_path) or not os.path.exists(self.manifest_path):
+            return None
+        with open(self.state_path) as f:
+            parent = json.load(f)
+        if parent['level'] + 1 >= self.max_chain_length:
+            return None
+        # +-> A backup whose parent was deleted could not be restored
+        if not self.blobstore.has_file('{}/{}'.format(parent['backup_guid'], MANIFEST_NAME)):
+            return None
+        return parent
+
+    def run(self, backup_guid, secret, archive_name, part_size, codec=None, journal=None, parent=None, directory=None):
+        """Backs up the changes since the parent (see `load_parent`), or everything if there is none.
+
+        The files are read from `directory` if given, e.g. the mount of a snapshot of the directory; the manifest is
+        the same as if they were read from the directory itself.
+        """
+        directory = directory or self.directory
+        manifest_path = self.manifest_path + '.' + backup_guid
+        tombstones_path = self.blobstore.spool_file('.json.gz')
+        delta_path = self.blobstore.spool_file('.list')
+        changed = 0
+        changed_bytes = 0
+        try:
+            with ManifestWriter(manifest_path) as manifest, ManifestWriter(tombstones_path) as tombstones, \
+                    open(delta_path, 'wb') as delta:
+                previous = read_manifest(self.manifest_path) if parent else []
+                for status, entry in compare(previous, scan_directory(directory), directory):
+                    if status == 'deleted':
+                        tombstones.write(entry)
+                        continue
+                    manifest.write(entry)
+                    if status != 'unchanged':
+                        delta.write(os.fsencode(entry.path) + b'\0')
+                        changed += 1
+                        changed_bytes += entry.size if entry.type == TYPE_FILE else 0
+
+            progress.expect(changed_bytes)
+            archive = stream_directory_to_blobstore(self.blobstore, directory, secret,
+                                                    '{}/{}'.format(backup_guid, archive_name), part_size,
+                                                    files_from=delta_path, codec=codec, throttle=self.throttle,
+                                                    journal=journal, resumable=True)
+            self._upload_encrypted(manifest_path, '{}/{}'.format(backup_guid, MANIFEST_NAME), secret)
+            self._upload_encrypted(tombstones_path, '{}/{}'.format(backup_guid, TOMBSTONES_NAME), secret)
+        except Exception:
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            raise
+        finally:
+            os.remove(tombstones_path)
+            os.remove(delta_path)
+
+        level = parent['level'] + 1 if parent else 0
+        self.pending = (manifest_path, {'backup_guid': backup_guid, 'secret': secret, 'level': level})
+        return dict(archive,
+                    format='incremental',
+                    level=level,
+                    parent=parent['backup_guid'] if parent else None,
+                    parentSecret=encrypt_text(parent['secret'], secret) if parent else None,
+                    files=manifest.count,
+                    changed=changed,
+                    deleted=tombstones.count)
+
+    def commit(self):
+        """Makes the backup created by `run` the parent of the next one; to be called once its metadata is stored."""
+        manifest_path, state = self.pending
+        os.replace(manifest_path, self.manifest_path)
+        descriptor = os.open(self.state_path + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as f:
+            f.write(json.dumps(state))
+        os.replace(self.state_path + '.new', self.state_path)
+
+    def _upload_encrypted(self, path, blob_name, secret):
+        encrypted_path = self.blobstore.spool_file('.gpg')
+        try:
+            encrypt_file(path, encrypted_path, secret)
+            if not self.blobstore.upload_file(encrypted_path, blob_name):
+                raise IncrementalError('Could not upload {}.'.format(blob_name))
+        finally:
+            os.remove(encrypted_path)
+
+
+def resolve_chain(blobstore, backup_guid, metadata, secret, metadata_name):
+    """Returns `(backup_guid, metadata, secret)` of every backup in the chain, starting with the full backup."""
+    chain = [(backup_guid, metadata, secret)]
+    while metadata.get('parent'):
+        parent_guid = metadata['parent']
+        parent_metadata = blobstore.download_json('{}/{}'.format(parent_guid, metadata_name))
+        if not parent_metadata:
+            raise IncrementalError('Could not find the parent backup {} of backup {}.'.format(parent_guid, backup_guid))
+        secret = decrypt_text(metadata['parentSecret'], secret)
+        backup_guid, metadata = parent_guid, parent_metadata
+        chain.append((backup_guid, metadata, secret))
+    return list(reversed(chain))
+
+
+def restore_incremental_backup(blobstore, backup_guid, metadata, secret, directory, metadata_name):
+    """Rebuilds the state of the backup by applying every backup of its chain to the (empty) directory in order.
+
+    The tombstones of a backup are applied before its archive is extracted, as they also remove the entries that were
+    replaced by an entry of another type (see `manifest.compare`).
+    """
+    for guid, chain_metadata, chain_secret in resolve_chain(blobstore, backup_guid, metadata, secret, metadata_name):
+        _apply_tombstones(blobstore, guid, chain_secret, directory)
+        stream_blobstore_to_directory(blobstore, guid, chain_metadata, directory, chain_secret)
+
+
+def verify_incremental_backup(blobstore, backup_guid, metadata, secret, metadata_name):
+    """Checks the digests of the archives of every backup in the chain; returns the number of bytes checked."""
+    return sum(verify_streamed_archive(blobstore, guid, chain_metadata)
+               for guid, chain_metadata, _ in resolve_chain(blobstore, backup_guid, metadata, secret, metadata_name))
+
+
+def _apply_tombstones(blobstore, backup_guid, secret, directory):
+    encrypted_path = blobstore.spool_file('.gpg')
+    tombstones_path = blobstore.spool_file('.json.gz')
+    try:
+        if not blobstore.download_file('{}/{}'.format(backup_guid, TOMBSTONES_NAME), encrypted_path):
+            raise IncrementalError('Could not download the tombstones of backup {}.'.format(backup_guid))
+        decrypt_file(encrypted_path, tombstones_path, secret)
+        root = os.path.realpath(directory)
+        for entry in read_manifest(tombstones_path):
+            path = os.path.join(root, entry.path)
+            path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+            if not path.startswith(root + os.sep):
+                raise IncrementalError('Refusing to delete {} outside of {}.'.format(entry.path, directory))
+            # +-> The entry is removed as what it is now; a directory of an earlier tombstone may be gone already
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+    finally:
+        os.remove(encrypted_path)
+        os.remove(tombstones_path)
@@ -0,0 +1,310 @@
+import glob
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+
+class Journal:
+    """Persistent record of the resources a run has created and the steps it has completed.
+
+    The journal is kept in the state directory per operation and backup guid and rewritten atomically after every
+    change. It is removed when the run succeeds; a retry of a failed or killed run with the same backup guid finds it
+    and picks up where the previous attempt stopped.
+    """
+
+    def __init__(self, state_directory, operation, backup_guid):
+        os.makedirs(state_directory, mode=0o700, exist_ok=True)
+        self.state_directory = state_directory
+        self.operation = operation
+        self.path = os.path.join(state_directory, 'journal-{}-{}.json'.format(operation, backup_guid))
+        self.lock = threading.RLock()
+        self.resumed = os.path.exists(self.path)
+        self.document = {'resources': [], 'mounts': {}, 'formatted': [], 'files': {}, 'parts': {}}
+        if self.resumed:
+            with open(self.path) as f:
+                self.document.update(json.load(f))
+            # +-> Resources of the earlier attempt are up for reuse until a call of this run claims them
+            for resource in self.document['resources']:
+                resource['claimed'] = False
+
+    def stale_journals(self):
+        """Returns the paths of the journals of earlier runs of the operation for other backup guids."""
+        pattern = os.path.join(self.state_directory, 'journal-{}-*.json'.format(self.operation))
+        return [path for path in glob.glob(pattern) if path != self.path]
+
+    def save(self):
+        with self.lock:
+            descriptor = os.open(self.path + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w') as f:
+                f.write(json.dumps(self.document))
+            os.replace(self.path + '.new', self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # +-> Resources (snapshots, volumes, attachments)
+
+    def add_resource(self, kind, arguments, **attributes):
+        with self.lock:
+            self.document['resources'].append(dict(attributes, kind=kind, arguments=list(arguments), claimed=True))
+            self.save()
+
+    def claim(self, resource):
+        with self.lock:
+            resource['claimed'] = True
+            self.save()
+
+    def find_resource(self, kind, arguments=None, **attributes):
+        with self.lock:
+            for resource in self.document['resources']:
+                if resource['kind'] == kind and (arguments is None or resource['arguments'] == list(arguments)) and \
+                        all(resource.get(key) == value for key, value in attributes.items()):
+                    return resource
+        return None
+
+    def remove_resource(self, kind, **attributes):
+        with self.lock:
+            resource = self.find_resource(kind, **attributes)
+            if resource:
+                self.document['resources'].remove(resource)
+                self.save()
+
+    def add_formatted(self, volume_id):
+        with self.lock:
+            self.document['formatted'].append(volume_id)
+            self.save()
+
+    # +-> Mounts
+
+    def add_mount(self, device, directory):
+        with self.lock:
+            self.document['mounts'][device] = directory
+            self.save()
+
+    def remove_mount(self, device):
+        with self.lock:
+            if self.document['mounts'].pop(device, None) is not None:
+                self.save()
+
+    # +-> Files that were completely written, uploaded or downloaded
+
+    def add_file(self, key, path, summary=None):
+        """Records the file under the key, with an optional summary of it (e.g. its digest) to be reused with it."""
+        info = os.stat(path)
+        with self.lock:
+            self.document['files'][key] = [path, info.st_size, info.st_mtime_ns, summary]
+            self.save()
+
+    def has_file(self, key, path):
+        """Whether the file was recorded under the key and is still there, unmodified."""
+        with self.lock:
+            recorded = self.document['files'].get(key)
+        if not recorded or recorded[0] != path or not os.path.exists(path):
+            return False
+        info = os.stat(path)
+        return [info.st_size, info.st_mtime_ns] == recorded[1:3]
+
+    def file_summary(self, key):
+        """The summary recorded with the file under the key, if the file is still there unmodified."""
+        with self.lock:
+            recorded = self.document['files'].get(key)
+        if not recorded or not self.has_file(key, recorded[0]):
+            return None
+        return recorded[3] if len(recorded) > 3 else None
+
+    # +-> Parts of streamed archives that were completely uploaded
+
+    def add_part(self, blob_name, offset, sha256, part):
+        """Records the uploaded part with the offset and the digest of the slice of the stream it was encrypted from."""
+        with self.lock:
+            self.document['parts'][blob_name] = [offset, sha256, part]
+            self.save()
+
+    def find_part(self, blob_name, offset, sha256):
+        """The description of the part if it was uploaded from the same slice of the stream before, otherwise None."""
+        with self.lock:
+            recorded = self.document['parts'].get(blob_name)
+        if not recorded or recorded[:2] != [offset, sha256]:
+            return None
+        return recorded[2]
+
+
+class JournalingClient:
+    """Forwards everything to the IaaS client, records what is created in the journal and reuses it on a retry.
+
+    A scratch volume of an earlier attempt is reused for a call with the same arguments if it is still attached to the
+    instance; the snapshot it was created from is then reused as well. Mounts of an earlier attempt are released
+    first, as the process that made them is gone. Tarballs, uploads and downloads are skipped if the journal has them
+    and the local file has not changed since.
+
+    Volumes are provisioned from several threads at once; picking a resource of the earlier attempt and claiming it
+    happen under the lock of the journal, which also guards the volumes and devices this client keeps track of.
+    """
+
+    def __init__(self, iaas_client, journal):
+        self._iaas_client = iaas_client
+        self._journal = journal
+        self._devices = {}
+        self._reused_volumes = set()
+
+    def __getattr__(self, name):
+        return getattr(self._iaas_client, name)
+
+    def recover(self):
+        """Releases the mounts left behind by an earlier attempt; returns whether there was an earlier attempt."""
+        for device in list(self._journal.document['mounts']):
+            self._iaas_client.unmount_device(device)
+            self._journal.remove_mount(device)
+        return self._journal.resumed
+
+    def release_stale_resources(self):
+        """Unmounts, detaches and deletes the scratch volumes recorded by runs that never finished.
+
+        Snapshots are only logged, on some landscapes they are the backup itself.
+        """
+        for path in self._journal.stale_journals():
+            with open(path) as f:
+                document = json.load(f)
+            self._iaas_client.logger.warning('Releasing the resources of the unfinished run {}.'.format(path))
+            for device in document['mounts']:
+                self._iaas_client.unmount_device(device)
+            for resource in document['resources']:
+                if resource['kind'] == 'attachment':
+                    self._iaas_client.delete_attachment(resource['volume_id'], resource['arguments'][1])
+            for resource in document['resources']:
+                if resource['kind'] == 'volume':
+                    self._iaas_client.delete_volume(resource['id'])
+                elif resource['kind'] == 'snapshot':
+                    self._iaas_client.logger.warning('The snapshot {} of the unfinished run may be orphaned.'
+                                                     .format(resource['id']))
+            os.remove(path)
+
+    def _attached(self, volume):
+        return volume is not None and bool(self._iaas_client.get_mountpoint(volume['id']))
+
+    def create_snapshot(self, volume_id):
+        with self._journal.lock:
+            for volume in self._journal.document['resources']:
+                if volume['kind'] == 'volume' and not volume['claimed'] and volume['arguments'][1:] and \
+                        self._attached(volume):
+                    snapshot = self._journal.find_resource('snapshot', [volume_id], id=volume['arguments'][1],
+                                                           claimed=False)
+                    if snapshot:
+                        self._iaas_client.logger.info('Reusing the snapshot {}.'.format(snapshot['id']))
+                        self._journal.claim(snapshot)
+                        return SimpleNamespace(id=snapshot['id'], size=snapshot['size'])
+        snapshot = self._iaas_client.create_snapshot(volume_id)
+        if snapshot:
+            self._journal.add_resource('snapshot', [volume_id], id=snapshot.id, size=snapshot.size)
+        return snapshot
+
+    def copy_snapshot(self, snapshot_id):
+        snapshot = self._iaas_client.copy_snapshot(snapshot_id)
+        if snapshot:
+            self._journal.add_resource('snapshot', [snapshot_id], id=snapshot.id, size=snapshot.size)
+        return snapshot
+
+    def delete_snapshot(self, snapshot_id):
+        result = self._iaas_client.delete_snapshot(snapshot_id)
+        if result:
+            self._journal.remove_resource('snapshot', id=snapshot_id)
+        return result
+
+    def create_volume(self, size, snapshot_id=None):
+        arguments = [size, snapshot_id] if snapshot_id else [size]
+        with self._journal.lock:
+            volume = self._journal.find_resource('volume', arguments, claimed=False)
+            if volume is not None:
+                if self._attached(volume):
+                    self._iaas_client.logger.info('Reusing the volume {}.'.format(volume['id']))
+                    self._journal.claim(volume)
+                    self._reused_volumes.add(volume['id'])
+                    return SimpleNamespace(id=volume['id'], size=volume['size'])
+                self._journal.remove_resource('volume', id=volume['id'])
+                self._journal.remove_resource('attachment', volume_id=volume['id'])
+        volume = self._iaas_client.create_volume(*arguments)
+        if volume:
+            self._journal.add_resource('volume', arguments, id=volume.id, size=volume.size)
+        return volume
+
+    def delete_volume(self, volume_id):
+        result = self._iaas_client.delete_volume(volume_id)
+        if result:
+            self._journal.remove_resource('volume', id=volume_id)
+        return result
+
+    def create_attachment(self, volume_id, instance_id):
+        with self._journal.lock:
+            attachment = self._journal.find_resource('attachment', [volume_id, instance_id], claimed=False)
+            if attachment and volume_id in self._reused_volumes:
+                self._journal.claim(attachment)
+                return SimpleNamespace(volume_id=volume_id, instance_id=instance_id)
+        attachment = self._iaas_client.create_attachment(volume_id, instance_id)
+        if attachment:
+            self._journal.add_resource('attachment', [volume_id, instance_id], volume_id=attachment.volume_id)
+        return attachment
+
+    def delete_attachment(self, volume_id, instance_id):
+        result = self._iaas_client.delete_attachment(volume_id, instance_id)
+        if result:
+            self._journal.remove_resource('attachment', volume_id=volume_id)
+        return result
+
+    def get_mountpoint(self, volume_id, *partition):
+        mountpoint = self._iaas_client.get_mountpoint(volume_id, *partition)
+        if mountpoint:
+            with self._journal.lock:
+                self._devices[mountpoint] = volume_id
+        return mountpoint
+
+    def format_device(self, device):
+        # +-> A reused volume keeps its contents, e.g. a tarball that was created but not yet uploaded
+        with self._journal.lock:
+            volume_id = self._devices.get(device)
+            reused = volume_id in self._reused_volumes and volume_id in self._journal.document['formatted']
+        if reused:
+            return True
+        result = self._iaas_client.format_device(device)
+        if result and volume_id:
+            self._journal.add_formatted(volume_id)
+        return result
+
+    def mount_device(self, device, directory):
+        result = self._iaas_client.mount_device(device, directory)
+        if result:
+            self._journal.add_mount(device, directory)
+        return result
+
+    def unmount_device(self, device):
+        result = self._iaas_client.unmount_device(device)
+        if result:
+            self._journal.remove_mount(device)
+        return result
+
+    def create_and_encrypt_tarball_of_directory(self, directory, path):
+        if self._journal.has_file('tarball', path):
+            self._iaas_client.logger.info('Reusing the tarball {}.'.format(path))
+            return True
+        result = self._iaas_client.create_and_encrypt_tarball_of_directory(directory, path)
+        if result:
+            self._journal.add_file('tarball', path)
+        return result
+
+    def upload_to_blobstore(self, path, blob_name):
+        if self._journal.has_file('upload:{}'.format(blob_name), path):
+            self._iaas_client.logger.info('Skipping the upload of {}, it was uploaded before.'.format(blob_name))
+            return True
+        result = self._iaas_client.upload_to_blobstore(path, blob_name)
+        if result:
+            self._journal.add_file('upload:{}'.format(blob_name), path)
+        return result
+
+    def download_from_blobstore(self, blob_name, path):
+        if self._journal.has_file('download:{}'.format(blob_name), path):
+            return True
+        result = self._iaas_client.download_from_blobstore(blob_name, path)
+        if result:
+            self._journal.add_file('download:{}'.format(blob_name), path)
+        return result
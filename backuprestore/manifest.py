@@ -0,0 +1,142 @@
+import gzip
+import hashlib
+import json
+import os
+import stat
+from collections import namedtuple
+
+HASH_READ_SIZE = 1024 * 1024
+
+TYPE_FILE = 'f'
+TYPE_DIRECTORY = 'd'
+TYPE_SYMLINK = 'l'
+
+
+class Entry(namedtuple('Entry', ['path', 'type', 'size', 'mtime', 'digest'])):
+    """One line of a manifest; `path` is relative to the backed-up directory."""
+
+    def key(self):
+        return self.path.split('/')
+
+    def with_digest(self, digest):
+        return self._replace(digest=digest)
+
+
+def scan_directory(directory):
+    """Yields the entries of the directory tree in manifest order without reading any file contents.
+
+    Siblings are visited in name order and directories are descended into right after their own entry, which yields
+    the entries ordered by their list of path components. Manifests written in this order can be compared with a single
+    merge pass, so neither side has to be loaded into memory.
+    """
+    stack = [iter(_sorted_scandir(directory, ''))]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        path, info = entry
+        if stat.S_ISDIR(info.st_mode):
+            yield Entry(path, TYPE_DIRECTORY, 0, 0, None)
+            stack.append(iter(_sorted_scandir(os.path.join(directory, path), path)))
+        elif stat.S_ISLNK(info.st_mode):
+            yield Entry(path, TYPE_SYMLINK, info.st_size, info.st_mtime_ns, None)
+        elif stat.S_ISREG(info.st_mode):
+            yield Entry(path, TYPE_FILE, info.st_size, info.st_mtime_ns, None)
+
+
+def _sorted_scandir(directory, prefix):
+    try:
+        with os.scandir(directory) as entries:
+            names = sorted(entry.name for entry in entries)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = prefix + '/' + name if prefix else name
+        try:
+            yield path, os.lstat(os.path.join(directory, name))
+        except FileNotFoundError:
+            continue
+
+
+def compute_digest(directory, entry):
+    full_path = os.path.join(directory, entry.path)
+    digest = hashlib.sha256()
+    if entry.type == TYPE_SYMLINK:
+        digest.update(os.fsencode(os.readlink(full_path)))
+    elif entry.type == TYPE_FILE:
+        with open(full_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_READ_SIZE), b''):
+                digest.update(chunk)
+    else:
+        return None
+    return digest.hexdigest()
+
+
+def read_manifest(path):
+    if not path or not os.path.exists(path):
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield Entry(*json.loads(line))
+
+
+class ManifestWriter:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = gzip.open(self.path, 'wt', encoding='utf-8')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+    def write(self, entry):
+        self.file.write(json.dumps(list(entry)) + '\n')
+        self.count += 1
+
+
+def compare(previous, current, directory):
+    """Merges the previous manifest with the current scan and yields `(status, entry)` pairs.
+
+    The status is one of `new`, `changed`, `unchanged` or `deleted`. Digests of unchanged entries are taken over from
+    the previous manifest, all others are computed; a file whose size or mtime changed but whose content did not is
+    reported as unchanged. An entry whose type changed (e.g. a directory replaced by a file) is reported as the deleted
+    previous entry followed by a new one. Entries that vanish while they are compared are treated as not being there.
+    """
+    previous = iter(previous)
+    before = next(previous, None)
+    for entry in current:
+        while before is not None and before.key() < entry.key():
+            yield 'deleted', before
+            before = next(previous, None)
+        if before is not None and before.key() == entry.key() and before.type != entry.type:
+            # +-> The previous entry has to be removed before the new one can be restored in its place
+            yield 'deleted', before
+            before = next(previous, None)
+        if before is not None and before.key() == entry.key():
+            if entry.type == TYPE_DIRECTORY or (before.size, before.mtime) == (entry.size, entry.mtime):
+                yield 'unchanged', entry.with_digest(before.digest)
+            else:
+                try:
+                    entry = entry.with_digest(compute_digest(directory, entry))
+                except FileNotFoundError:
+                    yield 'deleted', before
+                else:
+                    if before.digest == entry.digest:
+                        yield 'unchanged', entry
+                    else:
+                        yield 'changed', entry
+            before = next(previous, None)
+        else:
+            try:
+                entry = entry.with_digest(compute_digest(directory, entry))
+            except FileNotFoundError:
+                continue
+            yield 'new', entry
+    while before is not None:
+        yield 'deleted', before
+        before = next(previous, None)
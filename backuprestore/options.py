@@ -0,0 +1,76 @@
+import argparse
+import json
+import sys
+
+
+def parse_extended_options(operation_name):
+    """Parses the blueprint specific options and removes them from the command line.
+
+    The options are handed over by the agent like all other `--key=value` parameters, but the argument parser of the
+    backup & restore library does not know them, hence they have to be consumed before `parse_options` is called.
+    """
+    parser = argparse.ArgumentParser(prog=operation_name, add_help=False, allow_abbrev=False)
+    parser.add_argument('--archive_format', choices=['tarball', 'streaming', 'resumable', 'dedup', 'blocks'],
+                        default='tarball',
+                        help='resumable: streamed like streaming, but every part is encrypted on its own, so that the '
+                             'retry of a backup skips the parts uploaded before; only this agent can restore it')
+    parser.add_argument('--part_size', type=int, default=64,
+                        help='Size (in MiB) of the parts a streamed archive is uploaded in')
+    parser.add_argument('--block_size', type=int, default=16,
+                        help='Size (in MiB) of the files archived together in a block of the blocks format')
+    parser.add_argument('--compression', choices=['gzip', 'pgzip', 'zstd'], default='gzip')
+    parser.add_argument('--compression_level', type=int)
+    parser.add_argument('--compression_threads', type=int,
+                        help='Number of threads of the pgzip and zstd codecs, defaults to the number of CPUs')
+    parser.add_argument('--parallelism', type=int, default=4,
+                        help='Number of concurrent transfers to and from the blob store')
+    parser.add_argument('--tarball_parallelism', type=int, default=1,
+                        help='Number of concurrent transfers a tarball larger than a part is uploaded with as parts; '
+                             '1 uploads it as one blob, the only layout restores of earlier versions can read')
+    parser.add_argument('--restore_mode', choices=['in_place', 'swap', 'partial'], default='in_place',
+                        help='swap restores into a staging directory while the service keeps running, partial only '
+                             'restores the restore_paths of a backup in the blocks format')
+    parser.add_argument('--restore_paths', type=json.loads, default=[],
+                        help='JSON list of paths or glob patterns (relative to the files directory) to restore')
+    parser.add_argument('--max_chain_length', type=int, default=7,
+                        help='Number of incremental backups after which a full one is taken again')
+    parser.add_argument('--iaas_poll_interval', type=int,
+                        help='Seconds between the status polls of volumes and snapshots by the library')
+    parser.add_argument('--volume_pool_size', type=int, default=0,
+                        help='Number of idle scratch volumes kept attached for the next run, 0 disables the pool')
+    parser.add_argument('--volume_pool_idle', type=int, default=86400,
+                        help='Seconds after which an idle scratch volume of the pool is deleted by the next run')
+    parser.add_argument('--read_rate_limit', type=float,
+                        help='MiB/s the files are read with while they are archived by an online backup')
+    parser.add_argument('--upload_rate_limit', type=float,
+                        help='MiB/s the parts, chunks and manifests of an online backup are uploaded with')
+    parser.add_argument('--max_load', type=float,
+                        help='Load average per CPU above which an online backup pauses reading and uploading')
+    parser.add_argument('--max_disk_queue', type=float,
+                        help='Average requests in flight on the persistent disk above which an online backup pauses')
+    parser.add_argument('--nice', type=int, help='Niceness added to the processes of an online backup')
+    parser.add_argument('--io_class', choices=['best-effort', 'idle'],
+                        help='I/O scheduling class of the processes of an online backup')
+    parser.add_argument('--stall_timeout', type=int, default=600,
+                        help='Seconds without any data moved after which a transfer is reported as stalled, 0 disables')
+    parser.add_argument('--metrics_directory',
+                        help='Directory to write the timings of the operation to in the Prometheus text format')
+    options, remaining = parser.parse_known_args(sys.argv[1:])
+    sys.argv[1:] = remaining
+    return vars(options)
+
+
+def parse_batch_options():
+    """Parses the options of a batch of backups and removes them from the command line, like the options above."""
+    parser = argparse.ArgumentParser(prog='batch_backup', add_help=False, allow_abbrev=False)
+    parser.add_argument('--jobs', required=True,
+                        help='JSON file with a list of jobs, each with an instance_id, a backup_guid and a type')
+    parser.add_argument('--results_directory', required=True,
+                        help='Directory to write the result of every job to, as <backup_guid>.json')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of jobs that run at the same time')
+    parser.add_argument('--max_call_rate', type=float,
+                        help='Upper bound for the IaaS calls and the status polls of the library started per second '
+                             'by all jobs together')
+    options, remaining = parser.parse_known_args(sys.argv[1:])
+    sys.argv[1:] = remaining
+    return vars(options)
@@ -0,0 +1,243 @@
+import json
+import os
+import stat
+import threading
+import time
+
+# +-> The progress is written by a thread of its own at most every `WRITE_INTERVAL` seconds, the pipeline only counts
+WRITE_INTERVAL = 2.0
+# +-> Weight of the latest sample in the smoothed throughput
+SMOOTHING = 0.3
+
+
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def directory_size(directory):
+    """Sums up the sizes of the regular files below the directory, like tar counts them in its listing."""
+    size = 0
+    for parent, _, names in os.walk(directory):
+        for name in names:
+            try:
+                status = os.lstat(os.path.join(parent, name))
+            except OSError:
+                continue
+            if stat.S_ISREG(status.st_mode):
+                size += status.st_size
+    return size
+
+
+class ProgressReporter:
+    """Publishes the progress of the running step of an operation next to its last operation state.
+
+    The running step is the outermost step of the timings; the steps nested in it (e.g. the part uploads of a streamed
+    archive) are part of its progress. The pipeline counts the bytes of the step with `advance`, the files written by
+    the library are watched for their size instead; files written by nested steps (e.g. a part being downloaded) only
+    tell that data keeps moving. Every `WRITE_INTERVAL` seconds the step, the bytes done and
+    expected, the smoothed throughput and the estimated time left are written to `<operation>.progress.blue.json` and
+    `<operation>.progress.green.json` in turn, and `<operation>.progress.json` is atomically replaced by a symlink to
+    it, so that a reader never sees a partially written document. A step that moved data before (or expects some) and
+    moves nothing for `stall_timeout` seconds is reported as stalled.
+    """
+
+    def __init__(self, directory, operation, stall_timeout, logger):
+        self.directory = directory
+        self.operation = operation
+        self.stall_timeout = stall_timeout
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.active = []
+        self.files = {}
+        self.stalls = 0
+        self.generation = 0
+        self.color = 'blue'
+        self.failed = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self._reset(None)
+
+    def _path(self, color=None):
+        return os.path.join(self.directory, '{}.progress{}.json'.format(self.operation, '.' + color if color else ''))
+
+    def _reset(self, name, path=None):
+        now = time.monotonic()
+        self.generation += 1
+        self.step = name
+        self.watched = path
+        self.tracked = path is not None
+        self.done = 0
+        self.total = None
+        self.started = time.time()
+        self.active_at = now
+        self.sample = (now, 0)
+        self.throughput = None
+        self.stalled = False
+
+    def enter(self, name, path=None):
+        with self.lock:
+            self.active.append(name)
+            if len(self.active) == 1:
+                self._reset(name, path)
+            elif path:
+                self.files[path] = 0
+
+    def leave(self, name, path=None):
+        with self.lock:
+            self.files.pop(path, None)
+            if name not in self.active:
+                return
+            index = self.active.index(name)
+            del self.active[index]
+            if index == 0:
+                self._reset(self.active[0] if self.active else None)
+
+    def expect(self, total=None, directory=None):
+        with self.lock:
+            self.tracked = True
+            self.total = total
+            self.active_at = time.monotonic()
+            generation = self.generation
+        if directory:
+            # +-> Walking a large directory takes a while, the total is only known once the walk is done
+            threading.Thread(target=self._measure, args=(directory, generation), daemon=True).start()
+
+    def _measure(self, directory, generation):
+        total = directory_size(directory)
+        with self.lock:
+            if self.generation == generation:
+                self.total = total
+
+    def advance(self, size=0):
+        with self.lock:
+            self.done += size
+            self.tracked = True
+            self.active_at = time.monotonic()
+
+    def to_json(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.watched:
+                size = _file_size(self.watched)
+                if size != self.done:
+                    self.done = size
+                    self.active_at = now
+            for path, size in list(self.files.items()):
+                self.files[path] = _file_size(path)
+                if self.files[path] != size:
+                    self.active_at = now
+            elapsed = now - self.sample[0]
+            if self.tracked and elapsed > 0:
+                rate = (self.done - self.sample[1]) / elapsed
+                self.throughput = rate if self.throughput is None else \
+                    SMOOTHING * rate + (1 - SMOOTHING) * self.throughput
+            self.sample = (now, self.done)
+            idle = now - self.active_at
+            stalled = self.tracked and bool(self.stall_timeout) and idle > self.stall_timeout
+            if stalled and not self.stalled:
+                self.stalls += 1
+                self.logger.warning('The step {} of the {} moved no data for {} seconds.'
+                                    .format(self.step, self.operation, int(idle)))
+            elif self.stalled and not stalled:
+                self.logger.info('The step {} of the {} moves data again.'.format(self.step, self.operation))
+            self.stalled = stalled
+            eta = None
+            if self.total is not None and self.throughput and not stalled:
+                eta = int(max(self.total - self.done, 0) / self.throughput)
+            return {
+                'operation': self.operation,
+                'step': self.step,
+                'stepStartedAt': _timestamp(self.started),
+                'bytesDone': self.done,
+                'bytesTotal': self.total,
+                'throughput': int(self.throughput) if self.throughput is not None else None,
+                'eta': eta,
+                'stalled': stalled,
+                'idleSeconds': int(idle) if self.tracked else None,
+                'stalls': self.stalls,
+                'updatedAt': _timestamp(time.time())
+            }
+
+    def publish(self):
+        document = json.dumps(self.to_json())
+        self.color = 'green' if self.color == 'blue' else 'blue'
+        target = self._path(self.color)
+        link = self._path() + '.new'
+        try:
+            with open(target, 'w') as f:
+                f.write(document)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.basename(target), link)
+            os.replace(link, self._path())
+        except OSError as error:
+            if not self.failed:
+                self.logger.warning('Could not write the progress of the {}: {}'.format(self.operation, error))
+            self.failed = True
+
+    def _run(self):
+        self.publish()
+        while not self.stopped.wait(WRITE_INTERVAL):
+            self.publish()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        for path in (self._path(), self._path('blue'), self._path('green')):
+            if os.path.lexists(path):
+                os.remove(path)
+
+
+_reporter = None
+
+
+def start(operation, stall_timeout, logger):
+    """Starts reporting the progress of the operation; does nothing if the directory of the last operation state is
+    unknown.
+    """
+    global _reporter
+    directory = os.environ.get('SF_BACKUP_RESTORE_LAST_OPERATION_DIRECTORY')
+    if directory:
+        _reporter = ProgressReporter(directory, operation, stall_timeout, logger)
+        _reporter.start()
+
+
+def stop():
+    """Stops reporting and removes the progress, the last operation state tells how the operation ended."""
+    global _reporter
+    if _reporter:
+        _reporter.stop()
+        _reporter = None
+
+
+def enter(name, path=None):
+    """Called by the timings when a step starts; `path` names a file the step writes, its size is the bytes done."""
+    if _reporter:
+        _reporter.enter(name, path)
+
+
+def leave(name, path=None):
+    if _reporter:
+        _reporter.leave(name, path)
+
+
+def expect(total=None, directory=None):
+    """Sets the bytes the running step is going to move, or the directory whose files it is going to read."""
+    if _reporter:
+        _reporter.expect(total, directory)
+
+
+def advance(size=0):
+    """Counts bytes moved by the running step; called with 0, it only tells that data keeps moving."""
+    if _reporter:
+        _reporter.advance(size)
@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from volumepool import VolumePoolError, wipe_directory
+
+# +-> Upper bound for IaaS calls that are in flight at the same time
+MAX_WORKERS = 4
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+class VolumeChain:
+    """A scratch volume that has to be created, attached and located before it can be used.
+
+    The chains of different volumes do not depend on each other, so they can be provisioned concurrently.
+    """
+
+    pooled = False
+
+    def __init__(self, name, size, snapshot_id=None, partition=None):
+        self.name = name
+        self.size = size
+        self.snapshot_id = snapshot_id
+        self.partition = partition
+        self.volume = None
+        self.attachment = None
+        self.mountpoint = None
+
+    def provision(self, iaas_client, instance_id):
+        if self.snapshot_id:
+            self.volume = iaas_client.create_volume(self.size, self.snapshot_id)
+        else:
+            self.volume = iaas_client.create_volume(self.size)
+        if not self.volume:
+            raise ProvisioningError(
+                'Could not create the {} volume.'.format(self.name))
+
+        self.attachment = iaas_client.create_attachment(self.volume.id, instance_id)
+        if not self.attachment:
+            raise ProvisioningError('Could not attach the {} volume with id {} to instance with id {}.'
+                                    .format(self.name, self.volume.id, instance_id))
+
+        if self.partition:
+            self.mountpoint = iaas_client.get_mountpoint(self.volume.id, self.partition)
+        else:
+            self.mountpoint = iaas_client.get_mountpoint(self.volume.id)
+        if not self.mountpoint:
+            raise ProvisioningError('Could not determine the mountpoint for the {} volume (id: {}).'
+                                    .format(self.name, self.volume.id))
+        return self
+
+    def release(self, iaas_client, instance_id):
+        if self.attachment and not iaas_client.delete_attachment(self.attachment.volume_id, instance_id):
+            iaas_client.logger.error('Could not detach the {} volume with id {} from instance with id {}.'
+                                     .format(self.name, self.attachment.volume_id, instance_id))
+            return
+        if self.volume and not iaas_client.delete_volume(self.volume.id):
+            iaas_client.logger.error('Could not delete the {} volume with id {}.'
+                                     .format(self.name, self.volume.id))
+
+
+class PooledVolumeChain(VolumeChain):
+    """A scratch volume leased from the pool of warm volumes; it is already attached and formatted."""
+
+    pooled = True
+
+    def __init__(self, name, size, pool):
+        super().__init__(name, size)
+        self.pool = pool
+        self.lease = None
+
+    def provision(self, iaas_client, instance_id):
+        try:
+            self.lease = self.pool.lease(self.size)
+        except VolumePoolError as error:
+            raise ProvisioningError('Could not lease the {} volume: {}'.format(self.name, error))
+        self.volume = SimpleNamespace(id=self.lease.volume_id, size=self.lease.size)
+        self.attachment = SimpleNamespace(volume_id=self.lease.volume_id)
+        self.mountpoint = self.lease.mountpoint
+        return self
+
+    def release(self, iaas_client, instance_id):
+        if self.lease:
+            self.pool.give_back(self.lease)
+            self.lease = None
+
+
+def scratch_volume_chain(name, size, pool=None):
+    """Returns the chain of an empty scratch volume, leased from the pool if there is one."""
+    return PooledVolumeChain(name, size, pool) if pool else VolumeChain(name, size)
+
+
+def run_in_parallel(steps, max_workers=MAX_WORKERS):
+    """Runs the given callables concurrently and waits for all of them.
+
+    Every step either returns its result or raises a ProvisioningError. All steps are allowed to finish before the
+    first error is re-raised, so that no step is left running behind the back of the caller's cleanup.
+    """
+    if not steps:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(steps), max_workers)) as executor:
+        futures = [executor.submit(step) for step in steps]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+    return [future.result() for future in futures]
+
+
+def provision_volume_chains(iaas_client, instance_id, chains, max_workers=MAX_WORKERS):
+    """Provisions all volume chains concurrently.
+
+    If any chain fails, the resources that were already created by all chains are detached and deleted again before
+    the error is raised.
+    """
+    try:
+        return run_in_parallel([lambda chain=chain: chain.provision(iaas_client, instance_id) for chain in chains],
+                               max_workers)
+    except Exception:
+        iaas_client.logger.error('Provisioning of the volumes failed, releasing the volumes created so far.')
+        run_in_parallel([lambda chain=chain: chain.release(iaas_client, instance_id) for chain in chains],
+                        max_workers)
+        raise
+
+
+def reset_directory(iaas_client, directory):
+    if not iaas_client.delete_directory(directory):
+        raise ProvisioningError(
+            'Could not remove the following directory: {}.'.format(directory))
+    if not iaas_client.create_directory(directory):
+        raise ProvisioningError(
+            'Could not create the following directory: {}'.format(directory))
+
+
+def prepare_mount(iaas_client, device, directory, format_device=False):
+    """Resets the directory, optionally formats the device and mounts it to the directory."""
+    reset_directory(iaas_client, directory)
+    if format_device and not iaas_client.format_device(device):
+        raise ProvisioningError(
+            'Could not format the following device: {}'.format(device))
+    if not iaas_client.mount_device(device, directory):
+        raise ProvisioningError('Could not mount the device {} to the directory {}.'
+                                .format(device, directory))
+
+
+def mount_scratch_volume(iaas_client, chain, directory):
+    """Mounts an empty scratch volume to the directory; a pooled volume is wiped instead of formatted."""
+    prepare_mount(iaas_client, chain.mountpoint, directory, format_device=not chain.pooled)
+    if chain.pooled:
+        wipe_directory(directory)
+
+
+def release_scratch_volume(iaas_client, instance_id, chain):
+    """Detaches and deletes an unmounted scratch volume, or gives it back to the pool."""
+    if chain.pooled:
+        chain.release(iaas_client, instance_id)
+        return
+    if not iaas_client.delete_attachment(chain.attachment.volume_id, instance_id):
+        raise ProvisioningError('Could not detach the {} volume with id {} from instance with id {}.'
+                                .format(chain.name, chain.attachment.volume_id, instance_id))
+    if not iaas_client.delete_volume(chain.volume.id):
+        raise ProvisioningError('Could not delete the {} volume with id {}.'.format(chain.name, chain.volume.id))
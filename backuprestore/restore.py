@@ -1,120 +1,319 @@
-import time
-import json
 import os
+import shutil
 from service_fabrik_backup_restore import parse_options, create_iaas_client
+from options import parse_extended_options
+from blobstore import CachingBlobstore, IaasBlobstore
+from incremental import restore_incremental_backup
+from dedup import restore_dedup_backup
+from blocks import restore_block_archive, restore_paths
+from streaming import IntegrityError, download_verified, extract_encrypted_archive, extract_encrypted_parts, \
+    stream_blobstore_to_directory
+from compression import codec_from_metadata
+from deltasync import sync_directories
+from staging import StagingDirectory
+from timings import InstrumentedClient, Timings, export_timings
+from waiting import LibraryClock, PollingClient, SerializedClient, wait_for_service_job_status
+from journal import Journal, JournalingClient
+from provisioning import ProvisioningError, scratch_volume_chain, mount_scratch_volume, release_scratch_volume
+from volumepool import VolumePool
+from verify import backup_size, has_digests, verify_backup
+from transfer import ParallelTransfer
+import progress
+
+# +-> Bytes of the local disk that are left free when a backup is kept in the cache for an in-place restore
+SPOOL_RESERVE = 1024 * 1024 * 1024
 
 
 def main():
-    # +-> Definition of constants
-    DIRECTORY_PERSISTENT = '/var/vcap/store'
-    DIRECTORY_DOWNLOADS = '/tmp/service-fabrik-restore/downloads'
+    # +-> Definition of constants; all directories are below the root directory, which is only changed by the benchmark
+    DIRECTORY_ROOT = os.environ.get('SF_BACKUP_RESTORE_ROOT_DIRECTORY', '')
+    DIRECTORY_PERSISTENT = DIRECTORY_ROOT + '/var/vcap/store'
+    DIRECTORY_DOWNLOADS = DIRECTORY_ROOT + '/tmp/service-fabrik-restore/downloads'
+    DIRECTORY_SPOOL = DIRECTORY_ROOT + '/tmp/service-fabrik-restore/spool'
+    DIRECTORY_STATE = DIRECTORY_ROOT + '/var/vcap/data/blueprint-restore'
+    DIRECTORY_VOLUME_POOL = DIRECTORY_ROOT + '/var/vcap/store/blueprint-volume-pool'
+    DIRECTORY_VOLUME_POOL_PREVIOUS = DIRECTORY_ROOT + '/var/vcap/data/blueprint-volume-pool'
 
     # +-> Initialization: Logging, Argument Parsing, IaaS-Client Creation
+    options = parse_extended_options('restore')
     configuration = parse_options('restore')
+    poll_arguments = [options['iaas_poll_interval'], 18000] if options['iaas_poll_interval'] else []
     iaas_client = create_iaas_client(
-        'restore', configuration, DIRECTORY_PERSISTENT, [DIRECTORY_DOWNLOADS])
+        'restore', configuration, DIRECTORY_PERSISTENT, [DIRECTORY_DOWNLOADS], *poll_arguments)
+    # +-> The status polls of the library back off from a fraction of a second up to the poll interval; calls made from
+    #     several threads (e.g. to provision volumes concurrently) are made one at a time, their waits overlap
+    clock = LibraryClock()
+    clock.install()
+    iaas_client = PollingClient(SerializedClient(iaas_client, clock), clock)
+    # +-> Every call of the IaaS client is timed, the timings are exported when the restore ends (also on failure)
+    timings = Timings('restore')
+    iaas_client = InstrumentedClient(iaas_client, timings)
+    # +-> Download volumes can be leased from a pool of warm volumes; they outlive the restore, hence are not journaled
+    volume_pool = None
+    if options['volume_pool_size']:
+        volume_pool = VolumePool(iaas_client, configuration['instance_id'], DIRECTORY_VOLUME_POOL,
+                                 options['volume_pool_size'], options['volume_pool_idle'],
+                                 DIRECTORY_VOLUME_POOL_PREVIOUS)
+    # +-> Created resources and finished transfers are journaled, a retry with the same backup guid resumes from there
+    journal = Journal(DIRECTORY_STATE, 'restore', configuration['backup_guid'])
+    iaas_client = JournalingClient(iaas_client, journal)
+
+    def wait_for_service_job(status):
+        # +-> Polls monit with a backoff that starts at a fraction of a second instead of the library's poll interval
+        return wait_for_service_job_status(iaas_client, configuration.get('job_name', 'blueprint'), status, timings)
 
     landscape = configuration['iaas'].title()
     # ------------------------------------------ RESTORE START ---------------------------------------------------------
     backup_guid = configuration['backup_guid']
     instance_id = configuration['instance_id']
     iaas_client.initialize()
+    # +-> The progress of the running step is published next to the last operation state while the restore runs
+    progress.start('restore', options['stall_timeout'], iaas_client.logger)
+    # +-> Blobs downloaded and checked before the service is stopped, which are extracted from there afterwards
+    cache = None
 
     try:
+        if iaas_client.recover():
+            iaas_client.logger.info(
+                'Resuming the restore of backup {} from its journal.'.format(backup_guid))
+        iaas_client.release_stale_resources()
+        if volume_pool:
+            volume_pool.reconcile()
+
         tarball_files_name = 'blueprint-files.tar.gz.gpg'
         tarball_files_path = DIRECTORY_DOWNLOADS + '/' + tarball_files_name
         metadata_files_name = 'blueprint-metadata.json'
-        metadata_files_path = '/tmp/' + metadata_files_name
-
-        # +-> Get the id of the persistent volume attached to this instance
-        volume_persistent = iaas_client.get_persistent_volume_for_instance(
-            instance_id)
-        if not volume_persistent:
-            iaas_client.exit(
-                'Could not find the persistent volume attached to this instance.')
-
-        if landscape != 'Aws' and landscape != 'Azure' and landscape != 'Gcp':
-            # +-> Create a volume where the downloaded blobs will be stored on
-            volume_downloads = iaas_client.create_volume(
-                volume_persistent.size)
-            if not volume_downloads:
-                iaas_client.exit(
-                    'Could not create a volume for the downloads.')
-
-            # +-> Attach the download volume to the instance
-            attachment_volume_downloads = iaas_client.create_attachment(
-                volume_downloads.id, instance_id)
-            if not attachment_volume_downloads:
-                iaas_client.exit('Could not attach the download volume with id {} to instance with id {}.'
-                                 .format(volume_downloads.id, instance_id))
-
-            # +-> Find the mountpoint of the download volume
-            mountpoint_volume_downloads = iaas_client.get_mountpoint(
-                volume_downloads.id)
-            if not mountpoint_volume_downloads:
-                iaas_client.exit('Could not determine the mountpoint for the download volume (id: {}).'
-                                 .format(volume_downloads.id))
-
-            # +-> Create temporary directories, format the download volume and mount them to these directories
-            if not iaas_client.delete_directory(DIRECTORY_DOWNLOADS):
-                iaas_client.exit(
-                    'Could not remove the following directory: {}.'.format(DIRECTORY_DOWNLOADS))
-            if not iaas_client.create_directory(DIRECTORY_DOWNLOADS):
-                iaas_client.exit(
-                    'Could not create the following directory: {}'.format(DIRECTORY_DOWNLOADS))
-            if not iaas_client.format_device(mountpoint_volume_downloads):
-                iaas_client.exit('Could not format the following device: {}'.format(
-                    mountpoint_volume_downloads))
-            if not iaas_client.mount_device(mountpoint_volume_downloads, DIRECTORY_DOWNLOADS):
-                iaas_client.exit('Could not mount the device {} to the directory {}.'
-                                 .format(mountpoint_volume_downloads, DIRECTORY_DOWNLOADS))
-
-            # +-> Download tarball from the blob store and decrypt it
-            # +-> Service Fabrik forces the services to store their blobs in a pseudo-folder named with the backup_guid,
-            #     thus we download our files from that pseudo-folder
-            if not iaas_client.download_from_blobstore('{}/{}'.format(backup_guid, tarball_files_name), tarball_files_path):
-                iaas_client.exit(
-                    'Could not download the tarball {} for backup guid {} from pseudo-folder.'.format(tarball_files_name, backup_guid))
+        blobstore = IaasBlobstore(iaas_client, DIRECTORY_SPOOL)
+        directory_files = '{}/blueprint/files'.format(DIRECTORY_PERSISTENT)
+
+        def replace_files(fill, seed=False):
+            # +-> `fill` writes the restored contents to the directory it is given. In the swap mode this is a staging
+            #     directory next to the files directory which is filled while the service keeps running; the service
+            #     is only stopped for the rename and the old contents are kept until the swap succeeded. A `fill` that
+            #     only syncs differences wants the staging directory to be `seed`ed with the current contents
+            if options['restore_mode'] == 'swap':
+                staging = StagingDirectory(directory_files)
+                try:
+                    with timings.step('restore_files'):
+                        path = staging.prepare(seed)
+                        if seed and not staging.seeded:
+                            iaas_client.logger.warning('Could not clone {} into the staging directory, all files are '
+                                                       'copied.'.format(directory_files))
+                        fill(path)
+                except BaseException:
+                    staging.discard()
+                    raise
 
             # +-> Stop the service job and wait for it to be stopped
             iaas_client.stop_service_job()
-            if not iaas_client.wait_for_service_job_status('not monitored'):
+            if not wait_for_service_job('not monitored'):
                 iaas_client.exit('Could not stop the service job.')
 
-            # +-> Extract the tarball's contents to the persistent volume
-            if not iaas_client.decrypt_and_extract_tarball_of_directory(tarball_files_path,
-                                                                        '{}/blueprint/files'.format(DIRECTORY_PERSISTENT)):
-                iaas_client.exit('Could not decrypt and extract the tarball {} to the persistent volume.'
-                                 .format(tarball_files_path))
+            if options['restore_mode'] == 'swap':
+                try:
+                    with timings.step('swap_staging_directory'):
+                        staging.swap()
+                except OSError as error:
+                    staging.discard()
+                    iaas_client.exit('Could not swap the staging directory {} with the directory {}: {}'
+                                     .format(staging.path, directory_files, error))
+            else:
+                with timings.step('restore_files'):
+                    fill(directory_files)
 
             # +-> Start the service job
             iaas_client.start_service_job()
 
-            # +-> Unmount the volumes and remove the temporary directories
-            if not iaas_client.unmount_device(mountpoint_volume_downloads):
-                iaas_client.exit('Could not unmount the device {}.'.format(
-                    mountpoint_volume_downloads))
-            if not iaas_client.delete_directory(DIRECTORY_DOWNLOADS):
+            if options['restore_mode'] == 'swap':
+                staging.remove_previous()
+
+        def clear_directory(directory):
+            if not iaas_client.delete_directory('{}/*'.format(directory)):
                 iaas_client.exit(
-                    'Could not remove the following directory: {}.'.format(DIRECTORY_DOWNLOADS))
+                    'Could not remove the following directory: {}.'.format(directory))
+            if not iaas_client.create_directory(directory):
+                iaas_client.exit(
+                    'Could not create the following directory: {}'.format(directory))
 
-            # +-> Detach the download volume from the instance
-            if not iaas_client.delete_attachment(attachment_volume_downloads.volume_id, instance_id):
-                iaas_client.exit('Could not detach the download volume with id {} to instance with id {}.'
-                                 .format(attachment_volume_downloads.volume_id, instance_id))
+        # +-> Get the id of the persistent volume attached to this instance
+        volume_persistent = iaas_client.get_persistent_volume_for_instance(
+            instance_id)
+        if not volume_persistent:
+            iaas_client.exit(
+                'Could not find the persistent volume attached to this instance.')
 
-            # +-> Delete the download volume and the snapshot volume
-            if not iaas_client.delete_volume(volume_downloads.id):
-                iaas_client.exit(
-                    'Could not delete the download volume with id {}.'.format(volume_downloads.id))
+        # +-> Streaming and incremental backups describe their format in the metadata, tarball backups have none
+        metadata = blobstore.download_json(
+            '{}/{}'.format(backup_guid, metadata_files_name)) or {}
+        codec = codec_from_metadata(metadata)
+        tarball_files_name = metadata.get('archive', tarball_files_name)
+        tarball_files_path = DIRECTORY_DOWNLOADS + '/' + tarball_files_name
 
-        if landscape == 'Aws' or landscape == 'Azure' or landscape == 'Gcp':
-            # get sanpshot id from service metadata stored in blobstore
-            if not iaas_client.download_from_blobstore('{}/{}'.format(backup_guid, metadata_files_name), metadata_files_path):
+        def verify_before_stopping():
+            # +-> The digests are checked while the blobs are downloaded; in the swap mode this happens while the
+            #     staging directory is filled, before the service is stopped. In place, the extraction starts after it
+            #     was stopped, hence the blobs are downloaded and checked first and kept in a cache on the local disk,
+            #     from which they are extracted afterwards; every blob is downloaded once, a corrupt backup never
+            #     touches the service. If the local disk cannot hold the backup, every part is only checked right
+            #     before it is extracted
+            nonlocal blobstore, cache
+            if options['restore_mode'] != 'in_place' or not has_digests(metadata):
+                return
+            try:
+                required = backup_size(blobstore, backup_guid, metadata, configuration['secret'])
+                available = shutil.disk_usage(DIRECTORY_SPOOL).free
+                if required > available - SPOOL_RESERVE:
+                    iaas_client.logger.warning('The backup {} ({} bytes) does not fit into {} ({} bytes free), its '
+                                               'parts are checked while they are extracted.'
+                                               .format(backup_guid, required, DIRECTORY_SPOOL, available))
+                    return
+                cache = CachingBlobstore(blobstore, DIRECTORY_SPOOL + '/cache')
+                with timings.step('verify_backup') as step:
+                    step.bytes = verify_backup(cache, backup_guid, metadata, configuration['secret'],
+                                               options['parallelism'])['bytes']
+                blobstore = cache
+            except Exception as error:
+                iaas_client.exit('The backup {} failed verification, the service was not stopped: {}'
+                                 .format(backup_guid, error))
+
+        if options['restore_mode'] == 'partial':
+            # +-> Only the blocks holding the given paths are downloaded and the paths are renamed into place one by
+            #     one, all other files stay as they are; the service job keeps running
+            if metadata.get('format') != 'blocks':
+                iaas_client.exit('Only backups in the blocks format can be restored partially, backup {} is not.'
+                                 .format(backup_guid))
+            try:
+                with timings.step('restore_paths') as step:
+                    summary = restore_paths(blobstore, backup_guid, metadata, configuration['secret'],
+                                            directory_files, options['restore_paths'], options['parallelism'])
+                    step.bytes = summary['bytes']
+            except Exception as error:
+                iaas_client.exit('Could not restore the paths {} of backup {}: {}'
+                                 .format(', '.join(options['restore_paths']), backup_guid, error))
+            iaas_client.logger.info('Restored the paths of backup {}: {}'.format(backup_guid, summary))
+
+        elif metadata.get('format') == 'incremental':
+            # +-> Delete the original contents of the persistent volume and apply every backup of the chain in order
+            def fill_incremental(directory):
+                clear_directory(directory)
+                try:
+                    restore_incremental_backup(blobstore, backup_guid, metadata, configuration['secret'],
+                                               directory, metadata_files_name)
+                except Exception as error:
+                    iaas_client.exit('Could not restore the incremental backup {} to the persistent volume: {}'
+                                     .format(backup_guid, error))
+
+            verify_before_stopping()
+            replace_files(fill_incremental)
+
+        elif landscape != 'Aws' and landscape != 'Azure' and landscape != 'Gcp':
+            if metadata.get('format') in ('streaming', 'resumable', 'dedup', 'blocks'):
+                # +-> Download, decrypt and extract the parts directly to the persistent volume, no download volume is
+                #     needed and the extraction overlaps with the transfer; chunks of the dedup format are fetched
+                #     concurrently and reassembled in the order of the recipe, blocks are extracted concurrently
+                def fill_streamed(directory):
+                    progress.expect(metadata.get('size'))
+                    try:
+                        if metadata['format'] == 'dedup':
+                            restore_dedup_backup(blobstore, backup_guid, metadata, configuration['secret'],
+                                                 directory, options['parallelism'])
+                        elif metadata['format'] == 'blocks':
+                            restore_block_archive(blobstore, backup_guid, metadata, configuration['secret'],
+                                                  directory, options['parallelism'])
+                        else:
+                            stream_blobstore_to_directory(blobstore, backup_guid, metadata, directory,
+                                                          configuration['secret'])
+                    except Exception as error:
+                        iaas_client.exit('Could not stream the tarball {} for backup guid {} to the persistent volume: {}'
+                                         .format(tarball_files_name, backup_guid, error))
+
+                verify_before_stopping()
+                replace_files(fill_streamed)
+            else:
+                # +-> Create (or lease) a volume where the downloaded blobs will be stored on, attach it to the
+                #     instance and find its mountpoint
+                chain_downloads = scratch_volume_chain('download', volume_persistent.size, volume_pool)
+                try:
+                    chain_downloads.provision(iaas_client, instance_id)
+                except ProvisioningError as error:
+                    iaas_client.exit(str(error))
+                mountpoint_volume_downloads = chain_downloads.mountpoint
+
+                # +-> Create temporary directories, format (or wipe) the download volume and mount it to this directory
+                try:
+                    mount_scratch_volume(iaas_client, chain_downloads, DIRECTORY_DOWNLOADS)
+                except ProvisioningError as error:
+                    iaas_client.exit(str(error))
+
+                # +-> Download tarball from the blob store and decrypt it
+                # +-> Service Fabrik forces the services to store their blobs in a pseudo-folder named with the backup_guid,
+                #     thus we download our files from that pseudo-folder
+                # +-> A tarball uploaded in parts is downloaded by concurrent transfers into part files, which are
+                #     extracted one after the other
+                # +-> Digests are checked while the tarball (or every part) is downloaded, before the service is stopped
+                if metadata.get('parts'):
+                    try:
+                        with timings.step('download_tarball_parts') as step:
+                            step.bytes = ParallelTransfer(blobstore, options['parallelism']).download(
+                                backup_guid, metadata['parts'], DIRECTORY_DOWNLOADS)
+                    except Exception as error:
+                        iaas_client.exit('Could not download the tarball {} for backup guid {}: {}'
+                                         .format(tarball_files_name, backup_guid, error))
+                else:
+                    try:
+                        if not download_verified(blobstore, '{}/{}'.format(backup_guid, tarball_files_name),
+                                                 tarball_files_path, metadata.get('sha256'),
+                                                 'the tarball {}'.format(tarball_files_name)):
+                            iaas_client.exit('Could not download the tarball {} for backup guid {} from pseudo-folder.'
+                                             .format(tarball_files_name, backup_guid))
+                    except IntegrityError as error:
+                        iaas_client.exit('The tarball {} of backup {} failed verification, the service was not stopped: {}'
+                                         .format(tarball_files_name, backup_guid, error))
+
+                # +-> Extract the tarball's contents to the persistent volume; the library only handles gzip tarballs in
+                #     one piece, parts and tarballs of other codecs are extracted by the own pipeline
+                def fill_tarball(directory):
+                    if metadata.get('parts'):
+                        try:
+                            extract_encrypted_parts([DIRECTORY_DOWNLOADS + '/' + part['name']
+                                                     for part in metadata['parts']],
+                                                    directory, configuration['secret'], codec)
+                        except Exception as error:
+                            iaas_client.exit('Could not decrypt and extract the parts of the tarball {} to the '
+                                             'persistent volume: {}'.format(tarball_files_name, error))
+                    elif codec.extension == 'gz':
+                        if not iaas_client.decrypt_and_extract_tarball_of_directory(tarball_files_path, directory):
+                            iaas_client.exit('Could not decrypt and extract the tarball {} to the persistent volume.'
+                                             .format(tarball_files_path))
+                    else:
+                        try:
+                            extract_encrypted_archive(tarball_files_path, directory, configuration['secret'], codec)
+                        except Exception as error:
+                            iaas_client.exit('Could not decrypt and extract the tarball {} to the persistent volume: {}'
+                                             .format(tarball_files_path, error))
+
+                replace_files(fill_tarball)
+
+                # +-> Unmount the volumes and remove the temporary directories
+                if not iaas_client.unmount_device(mountpoint_volume_downloads):
+                    iaas_client.exit('Could not unmount the device {}.'.format(
+                        mountpoint_volume_downloads))
+                if not iaas_client.delete_directory(DIRECTORY_DOWNLOADS):
+                    iaas_client.exit(
+                        'Could not remove the following directory: {}.'.format(DIRECTORY_DOWNLOADS))
+
+                # +-> Detach and delete the download volume, or give it back to the pool
+                try:
+                    release_scratch_volume(iaas_client, instance_id, chain_downloads)
+                except ProvisioningError as error:
+                    iaas_client.exit(str(error))
+
+        elif landscape == 'Aws' or landscape == 'Azure' or landscape == 'Gcp':
+            # +-> The snapshot id is taken from the service metadata downloaded above
+            if 'snapshotId' not in metadata:
                 iaas_client.exit(
                     'Could not download the tarball {} for backup guid {} from pseudo-folder.'.format(metadata_files_name, backup_guid))
-            encrypted_snapshot_id = str(
-                json.load(open(metadata_files_path))['snapshotId'])
+            encrypted_snapshot_id = str(metadata['snapshotId'])
 
             # +-> Create a volume where the downloaded blobs will be stored on
             snapshot_volume = iaas_client.create_volume(
@@ -149,29 +348,21 @@ def main():
                 iaas_client.exit('Could not mount the device {} to the directory {}.'
                                  .format(mountpoint_encrypted_snapshot, DIRECTORY_DOWNLOADS))
 
-            iaas_client.stop_service_job()
-            if not iaas_client.wait_for_service_job_status('not monitored'):
-                iaas_client.exit('Could not stop the service job.')
-
-            # +-> Delete the original contents of the persistant volume
-            if not iaas_client.delete_directory('{}/blueprint/files/*'.format(DIRECTORY_PERSISTENT)):
-                iaas_client.exit('Could not remove the following directory: {}.'.format(
-                    '{}/blueprint/files'.format(DIRECTORY_PERSISTENT)))
-            if not iaas_client.create_directory('{}/blueprint/files'.format(DIRECTORY_PERSISTENT)):
-                iaas_client.exit('Could not create the following directory: {}'.format(
-                    '{}/blueprint/files'.format(DIRECTORY_PERSISTENT)))
-            # +-> Copy the Encrypted backups contents to the persistent volume
-            if os.listdir('{}/blueprint/files/'.format(DIRECTORY_DOWNLOADS)) != []:
-                if not iaas_client.copy_directory(
-                    '{}/blueprint/files/*'.format(DIRECTORY_DOWNLOADS),
-                        '{}/blueprint/files'.format(DIRECTORY_PERSISTENT)):
-                    iaas_client.exit('Could not copy from {}/{} to the persistent volume.'
-                                     .format(DIRECTORY_DOWNLOADS, DIRECTORY_PERSISTENT))
-            else:
-                iaas_client.logger.info(
-                    'Skipping copy since backup directory was empty')
-            # +-> Start the service job
-            iaas_client.start_service_job()
+            def fill_from_snapshot(directory):
+                # +-> Sync the persistent volume with the contents of the snapshot: only files that differ are copied
+                #     and only files that are not in the snapshot are deleted, which for a restore of a recent backup
+                #     is a small fraction of the data
+                try:
+                    with timings.step('sync_directories') as step:
+                        summary = sync_directories('{}/blueprint/files'.format(DIRECTORY_DOWNLOADS), directory,
+                                                   options['parallelism'])
+                        step.bytes = summary.get('copiedBytes', 0)
+                except Exception as error:
+                    iaas_client.exit('Could not sync {}/blueprint/files to the persistent volume: {}'
+                                     .format(DIRECTORY_DOWNLOADS, error))
+                iaas_client.logger.info('Synced the persistent volume with the snapshot: {}'.format(summary))
+
+            replace_files(fill_from_snapshot, seed=True)
 
             # +-> Unmount the volumes and remove the temporary directories
             if not iaas_client.unmount_device(mountpoint_encrypted_snapshot):
@@ -191,12 +382,19 @@ def main():
                     'Could not delete the download volume with id {}.'.format(snapshot_volume.id))
 
         # +-> Wait for the service job to be running again
-        if not iaas_client.wait_for_service_job_status('running'):
+        if not wait_for_service_job('running'):
             iaas_client.exit('Could not start the service job.')
 
         iaas_client.finalize()
+        journal.remove()
+        timings.succeeded = True
     except Exception as error:
         iaas_client.exit('An unexpected exception occurred: {}'.format(error))
+    finally:
+        if cache:
+            cache.remove()
+        progress.stop()
+        export_timings(timings, iaas_client.logger, options['metrics_directory'])
     # ------------------------------------------- RESTORE END ----------------------------------------------------------
 
 
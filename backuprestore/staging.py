@@ -0,0 +1,96 @@
+import ctypes
+import errno
+import os
+import shutil
+import subprocess
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def _renameat2():
+    try:
+        function = ctypes.CDLL(None, use_errno=True).renameat2
+    except (AttributeError, OSError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    return function
+
+
+def exchange(first, second):
+    """Atomically exchanges two paths on the same filesystem; returns False if the kernel or libc cannot do it."""
+    renameat2 = _renameat2()
+    if renameat2 is None:
+        return False
+    if renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL):
+        return False
+    raise OSError(error, os.strerror(error), first)
+
+
+def clone_directory(source, target):
+    """Clones the contents of the source into the target directory by reflinks; returns False if it is not supported."""
+    result = subprocess.run(['cp', '-a', '--reflink=always', source + '/.', target],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+class StagingDirectory:
+    """A sibling of the target directory that is filled while the service is running and then swapped in.
+
+    Staging and target are on the same filesystem, so swapping them is a rename and takes no time regardless of the
+    amount of data. The previous contents are kept until `remove_previous` is called after a successful swap.
+    """
+
+    def __init__(self, target):
+        self.target = target.rstrip('/')
+        self.path = self.target + '.staging'
+        self.previous = self.target + '.previous'
+        self.seeded = False
+
+    def prepare(self, seed=False):
+        """Creates the staging directory and returns its path; with `seed`, it is a clone of the target if possible.
+
+        A seeded staging directory lets a delta sync copy only what differs from the current contents. The clone shares
+        the data blocks of the target copy-on-write (reflink), which takes no time and no space; hard links cannot be
+        used, the running service would change the staged files through them. `seeded` tells whether it was cloned.
+        """
+        for leftover in (self.path, self.previous):
+            if os.path.lexists(leftover):
+                shutil.rmtree(leftover)
+        self._create()
+        self.seeded = seed and os.path.isdir(self.target) and clone_directory(self.target, self.path)
+        if seed and not self.seeded:
+            # +-> The filesystem cannot share blocks, a partial clone is removed and everything will be copied
+            shutil.rmtree(self.path)
+            self._create()
+        return self.path
+
+    def _create(self):
+        os.mkdir(self.path)
+        if os.path.isdir(self.target):
+            info = os.stat(self.target)
+            os.chmod(self.path, info.st_mode & 0o7777)
+            os.chown(self.path, info.st_uid, info.st_gid)
+
+    def swap(self):
+        if not os.path.exists(self.target):
+            os.rename(self.path, self.target)
+            return
+        if exchange(self.path, self.target):
+            os.rename(self.path, self.previous)
+            return
+        os.rename(self.target, self.previous)
+        try:
+            os.rename(self.path, self.target)
+        except OSError:
+            os.rename(self.previous, self.target)
+            raise
+
+    def remove_previous(self):
+        shutil.rmtree(self.previous, ignore_errors=True)
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
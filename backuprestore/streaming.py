@@ -0,0 +1,771 @@
+import ctypes
+import hashlib
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+
+import progress
+from compression import GzipCodec, codec_from_metadata
+
+MEBIBYTE = 1024 * 1024
+READ_SIZE = MEBIBYTE
+
+# +-> Number of finished parts that may wait on the local disk for their upload
+MAX_SPOOLED_PARTS = 2
+# +-> Seconds between the reads of a file that is followed while it is downloaded
+FOLLOW_INTERVAL = 0.05
+# +-> Modes of fallocate(2) that free a range of a file without changing its size
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+class StreamingError(Exception):
+    pass
+
+
+class IntegrityError(StreamingError):
+    pass
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_digest(name, expected, actual):
+    """Raises an `IntegrityError` if the SHA-256 digest differs; backups taken before digests were recorded have none."""
+    if expected and expected != actual:
+        raise IntegrityError('The SHA-256 digest of {} is {}, but {} was recorded.'.format(name, actual, expected))
+
+
+def punch_hole(fd, offset, length):
+    """Frees the blocks of a range of the file without changing its size; returns False if the filesystem cannot."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    return libc.fallocate(fd, FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE, offset, length) == 0
+
+
+class FileFollower:
+    """Computes the SHA-256 digest of a file while another writer (the library) writes it from start to end.
+
+    The file is opened as soon as it appears and read up to its current end again and again until `finish` is called
+    after the writer is done. The digest is only returned if the follower read the very file that is there in the end,
+    in full; if the writer replaced the file or wrote it out of order, the digest of what was read simply does not match
+    and the caller has to read the file once more. With `discard`, every range is freed on the disk once it was read,
+    so a file that is only downloaded to be checked never takes its full size on the local disk.
+    """
+
+    def __init__(self, path, discard=False):
+        self.path = path
+        self.discard = discard
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.inode = None
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            while True:
+                # +-> A fast writer may be done before the file was opened at all, it is then read in one go
+                finished = self.done.is_set()
+                try:
+                    f = open(self.path, 'rb')
+                    break
+                except FileNotFoundError:
+                    if finished:
+                        return
+                    self.done.wait(FOLLOW_INTERVAL)
+            discard_fd = os.open(self.path, os.O_WRONLY) if self.discard else None
+            try:
+                with f:
+                    self.inode = os.fstat(f.fileno()).st_ino
+                    while True:
+                        # +-> The writer has to be done before the read, otherwise the end of the file is not its end
+                        finished = self.done.is_set()
+                        chunk = f.read(READ_SIZE)
+                        if chunk:
+                            self.digest.update(chunk)
+                            if discard_fd is not None and not punch_hole(discard_fd, self.size, len(chunk)):
+                                os.close(discard_fd)
+                                discard_fd = None
+                            self.size += len(chunk)
+                        elif finished:
+                            return
+                        else:
+                            time.sleep(FOLLOW_INTERVAL)
+            finally:
+                if discard_fd is not None:
+                    os.close(discard_fd)
+        except OSError as error:
+            self.error = error
+
+    def finish(self):
+        """Returns the digest of the file, or None if what was read is not the complete file that is there now."""
+        self.done.set()
+        self.thread.join()
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return None
+        if self.error or info.st_ino != self.inode or info.st_size != self.size:
+            return None
+        return self.digest.hexdigest()
+
+
+def download_verified(blobstore, blob_name, path, sha256=None, description=None, discard=False):
+    """Downloads the blob to the file and checks its SHA-256 digest; returns False if the download failed.
+
+    The digest is computed from the file while the blob store writes it, so the file is not read a second time. Only if
+    that digest does not match (see `FileFollower`) the file is hashed once more, before an `IntegrityError` is raised.
+    A blob the blob store serves from its cache (see `CachingBlobstore`) was checked in the pass that cached it. With
+    `discard`, the contents of the file are freed while it is checked and only its size is left; the blob is then
+    downloaded once more if the digest does not match.
+    """
+    if not sha256 or blobstore.is_cached(blob_name):
+        return blobstore.download_file(blob_name, path)
+    if os.path.lexists(path):
+        os.remove(path)
+    follower = FileFollower(path, discard).start()
+    try:
+        downloaded = blobstore.download_file(blob_name, path)
+    finally:
+        digest = follower.finish()
+    if not downloaded:
+        return False
+    if digest != sha256 and discard:
+        return download_verified(blobstore, blob_name, path, sha256, description)
+    if digest != sha256:
+        digest = file_digest(path)
+    check_digest(description or blob_name, sha256, digest)
+    return True
+
+
+def gpg_command(passphrase_fd, *arguments):
+    return ['gpg', '--batch', '--yes', '--no-tty', '--quiet', '--passphrase-fd', str(passphrase_fd)] + list(arguments)
+
+
+class Pipeline:
+    """A chain of processes whose standard streams are connected to each other.
+
+    The passphrase for gpg is handed over through an anonymous pipe, so that it never shows up in the process list.
+    """
+
+    def __init__(self, passphrase=None):
+        self.passphrase = passphrase
+        self.processes = []
+        self.threads = []
+        self.errors = []
+        self.entries = 0
+        self.stderr = tempfile.TemporaryFile()
+
+    def passphrase_pipe(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, self.passphrase.encode('utf-8'))
+        os.close(write_fd)
+        return read_fd
+
+    def spawn(self, command, stdin=None, stdout=subprocess.PIPE, pass_fds=()):
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=self.stderr, pass_fds=pass_fds)
+        self.processes.append((command[0], process))
+        for fd in pass_fds:
+            os.close(fd)
+        return process
+
+    def spawn_archiver(self, directory, files_from=None):
+        """Spawns tar writing the archive of the directory to its stdout.
+
+        tar's verbose listing of the archived entries is read from an anonymous pipe; the files (all entries but
+        directories) are counted in `entries`, which is final once the pipeline has been waited for, and their sizes
+        are reported as the progress of the running step. If `files_from` names a file with NUL-separated relative
+        paths, only these paths (and no directory contents) are archived.
+        """
+        read_fd, write_fd = os.pipe()
+        command = ['tar', '-cvvf', '-', '--index-file=/dev/fd/{}'.format(write_fd), '-C', directory]
+        if files_from:
+            command += ['--no-recursion', '--ignore-failed-read', '--null', '-T', files_from]
+        else:
+            command.append('.')
+        tar = self.spawn(command, pass_fds=(write_fd,))
+        self.pump(self._count_entries, os.fdopen(read_fd, 'rb'), None)
+        return tar
+
+    def _count_entries(self, listing, _):
+        # +-> Every line reads like `-rw-r--r-- owner/group <size> <date> <time> <path>`
+        for line in listing:
+            fields = line.split(None, 3)
+            if not fields or fields[0].startswith(b'd'):
+                continue
+            self.entries += 1
+            progress.advance(int(fields[2]) if len(fields) > 2 and fields[2].isdigit() else 0)
+
+    def pump(self, function, source, sink):
+        """Runs an in-process stage that reads from `source` and writes to `sink`, closing both when done."""
+        def run():
+            try:
+                function(source, sink)
+            except Exception as error:
+                self.errors.append(error)
+            finally:
+                for stream in (source, sink):
+                    if stream is None:
+                        continue
+                    try:
+                        stream.close()
+                    except BrokenPipeError:
+                        pass
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def kill(self):
+        for _, process in self.processes:
+            if process.poll() is None:
+                process.kill()
+        for _, process in self.processes:
+            process.wait()
+        for thread in self.threads:
+            thread.join()
+
+    def error_output(self):
+        self.stderr.seek(0)
+        return self.stderr.read().decode('utf-8', 'replace').strip()[-2000:]
+
+    def wait(self, tolerated_codes=None):
+        tolerated_codes = tolerated_codes or {}
+        failed = []
+        for name, process in self.processes:
+            code = process.wait()
+            if code != 0 and code not in tolerated_codes.get(name, ()):
+                failed.append('{} exited with code {}'.format(name, code))
+        for thread in self.threads:
+            thread.join()
+        failed.extend(str(error) for error in self.errors)
+        if failed:
+            raise StreamingError('{}: {}'.format(', '.join(failed), self.error_output()))
+
+
+class CompressedArchive(Pipeline):
+    """Streams `tar | <codec>` of a directory.
+
+    If `files_from` is given, only the paths listed there are archived (see `spawn_archiver`). With a `throttle`, tar's
+    output is paced by it, which in turn limits how fast tar reads the directory.
+    """
+
+    def __init__(self, directory, passphrase=None, files_from=None, codec=None, throttle=None):
+        super().__init__(passphrase)
+        self.directory = directory
+        self.files_from = files_from
+        self.codec = codec or GzipCodec()
+        self.throttle = throttle
+        self.stdout = None
+
+    def compressed_stream(self):
+        """Spawns tar and the compressor; returns the stream of the compressed archive."""
+        tar = self.spawn_archiver(self.directory, self.files_from)
+        source = tar.stdout
+        if self.throttle:
+            read_fd, write_fd = os.pipe()
+            self.pump(self.throttle.copy, tar.stdout, os.fdopen(write_fd, 'wb'))
+            source = os.fdopen(read_fd, 'rb')
+        compress_command = self.codec.compress_command()
+        if compress_command:
+            compressor = self.spawn(compress_command, stdin=source)
+            source.close()
+            return compressor.stdout
+        read_fd, write_fd = os.pipe()
+        self.pump(self.codec.compress, source, os.fdopen(write_fd, 'wb'))
+        return os.fdopen(read_fd, 'rb')
+
+    def __enter__(self):
+        self.stdout = self.compressed_stream()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.kill()
+        self.stdout.close()
+        if not exc_type:
+            # +-> tar exits with 1 if files changed while they were read, which is expected for a live directory
+            self.wait({'tar': (1,)})
+
+    def read(self, size=READ_SIZE):
+        return self.stdout.read(size)
+
+
+def encrypt_command(passphrase_fd, *arguments):
+    return gpg_command(passphrase_fd, '--symmetric', '--cipher-algo', 'AES256', '--compress-algo', 'none', *arguments)
+
+
+class EncryptedArchive(CompressedArchive):
+    """Streams `tar | <codec> | gpg` of a directory.
+
+    With the default gzip codec the output is byte-compatible to the archives written by
+    `create_and_encrypt_tarball_of_directory`, i.e. the concatenation of everything read from this stream can be
+    restored by `decrypt_and_extract_tarball_of_directory`; gpg encrypts with a new random session key every time, so
+    the encrypted stream of the same directory differs from run to run. The stream is written to `output` if given.
+    """
+
+    def __init__(self, directory, passphrase, files_from=None, codec=None, output='-', throttle=None):
+        super().__init__(directory, passphrase, files_from, codec, throttle)
+        self.output = output
+
+    def __enter__(self):
+        source = self.compressed_stream()
+        passphrase_fd = self.passphrase_pipe()
+        gpg = self.spawn(encrypt_command(passphrase_fd, '-o', self.output), stdin=source, pass_fds=(passphrase_fd,))
+        source.close()
+        self.stdout = gpg.stdout
+        return self
+
+
+class MultipartUpload:
+    """Uploads a stream as a sequence of parts of at most `part_size` bytes.
+
+    Only `MAX_SPOOLED_PARTS` parts are buffered on the local disk at any time: while one part is uploaded, the next one
+    is already filled from the stream. Each part is a blob of its own named `<blob_name>.part-<index>`. The SHA-256
+    digests of every part and of the whole stream are computed while the parts are filled.
+
+    With a `passphrase`, the stream is a compressed one instead, which is cut into slices of `part_size` bytes that are
+    encrypted by a gpg process of their own each; the restore decrypts such parts one by one. With a `journal`, every
+    uploaded part of them is recorded with the offset and the digest of its slice. The compressed stream of unchanged
+    files is the same again, so a retry of an interrupted backup skips the upload of every part that was uploaded
+    completely before and keeps its description; only the encryption is repeated. A stream encrypted as a whole cannot
+    be resumed like that, its encrypted bytes differ on every run.
+    """
+
+    def __init__(self, blobstore, blob_name, part_size, passphrase=None, journal=None):
+        self.blobstore = blobstore
+        self.blob_name = blob_name
+        self.part_size = part_size
+        self.passphrase = passphrase
+        self.journal = journal
+        self.parts = []
+        self.error = None
+        self.digest = hashlib.sha256()
+
+    def part_name(self, index):
+        return '{}.part-{:05d}'.format(self.blob_name, index)
+
+    def _upload_parts(self, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            index, path, part, offset, digest = item
+            try:
+                if not self.error and path:
+                    if not self.blobstore.upload_file(path, self.part_name(index)):
+                        raise StreamingError('Could not upload part {} of {}.'.format(index, self.blob_name))
+                    if self.journal:
+                        self.journal.add_part(self.part_name(index), offset, digest, part)
+                self.parts.append(part)
+            except BaseException as error:
+                # +-> The library exits when an upload fails, the exit is raised again by the thread filling the parts
+                self.error = error
+            finally:
+                if path:
+                    os.remove(path)
+
+    def _fill_part(self, stream, path):
+        """Copies the next part of the stream into the file; returns its description, or None at the end of the stream.
+        """
+        size = 0
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            while size < self.part_size:
+                chunk = stream.read(min(READ_SIZE, self.part_size - size))
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                self.digest.update(chunk)
+                size += len(chunk)
+                progress.advance()
+        return {'size': size, 'sha256': digest.hexdigest()} if size else None
+
+    def _encrypt_part(self, stream, path):
+        """Encrypts the next slice of the stream into the file; returns the description of the part and the digest of
+        the slice, or None at the end of the stream.
+        """
+        chunk = stream.read(min(READ_SIZE, self.part_size))
+        if not chunk:
+            return None
+        pipeline = Pipeline(self.passphrase)
+        passphrase_fd = pipeline.passphrase_pipe()
+        gpg = pipeline.spawn(encrypt_command(passphrase_fd), stdin=subprocess.PIPE, pass_fds=(passphrase_fd,))
+        part = {'size': 0}
+        part_digest = hashlib.sha256()
+
+        def write_part(source, _):
+            with open(path, 'wb') as f:
+                for data in iter(lambda: source.read(READ_SIZE), b''):
+                    f.write(data)
+                    part_digest.update(data)
+                    part['size'] += len(data)
+
+        pipeline.pump(write_part, gpg.stdout, None)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while chunk:
+                digest.update(chunk)
+                size += len(chunk)
+                gpg.stdin.write(chunk)
+                progress.advance()
+                chunk = stream.read(min(READ_SIZE, self.part_size - size)) if size < self.part_size else b''
+            gpg.stdin.close()
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            pipeline.kill()
+            raise
+        pipeline.wait()
+        part['sha256'] = part_digest.hexdigest()
+        return part, digest.hexdigest()
+
+    def upload(self, stream):
+        pending = queue.Queue(maxsize=MAX_SPOOLED_PARTS - 1)
+        uploader = threading.Thread(target=self._upload_parts, args=(pending,), daemon=True)
+        uploader.start()
+        try:
+            index = 0
+            offset = 0
+            while not self.error:
+                path = self.blobstore.spool_file('.part')
+                if self.passphrase:
+                    filled = self._encrypt_part(stream, path)
+                else:
+                    part = self._fill_part(stream, path)
+                    filled = (part, None) if part else None
+                if not filled:
+                    os.remove(path)
+                    break
+                part, digest = filled
+                part['name'] = os.path.basename(self.part_name(index))
+                recorded = self.journal.find_part(self.part_name(index), offset, digest) if self.journal else None
+                if recorded:
+                    os.remove(path)
+                    pending.put((index, None, recorded, offset, digest))
+                else:
+                    pending.put((index, path, part, offset, digest))
+                offset += self.part_size
+                index += 1
+        finally:
+            pending.put(None)
+            uploader.join()
+        if self.error:
+            raise self.error
+        return self.parts
+
+
+def stream_directory_to_blobstore(blobstore, directory, passphrase, blob_name, part_size, files_from=None,
+                                  codec=None, throttle=None, journal=None, resumable=False):
+    """Archives, compresses and encrypts the directory straight into a multipart upload.
+
+    Returns the description of the uploaded parts which has to be kept in the backup's metadata, with the digest and
+    size of the encrypted archive and the number of files in it. The concatenation of the parts is one encrypted
+    archive, like the ones of `create_and_encrypt_tarball_of_directory`. If `resumable`, the parts are encrypted
+    separately instead and only have digests of their own; with a `journal`, the parts uploaded by an earlier attempt
+    are then skipped (see `MultipartUpload`).
+    """
+    if resumable:
+        upload = MultipartUpload(blobstore, blob_name, part_size, passphrase, journal)
+        archive = CompressedArchive(directory, files_from=files_from, codec=codec, throttle=throttle)
+    else:
+        upload = MultipartUpload(blobstore, blob_name, part_size)
+        archive = EncryptedArchive(directory, passphrase, files_from, codec, throttle=throttle)
+    with archive:
+        parts = upload.upload(archive)
+    description = {
+        'archive': os.path.basename(blob_name),
+        'compression': archive.codec.describe(),
+        'size': sum(part['size'] for part in parts),
+        'fileCount': archive.entries,
+        'parts': parts
+    }
+    if resumable:
+        description['encryption'] = 'parts'
+    else:
+        description['sha256'] = upload.digest.hexdigest()
+    return description
+
+
+class DecryptingExtractor(Pipeline):
+    """Streams `gpg | <codec> | tar` into a directory, i.e. the counterpart of `EncryptedArchive`.
+
+    The encrypted archive is either written to the extractor or read from `source` if given. The parts of an archive
+    whose parts are encrypted separately (see `MultipartUpload`) are decrypted one by one with `write_part` instead.
+    """
+
+    def __init__(self, directory, passphrase, codec=None, source=None, separately_encrypted=False):
+        super().__init__(passphrase)
+        self.directory = directory
+        self.codec = codec or GzipCodec()
+        self.source = source
+        self.separately_encrypted = separately_encrypted
+        self.stdin = None
+
+    def __enter__(self):
+        if self.separately_encrypted:
+            decompressor = self.spawn(self.codec.decompress_command(), stdin=subprocess.PIPE)
+        else:
+            passphrase_fd = self.passphrase_pipe()
+            arguments = ['--decrypt', '-o', '-'] + ([self.source] if self.source else [])
+            gpg = self.spawn(gpg_command(passphrase_fd, *arguments),
+                             stdin=subprocess.DEVNULL if self.source else subprocess.PIPE, pass_fds=(passphrase_fd,))
+            decompressor = self.spawn(self.codec.decompress_command(), stdin=gpg.stdout)
+            gpg.stdout.close()
+        self.spawn(['tar', '-xf', '-', '-C', self.directory], stdin=decompressor.stdout, stdout=subprocess.DEVNULL)
+        decompressor.stdout.close()
+        self.stdin = decompressor.stdin if self.separately_encrypted else gpg.stdin
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.kill()
+        try:
+            if self.stdin:
+                self.stdin.close()
+        except BrokenPipeError:
+            pass
+        if not exc_type:
+            self.wait()
+
+    def write(self, data):
+        try:
+            self.stdin.write(data)
+        except BrokenPipeError:
+            self.kill()
+            raise StreamingError('The extraction stopped unexpectedly: {}'.format(self.error_output()))
+
+    def write_part(self, path):
+        """Decrypts a separately encrypted part from the file into the extraction."""
+        passphrase_fd = self.passphrase_pipe()
+        gpg = self.spawn(gpg_command(passphrase_fd, '--decrypt', '-o', '-', path), stdin=subprocess.DEVNULL,
+                         pass_fds=(passphrase_fd,))
+        with gpg.stdout:
+            for chunk in iter(lambda: gpg.stdout.read(READ_SIZE), b''):
+                self.write(chunk)
+        if gpg.wait() != 0:
+            self.kill()
+            raise StreamingError('Could not decrypt the part {}: {}'.format(path, self.error_output()))
+
+
+class MultipartDownload:
+    """Downloads the parts of a multipart upload in order and feeds them into a sink.
+
+    The next parts are prefetched while the current one is written to the sink, but never more than
+    `MAX_SPOOLED_PARTS` of them are kept on the local disk. A part whose digest does not match the recorded one is not
+    written to the sink at all; the digest of the whole stream (`sha256`, recorded for archives encrypted in one piece)
+    is checked after its last byte was written, before the sink is closed. Parts that are encrypted separately are
+    handed to the sink as files, by `write_part`.
+    """
+
+    def __init__(self, blobstore, blob_folder, parts, sha256=None, separately_encrypted=False):
+        self.blobstore = blobstore
+        self.blob_folder = blob_folder
+        self.parts = parts
+        self.sha256 = sha256
+        self.separately_encrypted = separately_encrypted
+        self.cancelled = False
+
+    def _download_parts(self, downloaded):
+        for part in self.parts:
+            if self.cancelled:
+                break
+            path = self.blobstore.spool_file('.part')
+            try:
+                if not download_verified(self.blobstore, '{}/{}'.format(self.blob_folder, part['name']), path,
+                                         part.get('sha256'), 'the part {}'.format(part['name'])):
+                    raise StreamingError('Could not download the part {}.'.format(part['name']))
+            except StreamingError as error:
+                if os.path.exists(path):
+                    os.remove(path)
+                downloaded.put(error)
+                return
+            downloaded.put(path)
+        downloaded.put(None)
+
+    def download(self, sink):
+        downloaded = queue.Queue(maxsize=MAX_SPOOLED_PARTS - 1)
+        downloader = threading.Thread(target=self._download_parts, args=(downloaded,), daemon=True)
+        downloader.start()
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                item = downloaded.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                try:
+                    if self.separately_encrypted:
+                        size += os.path.getsize(item)
+                        sink.write_part(item)
+                        progress.advance(os.path.getsize(item))
+                        continue
+                    with open(item, 'rb') as f:
+                        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                            digest.update(chunk)
+                            size += len(chunk)
+                            sink.write(chunk)
+                            progress.advance(len(chunk))
+                finally:
+                    os.remove(item)
+            check_digest('the archive in {}'.format(self.blob_folder), self.sha256, digest.hexdigest())
+            return size
+        finally:
+            self.cancelled = True
+            while downloader.is_alive() or not downloaded.empty():
+                try:
+                    item = downloaded.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if isinstance(item, str):
+                    os.remove(item)
+            downloader.join()
+
+
+def multipart_download(blobstore, blob_folder, archive):
+    return MultipartDownload(blobstore, blob_folder, archive['parts'], archive.get('sha256'),
+                             archive.get('encryption') == 'parts')
+
+
+def stream_blobstore_to_directory(blobstore, blob_folder, archive, directory, passphrase):
+    """Downloads, decrypts and extracts a streamed archive (as described by its metadata) into the directory."""
+    with DecryptingExtractor(directory, passphrase, codec_from_metadata(archive),
+                             separately_encrypted=archive.get('encryption') == 'parts') as extractor:
+        multipart_download(blobstore, blob_folder, archive).download(extractor)
+
+
+class DiscardingSink:
+    def write(self, data):
+        pass
+
+    def write_part(self, path):
+        pass
+
+
+def verify_streamed_archive(blobstore, blob_folder, archive):
+    """Downloads the parts of a streamed archive and checks their digests without decrypting or extracting them.
+
+    Returns the number of bytes checked.
+    """
+    return multipart_download(blobstore, blob_folder, archive).download(DiscardingSink())
+
+
+def part_path(path, index):
+    return '{}.part-{:05d}'.format(path, index)
+
+
+def _write_file(path, read, limit, *digests):
+    """Writes what `read` returns to the file, at most `limit` bytes if given; returns the number of bytes written."""
+    size = 0
+    with open(path, 'wb') as f:
+        while limit is None or size < limit:
+            chunk = read(READ_SIZE if limit is None else min(READ_SIZE, limit - size))
+            if not chunk:
+                break
+            for digest in digests:
+                digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+            progress.advance()
+    return size
+
+
+def create_encrypted_archive(directory, path, passphrase, codec, throttle=None, part_size=None):
+    """Writes the encrypted archive of the directory to a file, like `create_and_encrypt_tarball_of_directory`.
+
+    Returns the SHA-256 digest and size of the file, computed while it is written, and the number of files in it.
+    With a `part_size`, an archive larger than that is written as part files of at most `part_size` bytes next to
+    the file instead (see `part_path`), which are described with their digests in `parts`, so that they can be
+    transferred concurrently without being cut out of the archive first.
+    """
+    digest = hashlib.sha256()
+    parts = []
+    with EncryptedArchive(directory, passphrase, codec=codec, throttle=throttle) as archive:
+        if not part_size:
+            size = _write_file(path, archive.read, None, digest)
+        else:
+            while True:
+                part_digest = hashlib.sha256()
+                written = _write_file(part_path(path, len(parts)), archive.read, part_size, digest,
+                                                part_digest)
+                if not written and parts:
+                    os.remove(part_path(path, len(parts)))
+                    break
+                parts.append({'name': os.path.basename(part_path(path, len(parts))), 'size': written,
+                              'sha256': part_digest.hexdigest()})
+            size = sum(part['size'] for part in parts)
+    summary = {'sha256': digest.hexdigest(), 'size': size, 'fileCount': archive.entries}
+    if len(parts) == 1:
+        os.replace(part_path(path, 0), path)
+    elif parts:
+        summary['parts'] = parts
+    return summary
+
+
+def extract_encrypted_archive(path, directory, passphrase, codec):
+    with DecryptingExtractor(directory, passphrase, codec, source=path):
+        pass
+
+
+def extract_encrypted_parts(paths, directory, passphrase, codec):
+    """Extracts the archive whose parts are in the files, in their order, without joining them to one file first."""
+    with DecryptingExtractor(directory, passphrase, codec) as extractor:
+        for path in paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                    extractor.write(chunk)
+                    progress.advance(len(chunk))
+
+
+def encrypt_file(source_path, target_path, passphrase, armor=False):
+    pipeline = Pipeline(passphrase)
+    passphrase_fd = pipeline.passphrase_pipe()
+    arguments = ['--symmetric', '--cipher-algo', 'AES256'] + (['--armor'] if armor else [])
+    pipeline.spawn(gpg_command(passphrase_fd, *(arguments + ['-o', target_path, source_path])),
+                   stdout=subprocess.DEVNULL, pass_fds=(passphrase_fd,))
+    pipeline.wait()
+
+
+def decrypt_file(source_path, target_path, passphrase):
+    pipeline = Pipeline(passphrase)
+    passphrase_fd = pipeline.passphrase_pipe()
+    pipeline.spawn(gpg_command(passphrase_fd, '--decrypt', '-o', target_path, source_path),
+                   stdout=subprocess.DEVNULL, pass_fds=(passphrase_fd,))
+    pipeline.wait()
+
+
+def encrypt_text(text, passphrase):
+    """Encrypts a short text into an ASCII-armored message that can be kept in a JSON document."""
+    pipeline = Pipeline(passphrase)
+    passphrase_fd = pipeline.passphrase_pipe()
+    process = pipeline.spawn(gpg_command(passphrase_fd, '--symmetric', '--cipher-algo', 'AES256', '--armor'),
+                             stdin=subprocess.PIPE, pass_fds=(passphrase_fd,))
+    output, _ = process.communicate(text.encode('utf-8'))
+    pipeline.wait()
+    return output.decode('ascii')
+
+
+def decrypt_text(message, passphrase):
+    pipeline = Pipeline(passphrase)
+    passphrase_fd = pipeline.passphrase_pipe()
+    process = pipeline.spawn(gpg_command(passphrase_fd, '--decrypt'), stdin=subprocess.PIPE, pass_fds=(passphrase_fd,))
+    output, _ = process.communicate(message.encode('ascii'))
+    pipeline.wait()
+    return output.decode('utf-8')
@@ -0,0 +1,136 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from blobstore import DirectoryBlobstore
+from blocks import BlockArchiveError, IndexEntry, _move_into_place, blocks_directory_to_blobstore, matches, \
+    normalize_patterns, restore_block_archive, restore_paths
+from compression import create_codec
+from manifest import TYPE_FILE
+
+
+def write(path, data='data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class MatchesTest(unittest.TestCase):
+    def test_path_and_its_contents_match(self):
+        self.assertTrue(matches('data', ['data']))
+        self.assertTrue(matches('data/file', ['data']))
+        self.assertFalse(matches('database', ['data']))
+        self.assertFalse(matches('other/data', ['data']))
+
+    def test_globs_match_whole_components(self):
+        self.assertTrue(matches('logs/2020.log', ['logs/*.log']))
+        self.assertTrue(matches('logs/2020.log/part', ['logs/*.log']))
+        self.assertFalse(matches('logs/2020.txt', ['logs/*.log']))
+
+    def test_any_pattern_matches(self):
+        self.assertTrue(matches('b/file', ['a', 'b']))
+
+
+class NormalizePatternsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_patterns_are_relative(self):
+        self.assertEqual(normalize_patterns(['/data/', './logs/*.log', ' file '], self.directory),
+                         ['data', 'logs/*.log', 'file'])
+
+    def test_patterns_outside_of_the_directory_are_refused(self):
+        for pattern in ('', '/', '../file', 'data/../../file'):
+            self.assertRaises(BlockArchiveError, normalize_patterns, [pattern], self.directory)
+
+    def test_patterns_below_a_link_out_of_the_directory_are_refused(self):
+        os.symlink(tempfile.gettempdir(), os.path.join(self.directory, 'link'))
+        self.assertEqual(normalize_patterns(['link'], self.directory), ['link'])
+        self.assertRaises(BlockArchiveError, normalize_patterns, ['link/file'], self.directory)
+        self.assertRaises(BlockArchiveError, normalize_patterns, ['link/*'], self.directory)
+
+
+class MoveIntoPlaceTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.staging = os.path.join(self.root, 'staging')
+        self.directory = os.path.join(self.root, 'files')
+        self.outside = os.path.join(self.root, 'outside')
+        write(os.path.join(self.staging, 'data', 'file'), 'restored')
+        os.makedirs(self.directory)
+        os.makedirs(self.outside)
+
+    def test_entry_replaces_the_one_in_the_directory(self):
+        write(os.path.join(self.directory, 'data', 'file'), 'current')
+        self.assertTrue(_move_into_place(self.staging, self.directory, IndexEntry('data/file', TYPE_FILE, 8, 0)))
+        self.assertEqual(read(os.path.join(self.directory, 'data', 'file')), 'restored')
+
+    def test_entry_missing_in_the_block(self):
+        self.assertFalse(_move_into_place(self.staging, self.directory, IndexEntry('other', TYPE_FILE, 8, 0)))
+
+    def test_entry_below_a_link_out_of_the_directory_is_refused(self):
+        os.symlink(self.outside, os.path.join(self.directory, 'data'))
+        self.assertRaises(BlockArchiveError, _move_into_place, self.staging, self.directory,
+                          IndexEntry('data/file', TYPE_FILE, 8, 0))
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_entry_outside_of_the_directory_is_refused(self):
+        for path in ('../outside/file', '/outside/file'):
+            self.assertRaises(BlockArchiveError, _move_into_place, self.staging, self.directory,
+                              IndexEntry(path, TYPE_FILE, 8, 0))
+
+
+class RestorePathsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.directory = os.path.join(self.root, 'files')
+        for path in ('a/1', 'a/2', 'b/3', 'c'):
+            write(os.path.join(self.directory, path), 'backed up {}'.format(path))
+        self.blobstore = DirectoryBlobstore(os.path.join(self.root, 'blobstore'), os.path.join(self.root, 'spool'))
+        # +-> Every file takes a block of its own
+        self.metadata = blocks_directory_to_blobstore(self.blobstore, self.directory, 'secret', 'guid',
+                                                      'files.tar.gz.gpg', 1, 1024 * 1024, 2, create_codec())
+
+    def test_whole_archive_is_restored(self):
+        target = os.path.join(self.root, 'restored')
+        os.mkdir(target)
+        restore_block_archive(self.blobstore, 'guid', self.metadata, 'secret', target, 2)
+        self.assertEqual(subprocess.run(['diff', '-r', self.directory, target]).returncode, 0)
+
+    def test_only_the_matching_paths_are_restored(self):
+        for path in ('a/1', 'b/3', 'c'):
+            write(os.path.join(self.directory, path), 'changed')
+        os.remove(os.path.join(self.directory, 'a', '2'))
+        summary = restore_paths(self.blobstore, 'guid', self.metadata, 'secret', self.directory, ['/a/'], 2)
+        self.assertEqual((summary['paths'], summary['entries'], summary['missing']), (['a'], 3, 0))
+        self.assertLess(summary['blocks'], len(self.metadata['blocks']))
+        self.assertEqual(read(os.path.join(self.directory, 'a', '1')), 'backed up a/1')
+        self.assertEqual(read(os.path.join(self.directory, 'a', '2')), 'backed up a/2')
+        self.assertEqual(read(os.path.join(self.directory, 'b', '3')), 'changed')
+        self.assertEqual(read(os.path.join(self.directory, 'c')), 'changed')
+        self.assertEqual(sorted(os.listdir(self.root)), ['blobstore', 'files', 'spool'])
+
+    def test_globs_select_the_paths(self):
+        write(os.path.join(self.directory, 'a', '1'), 'changed')
+        write(os.path.join(self.directory, 'c'), 'changed')
+        restore_paths(self.blobstore, 'guid', self.metadata, 'secret', self.directory, ['?'], 2)
+        self.assertEqual(read(os.path.join(self.directory, 'a', '1')), 'backed up a/1')
+        self.assertEqual(read(os.path.join(self.directory, 'c')), 'backed up c')
+
+    def test_unknown_paths_are_an_error(self):
+        self.assertRaises(BlockArchiveError, restore_paths, self.blobstore, 'guid', self.metadata, 'secret',
+                          self.directory, ['unknown'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
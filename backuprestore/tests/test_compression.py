@@ -0,0 +1,42 @@
+import gzip
+import io
+import random
+import unittest
+
+from compression import BLOCK_SIZE, Codec, ParallelGzipCodec, archive_name, codec_from_metadata, create_codec
+
+
+class CodecTest(unittest.TestCase):
+    def test_codec_without_decompression_cannot_be_created(self):
+        self.assertRaises(TypeError, Codec)
+
+    def test_default_and_explicit_levels(self):
+        self.assertEqual(create_codec('gzip').level, 6)
+        self.assertEqual(create_codec('zstd').level, 3)
+        self.assertEqual(create_codec('zstd', 0).level, 0)
+        self.assertEqual(create_codec('pgzip', 1, 2).describe(), {'codec': 'pgzip', 'level': 1, 'threads': 2})
+
+    def test_archives_without_a_record_are_gzip(self):
+        codec = codec_from_metadata({})
+        self.assertEqual((codec.name, codec.level), ('gzip', 6))
+        self.assertEqual(archive_name(codec), 'blueprint-files.tar.gz.gpg')
+
+    def test_codec_of_the_metadata(self):
+        codec = codec_from_metadata({'compression': {'codec': 'zstd', 'level': 0, 'threads': 4}})
+        self.assertEqual(codec.describe(), {'codec': 'zstd', 'level': 0, 'threads': 4})
+        self.assertEqual(archive_name(codec), 'blueprint-files.tar.zst.gpg')
+
+    def test_parallel_gzip_is_gzip(self):
+        data = random.Random(1).randbytes(BLOCK_SIZE) * 3 + b'tail'
+        sink = io.BytesIO()
+        ParallelGzipCodec(1, 2).compress(io.BytesIO(data), sink)
+        self.assertEqual(gzip.decompress(sink.getvalue()), data)
+
+    def test_parallel_gzip_without_compression(self):
+        sink = io.BytesIO()
+        ParallelGzipCodec(0, 2).compress(io.BytesIO(b'data'), sink)
+        self.assertEqual(gzip.decompress(sink.getvalue()), b'data')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from blobstore import DirectoryBlobstore
+from dedup import GC_GRACE_CHECKS, MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, ChunkStore, chunk_stream, \
+    dedup_directory_to_blobstore, load_chunk_key, restore_dedup_backup
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+class ChunkStreamTest(unittest.TestCase):
+    def test_chunks_make_up_the_stream(self):
+        data = random_bytes(8 * 1024 * 1024, 1)
+        chunks = list(chunk_stream(io.BytesIO(data)))
+        self.assertEqual(b''.join(chunks), data)
+        self.assertTrue(all(MIN_CHUNK_SIZE <= len(chunk) <= MAX_CHUNK_SIZE for chunk in chunks[:-1]))
+
+    def test_insertion_only_changes_the_chunks_around_it(self):
+        data = random_bytes(8 * 1024 * 1024, 2)
+        chunks = list(chunk_stream(io.BytesIO(data)))
+        shifted = list(chunk_stream(io.BytesIO(data[:1000] + b'inserted' + data[1000:])))
+        self.assertGreater(len(chunks), 3)
+        self.assertNotEqual(chunks[0], shifted[0])
+        self.assertEqual(chunks[2:], shifted[2:])
+
+    def test_empty_stream_has_no_chunks(self):
+        self.assertEqual(list(chunk_stream(io.BytesIO(b''))), [])
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.state_directory = os.path.join(self.root, 'state')
+        self.blobstore = DirectoryBlobstore(os.path.join(self.root, 'blobstore'), os.path.join(self.root, 'spool'))
+        self.key = load_chunk_key(self.state_directory)
+
+    def store(self):
+        return ChunkStore(self.blobstore, self.key, self.state_directory)
+
+    def backup(self, backup_guid, content):
+        directory = os.path.join(self.root, 'files')
+        shutil.rmtree(directory, ignore_errors=True)
+        os.mkdir(directory)
+        with open(os.path.join(directory, 'file'), 'wb') as f:
+            f.write(content)
+        metadata = dedup_directory_to_blobstore(self.blobstore, self.store(), directory, 'secret', backup_guid, 2)
+        self.blobstore.upload_json(metadata, '{}/blueprint-metadata.json'.format(backup_guid))
+        return metadata
+
+    def restore(self, backup_guid, metadata):
+        directory = os.path.join(self.root, 'restored-{}'.format(backup_guid))
+        os.mkdir(directory)
+        restore_dedup_backup(self.blobstore, backup_guid, metadata, 'secret', directory, 2)
+        with open(os.path.join(directory, 'file'), 'rb') as f:
+            return f.read()
+
+    def test_key_is_kept(self):
+        self.assertEqual(load_chunk_key(self.state_directory), self.key)
+
+    def test_equal_chunks_are_stored_once(self):
+        store = self.store()
+        address, pack_id, size = store.store(b'chunk')
+        self.assertGreater(size, 0)
+        self.assertEqual(store.store(b'chunk'), (address, pack_id, 0))
+        store.flush()
+        self.assertEqual(self.store().store(b'chunk'), (address, pack_id, 0))
+        self.assertEqual(self.store().load(address, pack_id), b'chunk')
+
+    def test_backup_of_unchanged_files_uploads_no_chunks(self):
+        content = random_bytes(3 * 1024 * 1024, 3)
+        metadata = self.backup('first', content)
+        self.assertEqual(metadata['uploadedChunks'], metadata['chunks'])
+        self.assertEqual(self.restore('first', metadata), content)
+        # +-> The tar header holds the mtime of the file, so only the first chunk may differ
+        os.utime(os.path.join(self.root, 'files', 'file'), (0, 0))
+        metadata = self.backup('second', content)
+        self.assertLessEqual(metadata['uploadedChunks'], 1)
+        self.assertEqual(self.restore('second', metadata), content)
+
+    def test_garbage_collection_removes_the_chunks_of_deleted_backups(self):
+        self.backup('deleted', random_bytes(2 * 1024 * 1024, 4))
+        content = random_bytes(2 * 1024 * 1024, 5)
+        metadata = self.backup('live', content)
+        store = self.store()
+        for _ in range(GC_GRACE_CHECKS - 1):
+            self.assertEqual(store.collect_garbage(lambda backup_guid: backup_guid == 'live'), 0)
+        self.assertGreater(store.collect_garbage(lambda backup_guid: backup_guid == 'live'), 0)
+        self.assertEqual(self.restore('live', metadata), content)
+        self.assertEqual(self.store().collect_garbage(lambda backup_guid: backup_guid == 'live'), 0)
+
+    def test_garbage_collection_keeps_backups_that_are_live_again(self):
+        content = random_bytes(1024 * 1024, 6)
+        metadata = self.backup('flaky', content)
+        store = self.store()
+        for _ in range(GC_GRACE_CHECKS - 1):
+            store.collect_garbage(lambda backup_guid: False)
+        store.collect_garbage(lambda backup_guid: True)
+        self.assertEqual(store.collect_garbage(lambda backup_guid: False), 0)
+        self.assertEqual(self.restore('flaky', metadata), content)
+
+    def test_check_known_drops_the_index_if_chunks_are_missing(self):
+        store = self.store()
+        store.store(b'chunk')
+        store.flush()
+        self.assertEqual(self.store().check_known(), 0)
+        shutil.rmtree(os.path.join(self.root, 'blobstore'))
+        store = self.store()
+        self.assertEqual(store.check_known(), 1)
+        self.assertGreater(store.store(b'chunk')[2], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
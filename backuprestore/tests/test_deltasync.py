@@ -0,0 +1,70 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from deltasync import TEMPORARY_PREFIX, sync_directories
+
+
+def write(path, data='data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+class DeltaSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.source = os.path.join(self.root, 'source')
+        self.target = os.path.join(self.root, 'target')
+        write(os.path.join(self.source, 'unchanged'))
+        write(os.path.join(self.source, 'changed'), 'new')
+        write(os.path.join(self.source, 'directory', 'file'))
+        os.symlink('unchanged', os.path.join(self.source, 'link'))
+        os.chmod(os.path.join(self.source, 'unchanged'), 0o640)
+
+    def assert_same(self):
+        result = subprocess.run(['diff', '-r', '--no-dereference', self.source, self.target],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.stdout, '')
+        for directory, names, files in os.walk(self.source):
+            for name in names + files:
+                source = os.lstat(os.path.join(directory, name))
+                target = os.lstat(os.path.join(self.target, os.path.relpath(os.path.join(directory, name),
+                                                                             self.source)))
+                self.assertEqual((source.st_mode, source.st_mtime_ns), (target.st_mode, target.st_mtime_ns), name)
+
+    def test_sync_into_an_empty_directory_copies_everything(self):
+        os.mkdir(self.target)
+        summary = sync_directories(self.source, self.target, 2)
+        self.assertEqual(summary['copied'], 4)
+        self.assert_same()
+
+    def test_sync_only_copies_what_differs(self):
+        shutil.copytree(self.source, self.target, symlinks=True)
+        write(os.path.join(self.target, 'changed'), 'old')
+        write(os.path.join(self.target, 'extraneous', 'file'))
+        write(os.path.join(self.target, TEMPORARY_PREFIX + '1'), 'leftover')
+        summary = sync_directories(self.source, self.target, 2)
+        self.assertEqual((summary['copied'], summary['unchanged'], summary['deleted']), (1, 3, 2))
+        self.assert_same()
+
+    def test_touched_file_with_the_same_content_is_compared(self):
+        shutil.copytree(self.source, self.target, symlinks=True)
+        os.utime(os.path.join(self.target, 'unchanged'), (0, 0))
+        summary = sync_directories(self.source, self.target, 2)
+        self.assertEqual((summary.get('copied', 0), summary['compared']), (0, 1))
+        self.assert_same()
+
+    def test_entries_whose_type_changed_are_replaced(self):
+        os.mkdir(self.target)
+        write(os.path.join(self.target, 'directory'), 'a file')
+        write(os.path.join(self.target, 'link', 'file'))
+        sync_directories(self.source, self.target, 2)
+        self.assert_same()
+
+
+if __name__ == '__main__':
+    unittest.main()
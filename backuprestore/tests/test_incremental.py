@@ -0,0 +1,90 @@
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+from blobstore import DirectoryBlobstore
+from incremental import IncrementalBackup, restore_incremental_backup
+
+METADATA_NAME = 'blueprint-metadata.json'
+
+
+def write(path, data='data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+class IncrementalBackupTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.directory = os.path.join(self.root, 'files')
+        os.mkdir(self.directory)
+        self.blobstore = DirectoryBlobstore(os.path.join(self.root, 'blobstore'), os.path.join(self.root, 'spool'))
+        self.backups = 0
+
+    def backup(self, max_chain_length=5):
+        self.backups += 1
+        backup_guid = 'backup-{}'.format(self.backups)
+        incremental_backup = IncrementalBackup(self.blobstore, self.directory, os.path.join(self.root, 'state'),
+                                               max_chain_length)
+        metadata = incremental_backup.run(backup_guid, 'secret-{}'.format(self.backups), 'files.tar.gz.gpg', 1024,
+                                          parent=incremental_backup.load_parent())
+        self.blobstore.upload_json(metadata, '{}/{}'.format(backup_guid, METADATA_NAME))
+        incremental_backup.commit()
+        return backup_guid, metadata
+
+    def assert_restores(self, backup_guid, metadata):
+        target = os.path.join(self.root, 'restored-{}'.format(backup_guid))
+        os.mkdir(target)
+        restore_incremental_backup(self.blobstore, backup_guid, metadata, 'secret-{}'.format(self.backups), target,
+                                   METADATA_NAME)
+        comparison = filecmp.dircmp(self.directory, target)
+        self.assertEqual((comparison.left_only, comparison.right_only, comparison.diff_files), ([], [], []))
+        for name in comparison.common_dirs:
+            sub = comparison.subdirs[name]
+            self.assertEqual((sub.left_only, sub.right_only, sub.diff_files), ([], [], []))
+
+    def test_levels_only_archive_the_changes(self):
+        write(os.path.join(self.directory, 'kept'))
+        write(os.path.join(self.directory, 'changed'))
+        _, metadata = self.backup()
+        self.assertEqual((metadata['level'], metadata['changed']), (0, 2))
+        write(os.path.join(self.directory, 'changed'), 'other data')
+        _, metadata = self.backup()
+        self.assertEqual((metadata['level'], metadata['changed'], metadata['parent']), (1, 1, 'backup-1'))
+
+    def test_chain_restores_deletions_and_type_changes(self):
+        write(os.path.join(self.directory, 'deleted'))
+        write(os.path.join(self.directory, 'directory', 'inner'))
+        write(os.path.join(self.directory, 'file'))
+        self.backup()
+        os.remove(os.path.join(self.directory, 'deleted'))
+        shutil.rmtree(os.path.join(self.directory, 'directory'))
+        write(os.path.join(self.directory, 'directory'), 'now a file')
+        os.remove(os.path.join(self.directory, 'file'))
+        write(os.path.join(self.directory, 'file', 'inner'), 'now a directory')
+        backup_guid, metadata = self.backup()
+        self.assertEqual((metadata['level'], metadata['deleted']), (1, 4))
+        self.assert_restores(backup_guid, metadata)
+
+    def test_full_backup_after_the_maximum_chain_length(self):
+        write(os.path.join(self.directory, 'file'))
+        self.backup(max_chain_length=2)
+        _, metadata = self.backup(max_chain_length=2)
+        self.assertEqual(metadata['level'], 1)
+        _, metadata = self.backup(max_chain_length=2)
+        self.assertEqual((metadata['level'], metadata['parent']), (0, None))
+
+    def test_full_backup_if_the_parent_is_gone(self):
+        write(os.path.join(self.directory, 'file'))
+        self.backup()
+        self.blobstore.remove_file('backup-1/blueprint-manifest.json.gz.gpg')
+        _, metadata = self.backup()
+        self.assertEqual(metadata['level'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from manifest import TYPE_DIRECTORY, TYPE_FILE, TYPE_SYMLINK, compare, scan_directory
+
+
+def write(path, data='data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+class CompareTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def manifest(self):
+        return [entry for status, entry in compare([], scan_directory(self.directory), self.directory)]
+
+    def changes(self, previous):
+        return [(status, entry.path, entry.type)
+                for status, entry in compare(previous, scan_directory(self.directory), self.directory)
+                if status != 'unchanged']
+
+    def test_scan_orders_entries_by_path_components(self):
+        write(os.path.join(self.directory, 'a', 'b'))
+        write(os.path.join(self.directory, 'a-b'))
+        write(os.path.join(self.directory, 'a.b'))
+        os.symlink('a-b', os.path.join(self.directory, 'z'))
+        self.assertEqual([(entry.path, entry.type) for entry in scan_directory(self.directory)],
+                         [('a', TYPE_DIRECTORY), ('a/b', TYPE_FILE), ('a-b', TYPE_FILE), ('a.b', TYPE_FILE),
+                          ('z', TYPE_SYMLINK)])
+
+    def test_new_changed_and_deleted_entries(self):
+        write(os.path.join(self.directory, 'kept'))
+        write(os.path.join(self.directory, 'changed'))
+        write(os.path.join(self.directory, 'deleted'))
+        previous = self.manifest()
+        write(os.path.join(self.directory, 'changed'), 'other data')
+        os.remove(os.path.join(self.directory, 'deleted'))
+        write(os.path.join(self.directory, 'new'))
+        self.assertEqual(self.changes(previous), [('changed', 'changed', TYPE_FILE), ('deleted', 'deleted', TYPE_FILE),
+                                                  ('new', 'new', TYPE_FILE)])
+
+    def test_touched_file_with_the_same_content_is_unchanged(self):
+        write(os.path.join(self.directory, 'file'))
+        previous = self.manifest()
+        os.utime(os.path.join(self.directory, 'file'), (0, 0))
+        self.assertEqual(self.changes(previous), [])
+
+    def test_unchanged_entries_keep_their_digest(self):
+        write(os.path.join(self.directory, 'file'))
+        previous = self.manifest()
+        self.assertEqual([entry.digest for status, entry in compare(previous, scan_directory(self.directory),
+                                                                    self.directory)],
+                         [previous[0].digest])
+
+    def test_directory_replaced_by_file_is_deleted_first(self):
+        write(os.path.join(self.directory, 'entry', 'inner'))
+        previous = self.manifest()
+        shutil.rmtree(os.path.join(self.directory, 'entry'))
+        write(os.path.join(self.directory, 'entry'))
+        self.assertEqual(self.changes(previous), [('deleted', 'entry', TYPE_DIRECTORY), ('new', 'entry', TYPE_FILE),
+                                                  ('deleted', 'entry/inner', TYPE_FILE)])
+
+    def test_file_replaced_by_directory_is_deleted_first(self):
+        write(os.path.join(self.directory, 'entry'))
+        previous = self.manifest()
+        os.remove(os.path.join(self.directory, 'entry'))
+        write(os.path.join(self.directory, 'entry', 'inner'))
+        self.assertEqual(self.changes(previous), [('deleted', 'entry', TYPE_FILE), ('new', 'entry', TYPE_DIRECTORY),
+                                                  ('new', 'entry/inner', TYPE_FILE)])
+
+    def test_file_replaced_by_symlink_is_deleted_first(self):
+        write(os.path.join(self.directory, 'entry'))
+        previous = self.manifest()
+        os.remove(os.path.join(self.directory, 'entry'))
+        os.symlink('elsewhere', os.path.join(self.directory, 'entry'))
+        self.assertEqual(self.changes(previous), [('deleted', 'entry', TYPE_FILE), ('new', 'entry', TYPE_SYMLINK)])
+
+
+if __name__ == '__main__':
+    unittest.main()
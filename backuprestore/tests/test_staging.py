@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import staging
+from staging import StagingDirectory
+
+
+def write(path, data='data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class StagingDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.target = os.path.join(self.root, 'files')
+        write(os.path.join(self.target, 'file'), 'old')
+        os.chmod(self.target, 0o750)
+
+    def test_prepare_creates_an_empty_directory_like_the_target(self):
+        path = StagingDirectory(self.target + '/').prepare()
+        self.assertEqual(path, self.target + '.staging')
+        self.assertEqual(os.listdir(path), [])
+        self.assertEqual(os.stat(path).st_mode & 0o7777, 0o750)
+
+    def test_prepare_removes_leftovers(self):
+        write(os.path.join(self.target + '.staging', 'leftover'))
+        write(os.path.join(self.target + '.previous', 'leftover'))
+        StagingDirectory(self.target).prepare()
+        self.assertEqual(os.listdir(self.target + '.staging'), [])
+        self.assertFalse(os.path.exists(self.target + '.previous'))
+
+    def test_swap_keeps_the_previous_contents_until_removed(self):
+        directory = StagingDirectory(self.target)
+        write(os.path.join(directory.prepare(), 'file'), 'new')
+        directory.swap()
+        self.assertEqual(read(os.path.join(self.target, 'file')), 'new')
+        self.assertEqual(read(os.path.join(self.target + '.previous', 'file')), 'old')
+        self.assertFalse(os.path.exists(self.target + '.staging'))
+        directory.remove_previous()
+        self.assertFalse(os.path.exists(self.target + '.previous'))
+
+    def test_swap_without_exchange(self):
+        directory = StagingDirectory(self.target)
+        write(os.path.join(directory.prepare(), 'file'), 'new')
+        with mock.patch.object(staging, 'exchange', return_value=False):
+            directory.swap()
+        self.assertEqual(read(os.path.join(self.target, 'file')), 'new')
+        self.assertEqual(read(os.path.join(self.target + '.previous', 'file')), 'old')
+
+    def test_failed_swap_keeps_the_target(self):
+        directory = StagingDirectory(self.target)
+        directory.prepare()
+        renamed = []
+
+        def rename(source, target):
+            if source == directory.path:
+                raise OSError('rename failed')
+            renamed.append(source)
+            os.replace(source, target)
+
+        with mock.patch.object(staging, 'exchange', return_value=False), mock.patch.object(os, 'rename', rename):
+            self.assertRaises(OSError, directory.swap)
+        self.assertEqual(read(os.path.join(self.target, 'file')), 'old')
+        self.assertEqual(renamed, [self.target, directory.previous])
+
+    def test_swap_into_a_missing_target(self):
+        shutil.rmtree(self.target)
+        directory = StagingDirectory(self.target)
+        write(os.path.join(directory.prepare(), 'file'), 'new')
+        directory.swap()
+        self.assertEqual(read(os.path.join(self.target, 'file')), 'new')
+        self.assertFalse(os.path.exists(self.target + '.previous'))
+
+    def test_seeded_staging_directory_is_a_copy_of_the_target(self):
+        def clone(source, target):
+            shutil.copytree(source, target, dirs_exist_ok=True)
+            return True
+
+        directory = StagingDirectory(self.target)
+        with mock.patch.object(staging, 'clone_directory', clone):
+            path = directory.prepare(seed=True)
+        self.assertTrue(directory.seeded)
+        self.assertEqual(read(os.path.join(path, 'file')), 'old')
+
+    def test_staging_directory_is_empty_if_the_target_cannot_be_cloned(self):
+        def clone(source, target):
+            write(os.path.join(target, 'partial'))
+            return False
+
+        directory = StagingDirectory(self.target)
+        with mock.patch.object(staging, 'clone_directory', clone):
+            path = directory.prepare(seed=True)
+        self.assertFalse(directory.seeded)
+        self.assertEqual(os.listdir(path), [])
+        self.assertEqual(os.stat(path).st_mode & 0o7777, 0o750)
+
+    def test_discard(self):
+        directory = StagingDirectory(self.target)
+        directory.prepare()
+        directory.discard()
+        self.assertFalse(os.path.exists(directory.path))
+        self.assertEqual(read(os.path.join(self.target, 'file')), 'old')
+
+
+if __name__ == '__main__':
+    unittest.main()
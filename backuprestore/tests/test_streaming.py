@@ -0,0 +1,130 @@
+import hashlib
+import io
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from blobstore import DirectoryBlobstore
+from journal import Journal
+from streaming import MultipartUpload, StreamingError, decrypt_file, stream_blobstore_to_directory, \
+    stream_directory_to_blobstore
+
+PART_SIZE = 64 * 1024
+
+
+class RecordingBlobstore(DirectoryBlobstore):
+    """Records the uploaded blobs and fails the upload of the blob named by `failing`."""
+
+    def __init__(self, directory, spool_directory, failing=None):
+        super().__init__(directory, spool_directory)
+        self.failing = failing
+        self.uploaded = []
+
+    def upload_file(self, path, blob_name):
+        if blob_name == self.failing:
+            return False
+        self.uploaded.append(blob_name)
+        return super().upload_file(path, blob_name)
+
+
+class MultipartUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.data = random.Random(1).randbytes(4 * PART_SIZE + 100)
+
+    def blobstore(self, failing=None):
+        return RecordingBlobstore(os.path.join(self.root, 'blobstore'), os.path.join(self.root, 'spool'), failing)
+
+    def journal(self):
+        return Journal(os.path.join(self.root, 'state'), 'backup', 'guid')
+
+    def decrypt_parts(self, blobstore, parts):
+        data = b''
+        for part in parts:
+            path = os.path.join(self.root, 'part')
+            decrypt_file(blobstore.blob_path('guid/' + part['name']), path, 'secret')
+            with open(path, 'rb') as f:
+                data += f.read()
+        return data
+
+    def test_parts_make_up_the_stream(self):
+        blobstore = self.blobstore()
+        upload = MultipartUpload(blobstore, 'guid/archive', PART_SIZE)
+        parts = upload.upload(io.BytesIO(self.data))
+        self.assertEqual([part['size'] for part in parts], [PART_SIZE] * 4 + [100])
+        self.assertEqual(upload.digest.hexdigest(), hashlib.sha256(self.data).hexdigest())
+        joined = b''
+        for part in parts:
+            with open(blobstore.blob_path('guid/' + part['name']), 'rb') as f:
+                content = f.read()
+            self.assertEqual(hashlib.sha256(content).hexdigest(), part['sha256'])
+            joined += content
+        self.assertEqual(joined, self.data)
+
+    def test_retry_skips_the_parts_uploaded_before(self):
+        failing = self.blobstore('guid/archive.part-00002')
+        upload = MultipartUpload(failing, 'guid/archive', PART_SIZE, 'secret', self.journal())
+        self.assertRaises(StreamingError, upload.upload, io.BytesIO(self.data))
+        self.assertEqual(failing.uploaded, ['guid/archive.part-00000', 'guid/archive.part-00001'])
+
+        blobstore = self.blobstore()
+        parts = MultipartUpload(blobstore, 'guid/archive', PART_SIZE, 'secret', self.journal()).upload(
+            io.BytesIO(self.data))
+        self.assertEqual(blobstore.uploaded, ['guid/archive.part-00002', 'guid/archive.part-00003',
+                                              'guid/archive.part-00004'])
+        self.assertEqual(self.decrypt_parts(blobstore, parts), self.data)
+
+    def test_retry_uploads_the_parts_whose_slice_changed(self):
+        MultipartUpload(self.blobstore(), 'guid/archive', PART_SIZE, 'secret', self.journal()).upload(
+            io.BytesIO(self.data))
+        changed = self.data[:PART_SIZE + 10] + b'changed' + self.data[PART_SIZE + 17:]
+        blobstore = self.blobstore()
+        parts = MultipartUpload(blobstore, 'guid/archive', PART_SIZE, 'secret', self.journal()).upload(
+            io.BytesIO(changed))
+        self.assertEqual(blobstore.uploaded, ['guid/archive.part-00001'])
+        self.assertEqual(self.decrypt_parts(blobstore, parts), changed)
+
+
+class StreamDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.directory = os.path.join(self.root, 'files')
+        os.makedirs(os.path.join(self.directory, 'directory'))
+        with open(os.path.join(self.directory, 'directory', 'file'), 'wb') as f:
+            f.write(random.Random(2).randbytes(3 * PART_SIZE))
+        self.blobstore = DirectoryBlobstore(os.path.join(self.root, 'blobstore'), os.path.join(self.root, 'spool'))
+
+    def round_trip(self, resumable):
+        metadata = stream_directory_to_blobstore(self.blobstore, self.directory, 'secret', 'guid/archive.tar.gz.gpg',
+                                                 PART_SIZE, resumable=resumable)
+        target = os.path.join(self.root, 'restored')
+        os.mkdir(target)
+        stream_blobstore_to_directory(self.blobstore, 'guid', metadata, target, 'secret')
+        self.assertEqual(subprocess.run(['diff', '-r', self.directory, target]).returncode, 0)
+        return metadata
+
+    def test_parts_are_one_encrypted_archive(self):
+        metadata = self.round_trip(False)
+        self.assertNotIn('encryption', metadata)
+        joined = os.path.join(self.root, 'joined.gpg')
+        with open(joined, 'wb') as f:
+            for part in metadata['parts']:
+                with open(self.blobstore.blob_path('guid/' + part['name']), 'rb') as source:
+                    f.write(source.read())
+        decrypt_file(joined, os.path.join(self.root, 'joined.tar.gz'), 'secret')
+        listing = subprocess.run(['tar', '-tzf', os.path.join(self.root, 'joined.tar.gz')], stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout.split()
+        self.assertIn('./directory/file', listing)
+
+    def test_resumable_parts_are_encrypted_one_by_one(self):
+        metadata = self.round_trip(True)
+        self.assertEqual(metadata['encryption'], 'parts')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from volumepool import VolumePool, VolumePoolError, wipe_directory
+
+
+class FakeClient:
+    """Creates volumes that can be attached to any instance and records the calls."""
+
+    logger = logging.getLogger('volumepool')
+
+    def __init__(self):
+        self.calls = []
+        self.volumes = 0
+        self.attachments = {}
+        self.failing = set()
+
+    def create_volume(self, size):
+        self.calls.append(('create_volume', size))
+        self.volumes += 1
+        return SimpleNamespace(id='volume-{}'.format(self.volumes), size=size)
+
+    def delete_volume(self, volume_id):
+        self.calls.append(('delete_volume', volume_id))
+        return True
+
+    def create_attachment(self, volume_id, instance_id):
+        self.calls.append(('create_attachment', volume_id, instance_id))
+        if 'create_attachment' in self.failing:
+            return None
+        self.attachments[volume_id] = instance_id
+        return SimpleNamespace(volume_id=volume_id, instance_id=instance_id)
+
+    def delete_attachment(self, volume_id, instance_id):
+        self.calls.append(('delete_attachment', volume_id, instance_id))
+        self.attachments.pop(volume_id, None)
+        return True
+
+    def get_mountpoint(self, volume_id):
+        return '/dev/{}'.format(volume_id) if volume_id in self.attachments else None
+
+    def format_device(self, device):
+        self.calls.append(('format_device', device))
+        return True
+
+    def unmount_device(self, device):
+        self.calls.append(('unmount_device', device))
+        return True
+
+    def called(self, name):
+        return [call[1:] for call in self.calls if call[0] == name]
+
+
+class VolumePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.client = FakeClient()
+
+    def pool(self, instance_id='instance', max_volumes=1, max_idle=3600, state_directory='state', **kwargs):
+        return VolumePool(self.client, instance_id, os.path.join(self.root, state_directory), max_volumes, max_idle,
+                          **kwargs)
+
+    def test_given_back_volume_is_leased_again(self):
+        lease = self.pool().lease(10)
+        self.assertEqual((lease.volume_id, lease.size, lease.mountpoint), ('volume-1', 10, '/dev/volume-1'))
+        self.pool().give_back(lease)
+        self.assertEqual(self.pool().lease(5).volume_id, 'volume-1')
+        self.assertEqual(self.client.called('create_volume'), [(10,)])
+        self.assertEqual(self.client.called('format_device'), [('/dev/volume-1',)])
+
+    def test_leased_volume_is_not_leased_twice(self):
+        first = self.pool().lease(10)
+        second = self.pool().lease(10)
+        self.assertNotEqual(first.volume_id, second.volume_id)
+
+    def test_volume_that_is_too_small_is_not_leased(self):
+        self.pool().give_back(self.pool().lease(5))
+        self.assertEqual(self.pool(max_volumes=2).lease(10).volume_id, 'volume-2')
+
+    def test_surplus_volume_is_deleted(self):
+        pool = self.pool()
+        first, second = pool.lease(10), pool.lease(10)
+        pool.give_back(first)
+        pool.give_back(second)
+        self.assertEqual(self.client.called('delete_volume'), [(second.volume_id,)])
+
+    def test_idle_volume_is_evicted(self):
+        pool = self.pool(max_idle=0)
+        pool.give_back(pool.lease(10))
+        time.sleep(0.01)
+        pool.reconcile()
+        self.assertEqual(self.client.called('delete_volume'), [('volume-1',)])
+
+    def test_detached_volume_is_attached_again(self):
+        pool = self.pool()
+        pool.give_back(pool.lease(10))
+        self.client.attachments.clear()
+        self.assertEqual(pool.lease(10).volume_id, 'volume-1')
+        self.assertEqual(self.client.called('create_attachment')[-1], ('volume-1', 'instance'))
+
+    def test_volume_that_cannot_be_attached_is_dropped(self):
+        pool = self.pool()
+        pool.give_back(pool.lease(10))
+        self.client.attachments.clear()
+        self.client.failing.add('create_attachment')
+        self.assertRaises(VolumePoolError, pool.lease, 10)
+        self.assertEqual(self.client.called('delete_volume'), [('volume-1',), ('volume-2',)])
+
+    def test_lease_of_a_process_that_is_gone_is_recovered(self):
+        pool = self.pool()
+        pool.lease(10)
+        with pool._state() as state:
+            state['volumes'][0]['leasedBy'] = 2 ** 22 + 1
+        self.assertEqual(pool.lease(10).volume_id, 'volume-1')
+        self.assertEqual(self.client.called('unmount_device'), [('/dev/volume-1',)])
+
+    def test_volumes_of_a_previous_instance_are_deleted(self):
+        pool = self.pool(instance_id='previous')
+        pool.give_back(pool.lease(10))
+        self.pool().reconcile()
+        self.assertEqual(self.client.called('delete_attachment'), [('volume-1', 'previous')])
+        self.assertEqual(self.client.called('delete_volume'), [('volume-1',)])
+        self.assertEqual(self.pool().lease(10).volume_id, 'volume-2')
+
+    def test_state_of_the_previous_location_is_taken_over(self):
+        pool = self.pool(instance_id='previous', state_directory='ephemeral')
+        pool.give_back(pool.lease(10))
+        self.pool(previous_state_directory=os.path.join(self.root, 'ephemeral')).reconcile()
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'ephemeral', 'pool.json')))
+        self.assertEqual(self.client.called('delete_volume'), [('volume-1',)])
+
+
+class WipeDirectoryTest(unittest.TestCase):
+    def test_everything_but_lost_and_found_is_removed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name in ('lost+found', 'directory'):
+            os.mkdir(os.path.join(directory, name))
+        open(os.path.join(directory, 'directory', 'file'), 'w').close()
+        os.symlink('directory', os.path.join(directory, 'link'))
+        wipe_directory(directory)
+        self.assertEqual(os.listdir(directory), ['lost+found'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from waiting import BackoffPolicy, LibraryClock, PollingClient, SerializedClient, parse_monit_summary, wait_until
+
+SUMMARY = """The Monit daemon 5.2.5 uptime: 1h 2m
+
+Process 'blueprint'                 running
+Process 'agent'                     not monitored
+System 'system_localhost'           running
+"""
+
+SUMMARY_TABLE = """Monit 5.23.0 uptime: 3d 2h 14m
+┌─────────────────────────────────┬────────────────────────────┬───────────────┐
+│ Service Name                    │ Status                     │ Type          │
+├─────────────────────────────────┼────────────────────────────┼───────────────┤
+│ blueprint                       │ OK                         │ Process       │
+│ agent                           │ Not monitored              │ Process       │
+│ system_localhost                │ OK                         │ System        │
+└─────────────────────────────────┴────────────────────────────┴───────────────┘
+"""
+
+SUMMARY_WITHOUT_BORDERS = """Monit 5.23.0 uptime: 3d 2h 14m
+ Service Name                     Status                      Type
+ blueprint                        Does not exist              Process
+ agent                            OK                          Process
+ system_localhost                 OK                          System
+"""
+
+
+class ParseMonitSummaryTest(unittest.TestCase):
+    def test_old_format(self):
+        self.assertEqual(parse_monit_summary(SUMMARY), {'blueprint': 'running', 'agent': 'not monitored'})
+
+    def test_table(self):
+        self.assertEqual(parse_monit_summary(SUMMARY_TABLE), {'blueprint': 'running', 'agent': 'not monitored'})
+
+    def test_table_without_borders(self):
+        self.assertEqual(parse_monit_summary(SUMMARY_WITHOUT_BORDERS),
+                         {'blueprint': 'does not exist', 'agent': 'running'})
+
+    def test_empty_output(self):
+        self.assertEqual(parse_monit_summary(''), {})
+
+
+class WaitUntilTest(unittest.TestCase):
+    def test_delays_back_off_up_to_the_maximum(self):
+        delays = BackoffPolicy(0.5, 4, jitter=0).delays()
+        self.assertEqual([next(delays) for _ in range(6)], [0.5, 1, 2, 4, 4, 4])
+
+    def test_jitter_stays_within_its_bounds(self):
+        delays = BackoffPolicy(1, 1, jitter=0.2).delays()
+        self.assertTrue(all(0.8 <= next(delays) <= 1.2 for _ in range(100)))
+
+    def test_waits_until_the_condition_holds(self):
+        results = iter([False, False, True])
+        sleeps = []
+        self.assertTrue(wait_until(lambda: next(results), BackoffPolicy(0.5, 4, jitter=0), sleeps.append))
+        self.assertEqual(sleeps, [0.5, 1])
+
+    def test_gives_up_after_the_timeout(self):
+        self.assertFalse(wait_until(lambda: False, BackoffPolicy(0.01, 0.01, timeout=0.05)))
+
+
+class FakeClient:
+    """Sleeps through the clock like the library does while it waits for a resource."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.active = 0
+        self.overlaps = 0
+
+    def _enter(self):
+        with self.lock:
+            self.active += 1
+            self.overlaps += self.active > 1
+
+    def _leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def create_volume(self, size):
+        self._enter()
+        self._leave()
+        self.clock.sleep(0.2)
+        self._enter()
+        self._leave()
+        return size
+
+    def upload_to_blobstore(self, path, blob_name):
+        self._enter()
+        time.sleep(0.1)
+        self._leave()
+        return True
+
+
+class SerializedClientTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = LibraryClock()
+        self.client = FakeClient(self.clock)
+
+    def test_calls_are_made_one_at_a_time_but_their_waits_overlap(self):
+        serialized = PollingClient(SerializedClient(self.client, self.clock), self.clock)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertEqual(list(executor.map(serialized.create_volume, range(4))), [0, 1, 2, 3])
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual(self.client.overlaps, 0)
+        self.assertGreater(self.clock.polls, 0)
+
+    def test_transfers_are_not_serialized(self):
+        serialized = SerializedClient(self.client, self.clock)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda _: serialized.upload_to_blobstore('path', 'blob'), range(2)))
+        self.assertEqual(self.client.overlaps, 1)
+
+    def test_attributes_are_forwarded(self):
+        self.assertIs(SerializedClient(self.client, self.clock).clock, self.clock)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+MEBIBYTE = 1024 * 1024
+READ_SIZE = MEBIBYTE
+
+# +-> Pauses while the host is busy start short and double up to the maximum; after waiting for `MAX_WAIT` seconds in a
+#     row the data passes anyway, so that a host that never calms down does not stall the backup for good
+INITIAL_PAUSE = 0.25
+MAX_PAUSE = 4.0
+MAX_WAIT = 60.0
+CHECK_INTERVAL = 1.0
+
+IO_CLASSES = {'best-effort': ['-c', '2', '-n', '7'], 'idle': ['-c', '3']}
+
+
+class LoadMonitor:
+    """Tells whether the host is too busy for the backup to go on at full speed.
+
+    The host is busy if the 1-minute load average per CPU exceeds `max_load`, or if the average number of requests in
+    flight on the disk of `directory` (since the last check) exceeds `max_disk_queue`. Checks are made at most once per
+    `CHECK_INTERVAL` seconds and shared by all threads.
+    """
+
+    def __init__(self, directory, max_load=None, max_disk_queue=None):
+        self.max_load = max_load
+        self.max_disk_queue = max_disk_queue
+        self.cpus = os.cpu_count() or 1
+        self.stat_path = _disk_stat_path(directory) if max_disk_queue else None
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.busy = False
+        self.disk_sample = self._disk_sample()
+        self.pauses = 0
+        self.paused_seconds = 0.0
+
+    def _disk_sample(self):
+        if not self.stat_path:
+            return None
+        try:
+            with open(self.stat_path) as f:
+                # +-> The 11th field is the time (in ms) weighted by the number of requests in flight
+                return time.monotonic(), int(f.read().split()[10])
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _check(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked < CHECK_INTERVAL:
+                return self.busy
+            self.checked = now
+            busy = bool(self.max_load) and os.getloadavg()[0] / self.cpus > self.max_load
+            sample = self._disk_sample()
+            if sample and self.disk_sample:
+                elapsed = (sample[0] - self.disk_sample[0]) * 1000
+                if elapsed > 0 and (sample[1] - self.disk_sample[1]) / elapsed > self.max_disk_queue:
+                    busy = True
+            self.disk_sample = sample
+            self.busy = busy
+            return busy
+
+    def wait_while_busy(self):
+        waited = 0.0
+        pause = INITIAL_PAUSE
+        while waited < MAX_WAIT and self._check():
+            time.sleep(pause)
+            waited += pause
+            with self.lock:
+                self.pauses += 1
+                self.paused_seconds += pause
+            pause = min(pause * 2, MAX_PAUSE)
+
+    def to_json(self):
+        return {'maxLoad': self.max_load, 'maxDiskQueue': self.max_disk_queue, 'pauses': self.pauses,
+                'pausedSeconds': round(self.paused_seconds, 3)}
+
+
+class Throttle:
+    """Lets at most `rate` bytes per second pass (no limit if None) and waits while the monitor says the host is busy.
+
+    The throttle is shared by all threads of a stage, e.g. the concurrent part uploads, so the limit holds for all of
+    them together.
+    """
+
+    def __init__(self, rate=None, monitor=None):
+        self.rate = rate
+        self.monitor = monitor
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+        self.bytes = 0
+        self.throttled_seconds = 0.0
+
+    def consume(self, size):
+        if self.monitor:
+            self.monitor.wait_while_busy()
+        delay = 0
+        with self.lock:
+            self.bytes += size
+            if self.rate:
+                now = time.monotonic()
+                start = max(now, self.next_slot)
+                self.next_slot = start + size / self.rate
+                delay = start - now
+                self.throttled_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def copy(self, source, sink):
+        """Copies a stream at the throttled rate; a full pipe holds back the process that writes into `source`."""
+        for chunk in iter(lambda: source.read(READ_SIZE), b''):
+            self.consume(len(chunk))
+            sink.write(chunk)
+
+    def reader(self, stream):
+        return ThrottledReader(stream, self)
+
+    def to_json(self):
+        return {'rateLimit': self.rate, 'bytes': self.bytes, 'throttledSeconds': round(self.throttled_seconds, 3)}
+
+
+class ThrottledReader:
+    def __init__(self, stream, throttle):
+        self.stream = stream
+        self.throttle = throttle
+
+    def read(self, size=READ_SIZE):
+        data = self.stream.read(size)
+        if data:
+            self.throttle.consume(len(data))
+        return data
+
+
+class Throttling:
+    """The limits for reading the persistent disk and for uploading, and the priority of the backup.
+
+    Reading is limited where the files are archived, the upload where the blueprint specific formats hand files (parts,
+    chunks, manifests) to the blob store. Both are paused while the host is busy if a load threshold is set.
+    """
+
+    def __init__(self, directory, read_rate_limit=None, upload_rate_limit=None, max_load=None, max_disk_queue=None,
+                 nice=None, io_class=None):
+        self.monitor = LoadMonitor(directory, max_load, max_disk_queue) if max_load or max_disk_queue else None
+        self.read = None
+        self.upload = None
+        if read_rate_limit or self.monitor:
+            self.read = Throttle(read_rate_limit * MEBIBYTE if read_rate_limit else None, self.monitor)
+        if upload_rate_limit or self.monitor:
+            self.upload = Throttle(upload_rate_limit * MEBIBYTE if upload_rate_limit else None, self.monitor)
+        self.nice = nice
+        self.io_class = io_class
+        self.priority = {}
+
+    def lower_priority(self, logger):
+        """Lowers the CPU and I/O priority of this process; the archive pipeline's processes inherit them."""
+        if self.nice:
+            self.priority['nice'] = os.nice(self.nice)
+        if self.io_class:
+            ionice = shutil.which('ionice')
+            if ionice and subprocess.call([ionice] + IO_CLASSES[self.io_class] + ['-p', str(os.getpid())]) == 0:
+                self.priority['ioClass'] = self.io_class
+            else:
+                logger.warning('Could not set the I/O class {} of the backup.'.format(self.io_class))
+
+    def to_json(self):
+        return {
+            'read': self.read.to_json() if self.read else None,
+            'upload': self.upload.to_json() if self.upload else None,
+            'adaptive': self.monitor.to_json() if self.monitor else None,
+            'priority': self.priority
+        }
+
+
+def _disk_stat_path(directory):
+    """Returns the statistics file of the block device the directory is on, if the kernel provides one."""
+    try:
+        device = os.stat(directory).st_dev
+    except OSError:
+        return None
+    path = '/sys/dev/block/{}:{}/stat'.format(os.major(device), os.minor(device))
+    return path if os.path.exists(path) else None
@@ -0,0 +1,164 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import progress
+
+# +-> Index of the argument naming the local file a call reads or writes, its size is counted as the bytes moved
+TRANSFERRED_FILE_ARGUMENT = {
+    'upload_to_blobstore': 0,
+    'download_from_blobstore': 1,
+    'create_and_encrypt_tarball_of_directory': 1,
+    'decrypt_and_extract_tarball_of_directory': 0,
+}
+# +-> Calls writing that file while they run, its growth is reported as their progress
+WRITTEN_FILE_METHODS = ('download_from_blobstore', 'create_and_encrypt_tarball_of_directory')
+UNTIMED_METHODS = ('exit', 'initialize', 'finalize')
+
+
+class Step:
+    def __init__(self):
+        self.bytes = 0
+
+
+class Timings:
+    """Wall time, number of calls and bytes moved per step of a backup or restore.
+
+    Steps of the same name are summed up; calls running concurrently (e.g. part uploads) are each counted in full, so the
+    seconds of a step can exceed the duration of the whole operation. The throughput is given in bytes per second.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = time.time()
+        self.succeeded = False
+        self.lock = threading.Lock()
+        self.steps = collections.OrderedDict()
+
+    def record(self, name, seconds, transferred=0):
+        with self.lock:
+            step = self.steps.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+            step['calls'] += 1
+            step['seconds'] += seconds
+            step['bytes'] += transferred
+
+    @contextlib.contextmanager
+    def step(self, name, path=None):
+        """Times the enclosed block; the bytes it moved can be set on the yielded step.
+
+        The step is reported as the running one by the progress (see `progress`), `path` names a file the block writes.
+        """
+        step = Step()
+        started = time.monotonic()
+        progress.enter(name, path)
+        try:
+            yield step
+        finally:
+            progress.leave(name, path)
+            self.record(name, time.monotonic() - started, step.bytes)
+
+    def to_json(self):
+        with self.lock:
+            steps = collections.OrderedDict()
+            for name, step in self.steps.items():
+                steps[name] = dict(step, seconds=round(step['seconds'], 3))
+                if step['bytes'] and step['seconds']:
+                    steps[name]['throughput'] = int(step['bytes'] / step['seconds'])
+        return {
+            'operation': self.operation,
+            'startedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+            'duration': round(time.time() - self.started, 3),
+            'succeeded': self.succeeded,
+            'steps': steps
+        }
+
+    def to_prometheus(self):
+        document = self.to_json()
+        labels = 'operation="{}"'.format(self.operation)
+        lines = [
+            '# HELP blueprint_operation_duration_seconds Duration of the last backup or restore.',
+            '# TYPE blueprint_operation_duration_seconds gauge',
+            'blueprint_operation_duration_seconds{{{}}} {}'.format(labels, document['duration']),
+            '# HELP blueprint_operation_succeeded Whether the last backup or restore succeeded.',
+            '# TYPE blueprint_operation_succeeded gauge',
+            'blueprint_operation_succeeded{{{}}} {}'.format(labels, int(self.succeeded)),
+            '# HELP blueprint_operation_timestamp_seconds Start of the last backup or restore.',
+            '# TYPE blueprint_operation_timestamp_seconds gauge',
+            'blueprint_operation_timestamp_seconds{{{}}} {}'.format(labels, int(self.started)),
+        ]
+        for metric, field, description in (('step_seconds', 'seconds', 'Time spent in the step.'),
+                                           ('step_calls', 'calls', 'Number of calls of the step.'),
+                                           ('step_bytes', 'bytes', 'Bytes moved by the step.')):
+            lines.append('# HELP blueprint_{} {}'.format(metric, description))
+            lines.append('# TYPE blueprint_{} gauge'.format(metric))
+            for name, step in document['steps'].items():
+                lines.append('blueprint_{}{{{},step="{}"}} {}'.format(metric, labels, name, step[field]))
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedClient:
+    """Forwards everything to the IaaS client and records each method call as a step named like the method."""
+
+    def __init__(self, iaas_client, timings):
+        self._iaas_client = iaas_client
+        self._timings = timings
+
+    def __getattr__(self, name):
+        attribute = getattr(self._iaas_client, name)
+        if not callable(attribute) or name.startswith('_') or name in UNTIMED_METHODS:
+            return attribute
+
+        def timed(*args, **kwargs):
+            path = args[TRANSFERRED_FILE_ARGUMENT[name]] if name in WRITTEN_FILE_METHODS and len(args) > 1 else None
+            with self._timings.step(name, path) as step:
+                result = attribute(*args, **kwargs)
+                if result and name in TRANSFERRED_FILE_ARGUMENT:
+                    step.bytes = _file_size(args[TRANSFERRED_FILE_ARGUMENT[name]])
+            return result
+        return timed
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def _write_atomically(path, content):
+    with open(path + '.new', 'w') as f:
+        f.write(content)
+    os.replace(path + '.new', path)
+
+
+def merge_output(operation, key, document):
+    """Merges the document as `key` into `<log directory>/<operation>.output.json`, which the agent adds to the last
+    operation.
+    """
+    log_directory = os.environ.get('SF_BACKUP_RESTORE_LOG_DIRECTORY')
+    if log_directory:
+        path = os.path.join(log_directory, '{}.output.json'.format(operation))
+        output = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                output = json.load(f)
+        output[key] = document
+        _write_atomically(path, json.dumps(output))
+
+
+def export_timings(timings, logger, metrics_directory=None, **sections):
+    """Merges the timings and further sections into the output of the operation (see `merge_output`) and optionally
+    writes the timings in the Prometheus text format to `<metrics directory>/blueprint_<operation>.prom`.
+    """
+    try:
+        merge_output(timings.operation, 'timings', timings.to_json())
+        for key, document in sections.items():
+            merge_output(timings.operation, key, document)
+        if metrics_directory:
+            _write_atomically(os.path.join(metrics_directory, 'blueprint_{}.prom'.format(timings.operation)),
+                              timings.to_prometheus())
+    except (OSError, ValueError) as error:
+        logger.warning('Could not export the timings of the {}: {}'.format(timings.operation, error))
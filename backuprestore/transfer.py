@@ -0,0 +1,73 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import progress
+from streaming import download_verified
+
+# +-> Every part is tried this often before the transfer fails; the delay doubles after every failed attempt
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 2.0
+
+
+class TransferError(Exception):
+    pass
+
+
+class ParallelTransfer:
+    """Moves the parts of a large archive to or from the blob store, of which `workers` are transferred concurrently.
+
+    The library only transfers whole files, one stream each; a single stream to the object store rarely reaches the
+    available bandwidth, several concurrent ones do. Every part is a file of its own, named like its blob
+    (`<archive>.part-<index>`) in the local directory, as the archive was written as parts in the first place (see
+    `create_encrypted_archive`); nothing is cut out of or reassembled into a file of the whole archive. Each part is
+    retried on its own, its digest is checked while it is downloaded.
+    """
+
+    def __init__(self, blobstore, workers, attempts=MAX_ATTEMPTS):
+        self.blobstore = blobstore
+        self.workers = max(1, workers)
+        self.attempts = attempts
+
+    def _retry(self, transfer, description):
+        error = None
+        for attempt in range(self.attempts):
+            try:
+                if transfer():
+                    return
+            except Exception as attempt_error:
+                error = attempt_error
+            if attempt + 1 < self.attempts:
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+        raise TransferError('Could not {} after {} attempts{}.'.format(description, self.attempts,
+                                                                       ': {}'.format(error) if error else ''))
+
+    def _run(self, transfer, parts):
+        progress.expect(sum(part['size'] for part in parts))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(transfer, parts))
+        return sum(part['size'] for part in parts)
+
+    def upload(self, directory, blob_folder, parts):
+        """Uploads the part files of the directory into the blob folder; returns the number of bytes uploaded."""
+        def upload_part(part):
+            blob_name = '{}/{}'.format(blob_folder, part['name'])
+            self._retry(lambda: self.blobstore.upload_file(os.path.join(directory, part['name']), blob_name),
+                        'upload the part {}'.format(blob_name))
+            progress.advance(part['size'])
+
+        return self._run(upload_part, parts)
+
+    def download(self, blob_folder, parts, directory):
+        """Downloads the parts into files of the same names in the directory; returns the number of bytes downloaded."""
+        def download_part(part):
+            blob_name = '{}/{}'.format(blob_folder, part['name'])
+            path = os.path.join(directory, part['name'])
+            self._retry(lambda: download_verified(self.blobstore, blob_name, path, part.get('sha256')),
+                        'download the part {}'.format(blob_name))
+            if os.path.getsize(path) != part['size']:
+                raise TransferError('The part {} has {} bytes instead of {}.'
+                                    .format(blob_name, os.path.getsize(path), part['size']))
+            progress.advance(part['size'])
+
+        return self._run(download_part, parts)
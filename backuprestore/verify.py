@@ -0,0 +1,116 @@
+import json
+import os
+from service_fabrik_backup_restore import parse_options, create_iaas_client
+from options import parse_extended_options
+from blobstore import IaasBlobstore
+from incremental import resolve_chain, verify_incremental_backup
+from dedup import verify_dedup_backup
+from blocks import verify_block_archive
+from streaming import download_verified, verify_streamed_archive
+from timings import InstrumentedClient, Timings, export_timings
+import progress
+
+METADATA_FILES_NAME = 'blueprint-metadata.json'
+TARBALL_FILES_NAME = 'blueprint-files.tar.gz.gpg'
+
+
+def has_digests(metadata):
+    # +-> Archives whose parts are encrypted one by one only record the digests of their parts
+    return any(archive.get('sha256') or any(part.get('sha256') for part in archive.get('parts', ()))
+               for archive in [metadata] + metadata.get('blocks', []))
+
+
+def backup_size(blobstore, backup_guid, metadata, secret):
+    """Returns the number of bytes that are downloaded to verify the backup, i.e. of every archive in its chain."""
+    if metadata.get('format') == 'incremental':
+        return sum(chain_metadata.get('size', 0) for _, chain_metadata, _ in
+                   resolve_chain(blobstore, backup_guid, metadata, secret, METADATA_FILES_NAME))
+    return metadata.get('size', 0)
+
+
+def verify_backup(blobstore, backup_guid, metadata, secret, workers, iaas_client=None):
+    """Downloads the blobs of a backup and checks the digests recorded in its metadata, without extracting anything.
+
+    Returns a summary of what was checked; raises an `IntegrityError` if a digest does not match. Snapshot backups
+    have no blobs to check, only whether their snapshot still exists (given an `iaas_client`); backups taken before
+    digests were recorded are only downloaded.
+    """
+    summary = {'format': metadata.get('format', 'tarball'), 'recorded': has_digests(metadata)}
+    # +-> Parts and chunks are counted while they are checked; the size of an incremental backup only covers the last
+    #     archive of its chain, a tarball in one piece is downloaded by the library without any progress
+    if summary['format'] not in ('incremental', 'tarball') or metadata.get('parts'):
+        progress.expect(metadata.get('size'))
+    if 'snapshotId' in metadata:
+        summary.update(format='snapshot', recorded=False, bytes=0, snapshotId=metadata['snapshotId'])
+        if iaas_client and not iaas_client.get_snapshot(str(metadata['snapshotId'])):
+            raise IOError('The snapshot {} of backup {} does not exist.'.format(metadata['snapshotId'], backup_guid))
+    elif summary['format'] == 'incremental':
+        summary['bytes'] = verify_incremental_backup(blobstore, backup_guid, metadata, secret, METADATA_FILES_NAME)
+    elif summary['format'] == 'dedup':
+        summary['bytes'] = verify_dedup_backup(blobstore, backup_guid, metadata, secret, workers)
+    elif summary['format'] == 'blocks':
+        summary['bytes'] = verify_block_archive(blobstore, backup_guid, metadata, workers)
+    elif summary['format'] in ('streaming', 'resumable'):
+        summary['bytes'] = verify_streamed_archive(blobstore, backup_guid, metadata)
+    elif metadata.get('parts'):
+        # +-> A tarball uploaded in parts: their concatenation is the tarball the digest was computed of
+        summary['bytes'] = verify_streamed_archive(blobstore, backup_guid, metadata)
+    else:
+        # +-> The tarball is streamed through the digest while it is downloaded, every range that was checked is freed
+        #     on the local disk right away
+        archive = metadata.get('archive', TARBALL_FILES_NAME)
+        path = blobstore.spool_file('.gpg')
+        try:
+            if not download_verified(blobstore, '{}/{}'.format(backup_guid, archive), path, metadata.get('sha256'),
+                                     'the tarball {}'.format(archive), discard=True):
+                raise IOError('Could not download the tarball {} of backup {}.'.format(archive, backup_guid))
+            summary['bytes'] = os.path.getsize(path)
+        finally:
+            os.remove(path)
+    return summary
+
+
+def main():
+    # +-> Definition of constants; all directories are below the root directory, which is only changed by the benchmark
+    DIRECTORY_ROOT = os.environ.get('SF_BACKUP_RESTORE_ROOT_DIRECTORY', '')
+    DIRECTORY_PERSISTENT = DIRECTORY_ROOT + '/var/vcap/store'
+    DIRECTORY_SPOOL = DIRECTORY_ROOT + '/tmp/service-fabrik-verify/spool'
+
+    # +-> Initialization: Argument Parsing, IaaS-Client Creation; the verification takes the arguments of a restore,
+    #     but only reads from the blob store and never touches the instance's volumes or its service job. It is an
+    #     operation of its own, so its last operation state and log never replace the ones of a restore
+    options = parse_extended_options('verify')
+    configuration = parse_options('restore')
+    iaas_client = create_iaas_client('verify', configuration, DIRECTORY_PERSISTENT, [])
+    timings = Timings('verify')
+    iaas_client = InstrumentedClient(iaas_client, timings)
+
+    # ------------------------------------------ VERIFY START ----------------------------------------------------------
+    backup_guid = configuration['backup_guid']
+    summary = None
+    iaas_client.initialize()
+    progress.start('verify', options['stall_timeout'], iaas_client.logger)
+
+    try:
+        blobstore = IaasBlobstore(iaas_client, DIRECTORY_SPOOL)
+        metadata = blobstore.download_json('{}/{}'.format(backup_guid, METADATA_FILES_NAME)) or {}
+        try:
+            with timings.step('verify_backup') as step:
+                summary = verify_backup(blobstore, backup_guid, metadata, configuration['secret'],
+                                        options['parallelism'], iaas_client)
+                step.bytes = summary['bytes']
+        except Exception as error:
+            iaas_client.exit('The backup {} failed verification: {}'.format(backup_guid, error))
+        print(json.dumps(dict(summary, backupGuid=backup_guid, state='verified')))
+        iaas_client.finalize()
+        timings.succeeded = True
+    except Exception as error:
+        iaas_client.exit('An unexpected exception occurred: {}'.format(error))
+    finally:
+        progress.stop()
+        export_timings(timings, iaas_client.logger, options['metrics_directory'], verification=summary)
+    # ------------------------------------------- VERIFY END -----------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import fcntl
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+STATE_NAME = 'pool.json'
+LOCK_NAME = 'pool.lock'
+
+
+class VolumePoolError(Exception):
+    pass
+
+
+class VolumePool:
+    """Formatted scratch volumes that stay attached to this instance between backups and restores.
+
+    A run leases a volume instead of creating, attaching and formatting a new one and hands it back afterwards; only
+    volumes beyond `max_volumes` are deleted then. Volumes idle for longer than `max_idle` seconds are deleted on the
+    next lease or hand back and when an operation starts (see `reconcile`). The pool is tracked in a state file, guarded
+    by a file lock, so backups and restores share it. The state directory has to be on the persistent disk: it outlives
+    the instance, hence the volumes attached to a previous instance (e.g. before the VM was recreated) are still known
+    and deleted by `reconcile`. Leases of processes that are gone are recovered by unmounting the volume and putting it
+    back.
+    """
+
+    def __init__(self, iaas_client, instance_id, state_directory, max_volumes, max_idle, previous_state_directory=None):
+        os.makedirs(state_directory, mode=0o700, exist_ok=True)
+        self.iaas_client = iaas_client
+        self.instance_id = instance_id
+        self.state_path = os.path.join(state_directory, STATE_NAME)
+        self.lock_path = os.path.join(state_directory, LOCK_NAME)
+        self.max_volumes = max_volumes
+        self.max_idle = max_idle
+        # +-> The state of a pool that was kept elsewhere before (e.g. on the ephemeral disk) is taken over once
+        if previous_state_directory and os.path.exists(os.path.join(previous_state_directory, STATE_NAME)):
+            with open(self.lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(self.state_path):
+                    shutil.copyfile(os.path.join(previous_state_directory, STATE_NAME), self.state_path)
+                os.remove(os.path.join(previous_state_directory, STATE_NAME))
+
+    @contextmanager
+    def _state(self):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = {'instanceId': self.instance_id, 'volumes': []}
+            if os.path.exists(self.state_path):
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            yield state
+            with open(self.state_path + '.new', 'w') as f:
+                f.write(json.dumps(state))
+            os.replace(self.state_path + '.new', self.state_path)
+
+    def _recover_stale_leases(self, state):
+        for volume in state['volumes']:
+            if volume['leasedBy'] and not _process_exists(volume['leasedBy']):
+                self.iaas_client.logger.warning('Recovering the scratch volume {} leased by the process {}, which is '
+                                                'gone.'.format(volume['id'], volume['leasedBy']))
+                self.iaas_client.unmount_device(volume['mountpoint'])
+                volume['leasedBy'] = None
+                volume['idleSince'] = time.time()
+
+    def _take_evicted(self, state):
+        evicted = [volume for volume in state['volumes'] if not volume['leasedBy'] and
+                   (not volume['formatted'] or time.time() - volume['idleSince'] > self.max_idle)]
+        state['volumes'] = [volume for volume in state['volumes'] if volume not in evicted]
+        return evicted
+
+    def _delete(self, volumes, instance_id=None):
+        for volume in volumes:
+            if not self.iaas_client.delete_attachment(volume['id'], instance_id or self.instance_id) or \
+                    not self.iaas_client.delete_volume(volume['id']):
+                self.iaas_client.logger.error('Could not delete the scratch volume {}.'.format(volume['id']))
+
+    def reconcile(self):
+        """Deletes the volumes of a previous instance, recovers stale leases and evicts idle volumes.
+
+        To be called when an operation starts, so the pool is cleaned up by every backup and restore, also by those that
+        lease no volume.
+        """
+        with self._state() as state:
+            orphans = []
+            previous_instance_id = state.get('instanceId') or self.instance_id
+            if previous_instance_id != self.instance_id:
+                orphans = state['volumes']
+                state['volumes'] = []
+                self.iaas_client.logger.warning('Deleting the {} scratch volumes of the previous instance {}.'
+                                                .format(len(orphans), previous_instance_id))
+            state['instanceId'] = self.instance_id
+            self._recover_stale_leases(state)
+            evicted = self._take_evicted(state)
+        self._delete(orphans, previous_instance_id)
+        self._delete(evicted)
+
+    def lease(self, size):
+        """Returns a lease of an attached and formatted volume of at least the given size."""
+        with self._state() as state:
+            self._recover_stale_leases(state)
+            evicted = self._take_evicted(state)
+            candidates = sorted((volume for volume in state['volumes'] if not volume['leasedBy'] and
+                                 volume['formatted'] and volume['size'] >= size), key=lambda volume: volume['size'])
+            volume = candidates[0] if candidates else None
+            if volume:
+                volume['leasedBy'] = os.getpid()
+        self._delete(evicted)
+
+        if volume:
+            # +-> The volume may have been detached behind the pool's back, e.g. by a restart of the instance
+            mountpoint = self.iaas_client.get_mountpoint(volume['id'])
+            if not mountpoint and self.iaas_client.create_attachment(volume['id'], self.instance_id):
+                mountpoint = self.iaas_client.get_mountpoint(volume['id'])
+            if mountpoint:
+                with self._state() as state:
+                    for entry in state['volumes']:
+                        if entry['id'] == volume['id']:
+                            entry['mountpoint'] = mountpoint
+                self.iaas_client.logger.info('Leased the scratch volume {} from the pool.'.format(volume['id']))
+                return SimpleNamespace(volume_id=volume['id'], size=volume['size'], mountpoint=mountpoint)
+            self.iaas_client.logger.warning('Dropping the scratch volume {} from the pool, it cannot be attached.'
+                                            .format(volume['id']))
+            with self._state() as state:
+                state['volumes'] = [entry for entry in state['volumes'] if entry['id'] != volume['id']]
+            self.iaas_client.delete_volume(volume['id'])
+
+        # +-> A new volume is formatted once, when it joins the pool; until then it is not handed out again
+        created = self.iaas_client.create_volume(size)
+        if not created:
+            raise VolumePoolError('Could not create a scratch volume.')
+        if not self.iaas_client.create_attachment(created.id, self.instance_id):
+            self.iaas_client.delete_volume(created.id)
+            raise VolumePoolError('Could not attach the scratch volume with id {} to instance with id {}.'
+                                  .format(created.id, self.instance_id))
+        mountpoint = self.iaas_client.get_mountpoint(created.id)
+        if not mountpoint:
+            self._delete([{'id': created.id}])
+            raise VolumePoolError('Could not determine the mountpoint for the scratch volume (id: {}).'
+                                  .format(created.id))
+        with self._state() as state:
+            state['volumes'].append({'id': created.id, 'size': created.size, 'mountpoint': mountpoint,
+                                     'leasedBy': os.getpid(), 'idleSince': time.time(), 'formatted': False})
+        if not self.iaas_client.format_device(mountpoint):
+            raise VolumePoolError('Could not format the following device: {}'.format(mountpoint))
+        with self._state() as state:
+            for entry in state['volumes']:
+                if entry['id'] == created.id:
+                    entry['formatted'] = True
+        return SimpleNamespace(volume_id=created.id, size=created.size, mountpoint=mountpoint)
+
+    def give_back(self, lease):
+        """Ends the lease of the (unmounted) volume; it stays attached unless the pool is full."""
+        with self._state() as state:
+            volumes = [volume for volume in state['volumes'] if volume['id'] == lease.volume_id]
+            idle = [volume for volume in state['volumes'] if not volume['leasedBy']]
+            surplus = []
+            if volumes and len(idle) < self.max_volumes:
+                volumes[0]['leasedBy'] = None
+                volumes[0]['idleSince'] = time.time()
+            else:
+                surplus = [{'id': lease.volume_id}]
+                state['volumes'] = [volume for volume in state['volumes'] if volume['id'] != lease.volume_id]
+            evicted = self._take_evicted(state)
+        self._delete(surplus + evicted)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def wipe_directory(directory):
+    """Removes the contents of a leased volume, which is much faster than formatting it again."""
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name == 'lost+found':
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
@@ -0,0 +1,238 @@
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+MONIT_PATHS = ('/var/vcap/bosh/bin/monit',)
+MONIT_PROCESS_LINE = re.compile(r"^Process '([^']+)'\s+(.+?)\s*$")
+# +-> Newer versions of monit print the summary as a table (`│ name │ status │ type │`), with `-B` without borders
+MONIT_COLUMNS = re.compile(r'\s*│\s*|\s{2,}')
+# +-> First delay between two status polls of the library, which then backs off up to the library's poll interval
+LIBRARY_POLL_BACKOFF = 0.5
+# +-> Calls of the library that poll the status of the resource they create or delete until it is ready or gone
+POLLING_METHODS = ('create_snapshot', 'copy_snapshot', 'delete_snapshot', 'create_volume', 'delete_volume',
+                   'create_attachment', 'delete_attachment')
+# +-> Calls of the library that run concurrently nevertheless, the parallel transfers are made of them
+CONCURRENT_METHODS = ('upload_to_blobstore', 'download_from_blobstore')
+
+
+class BackoffPolicy:
+    """Polls quickly at first and backs off exponentially, with jitter, up to a maximum delay between polls."""
+
+    def __init__(self, initial, maximum, factor=2.0, jitter=0.2, timeout=18000):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            yield delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay = min(delay * self.factor, self.maximum)
+
+
+# +-> Stopping a job is a matter of seconds, starting one may take minutes (e.g. a database replaying its log)
+POLICIES = {
+    'not monitored': BackoffPolicy(0.2, 2),
+    'running': BackoffPolicy(0.5, 5),
+}
+DEFAULT_POLICY = BackoffPolicy(0.5, 10)
+
+
+def wait_until(condition, policy, sleep=time.sleep):
+    """Evaluates the condition until it holds or the policy's timeout has passed; returns whether it held."""
+    deadline = time.monotonic() + policy.timeout
+    for delay in policy.delays():
+        if condition():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        sleep(min(delay, remaining))
+
+
+class MonitJob:
+    """Reads the status of a job from `monit summary`, which is what the library waits for as well."""
+
+    def __init__(self, name):
+        self.name = name
+        self.monit = next((path for path in MONIT_PATHS if os.access(path, os.X_OK)), None) or shutil.which('monit')
+
+    def status(self):
+        """Returns the status as monit reports it (e.g. `running`, `not monitored`) or None if it is unknown."""
+        if not self.monit:
+            return None
+        try:
+            output = subprocess.run([self.monit, 'summary'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    universal_newlines=True, timeout=30).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        return parse_monit_summary(output).get(self.name)
+
+
+def parse_monit_summary(output):
+    """Returns the status of every process in the output of `monit summary`, in the words of the old format.
+
+    The old format has a line `Process 'name'   running` per process; newer versions print a table, with or without
+    borders, in which a running process is `OK`.
+    """
+    statuses = {}
+    for line in output.splitlines():
+        match = MONIT_PROCESS_LINE.match(line.strip())
+        if match:
+            statuses[match.group(1)] = match.group(2).lower()
+            continue
+        columns = [column for column in MONIT_COLUMNS.split(line.strip()) if column]
+        if len(columns) == 3 and columns[2] == 'Process':
+            status = columns[1].lower()
+            statuses[columns[0]] = 'running' if status == 'ok' else status
+    return statuses
+
+
+def wait_for_service_job_status(iaas_client, job_name, status, timings):
+    """Waits for the service job to reach the status, polling monit with the backoff policy of that status.
+
+    If monit cannot tell the status of the job, the fixed-interval wait of the library is used instead.
+    """
+    job = MonitJob(job_name)
+    if job.status() is None:
+        return iaas_client.wait_for_service_job_status(status)
+    started = time.monotonic()
+    with timings.step('wait_for_service_job_status'):
+        reached = wait_until(lambda: job.status() == status, POLICIES.get(status, DEFAULT_POLICY))
+    iaas_client.logger.info('Waited {:.1f}s for the job {} to be {}.'
+                            .format(time.monotonic() - started, job_name, status))
+    return reached
+
+
+class RateLimiter:
+    """Hands out at most `rate` slots per second across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+class LibraryClock:
+    """Stands in for the `time` module in the modules of the library (see `install`).
+
+    The clients of the library wait for a snapshot, volume or attachment by sleeping their poll interval between two
+    status calls, all inside one call like `create_volume`. Within a call of `POLLING_METHODS` made through a
+    `PollingClient`, every sleep is followed by a status poll: the sleeps back off from `LIBRARY_POLL_BACKOFF` up to
+    the poll interval, and every poll takes a slot of the rate limiter if there is one, so that the polls count against
+    the same bound as the calls. All other sleeps are passed through.
+
+    Calls made through a `SerializedClient` hold `client_lock`, which a call gives up while it sleeps; the calls of
+    several threads are thereby made one at a time, but their waits overlap.
+    """
+
+    def __init__(self, limiter=None):
+        self.limiter = limiter
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.client_lock = threading.Lock()
+        self.polls = 0
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    @contextmanager
+    def polling(self):
+        self.local.polling = True
+        self.local.delays = None
+        try:
+            yield
+        finally:
+            self.local.polling = False
+
+    @contextmanager
+    def calling(self):
+        with self.client_lock:
+            self.local.calling = True
+            try:
+                yield
+            finally:
+                self.local.calling = False
+
+    def sleep(self, seconds):
+        calling = getattr(self.local, 'calling', False)
+        if calling:
+            self.client_lock.release()
+        try:
+            self._wait(seconds)
+        finally:
+            if calling:
+                self.client_lock.acquire()
+
+    def _wait(self, seconds):
+        if not getattr(self.local, 'polling', False):
+            return time.sleep(seconds)
+        # +-> No delay exceeds the poll interval, a resource is never noticed later than by the library's own wait
+        if self.local.delays is None:
+            self.local.delays = BackoffPolicy(min(LIBRARY_POLL_BACKOFF, seconds), seconds).delays()
+        time.sleep(min(next(self.local.delays), seconds))
+        with self.lock:
+            self.polls += 1
+        if self.limiter:
+            self.limiter.acquire()
+
+    def install(self, package='service_fabrik_backup_restore'):
+        """Replaces the `time` module in the already imported modules of the library by this clock."""
+        for name, module in list(sys.modules.items()):
+            if name.split('.')[0] == package and getattr(module, 'time', None) is time:
+                module.time = self
+
+
+class SerializedClient:
+    """Forwards everything to the IaaS client, but makes the calls of all threads one at a time (see `LibraryClock`).
+
+    Nothing tells that the clients of the library are thread-safe, so only the `CONCURRENT_METHODS` are called without
+    holding the lock.
+    """
+
+    def __init__(self, iaas_client, clock):
+        self._iaas_client = iaas_client
+        self._clock = clock
+
+    def __getattr__(self, name):
+        attribute = getattr(self._iaas_client, name)
+        if not callable(attribute) or name.startswith('_') or name in CONCURRENT_METHODS:
+            return attribute
+
+        def serialized(*args, **kwargs):
+            with self._clock.calling():
+                return attribute(*args, **kwargs)
+        return serialized
+
+
+class PollingClient:
+    """Forwards everything to the IaaS client and tells the clock which calls poll (see `LibraryClock`)."""
+
+    def __init__(self, iaas_client, clock):
+        self._iaas_client = iaas_client
+        self._clock = clock
+
+    def __getattr__(self, name):
+        attribute = getattr(self._iaas_client, name)
+        if name not in POLLING_METHODS:
+            return attribute
+
+        def polling(*args, **kwargs):
+            with self._clock.polling():
+                return attribute(*args, **kwargs)
+        return polling
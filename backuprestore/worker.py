@@ -0,0 +1,392 @@
+"""Resident worker that runs backups and restores in processes forked from one warm interpreter.
+
+Starting `backup.py` or `restore.py` with a fresh `python3` imports the library and the cloud SDKs of the landscape
+every time, which takes seconds. The worker imports them once and forks a child per operation, which runs the `main`
+of the script exactly as if it had been started on its own: it writes the last-operation and log files itself, and its
+exit code is the one of the script.
+
+The agent talks to the worker over a Unix socket, one JSON document per line:
+
+    {"command": "backup", "arguments": ["--backup_guid=...", ...]}
+        -> {"event": "started", "pid": 4711}
+        -> {"event": "stderr", "data": "..."}                        (any number of times)
+        -> {"event": "exited", "code": 0, "signal": null}
+    {"command": "status"}
+        -> {"event": "status", "pid": 4242, "uptime": 360.5, "warmClients": 1, "warming": false,
+            "operations": [{"operation": "backup", "pid": 4711}]}
+
+The IaaS client is kept warm as well: the first operation creates its client as usual and reports the arguments of
+that call to the worker, which creates the same client (i.e. authenticates) in its own process. Every later operation
+whose configuration only differs in `PER_RUN_KEYS` takes that client over from the fork, with these keys set to its own
+values, for up to `WARM_CLIENT_TTL` seconds. Connections cannot be shared between processes: once the worker has
+created a client, it closes the connections of the client's sessions and pools in its own process (see
+`close_connections`), so that a child inherits the tokens and sessions, but no open socket; the sessions open new
+connections on demand. The client is created by a thread of its own; while it runs, operations are started as new
+processes of their script instead of being forked. The worker exits when the agent that started it is gone; running
+operations are not affected.
+"""
+import argparse
+import gc
+import importlib
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+OPERATIONS = ('backup', 'restore')
+STOP_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+# +-> Keys of the configuration that differ between the operations of one instance
+PER_RUN_KEYS = ('backup_guid', 'secret', 'type')
+# +-> Seconds after which a warm client is replaced, well within the lifetime of the tokens of every landscape
+WARM_CLIENT_TTL = 1800
+# +-> Seconds the agent has to send its request after connecting
+REQUEST_TIMEOUT = 5
+
+# +-> SDKs the library uses per landscape; they are only imported for the landscape of this instance
+PROVIDER_MODULES = {
+    'openstack': ['keystoneauth1.session', 'cinderclient.client', 'novaclient.client', 'swiftclient.client'],
+    'aws': ['boto3'],
+    'azure': ['azure.storage.blob', 'azure.mgmt.compute', 'azure.mgmt.storage'],
+    'gcp': ['google.cloud.storage', 'googleapiclient.discovery'],
+    'ali': ['oss2', 'aliyunsdkcore.client', 'aliyunsdkecs'],
+}
+
+
+def preload(landscape):
+    """Imports the scripts, the library and the SDKs of the landscape, so that forked children find them loaded."""
+    for operation in OPERATIONS:
+        importlib.import_module(operation)
+    for name in PROVIDER_MODULES.get(landscape, []):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def client_key(operation, configuration, arguments):
+    stable = {key: value for key, value in configuration.items() if key not in PER_RUN_KEYS}
+    return json.dumps([operation, stable, arguments], sort_keys=True, default=str)
+
+
+def connection_types():
+    """Returns the types of the sessions, pools and connections of the SDKs that can be closed and keep working, by
+    opening new connections when they are used the next time.
+    """
+    import http.client
+    types = [http.client.HTTPConnection]
+    for module, names in (('urllib3.poolmanager', ('PoolManager',)), ('urllib3.connectionpool', ('HTTPConnectionPool',)),
+                          ('requests.sessions', ('Session',))):
+        try:
+            imported = importlib.import_module(module)
+        except ImportError:
+            continue
+        types.extend(getattr(imported, name) for name in names)
+    return tuple(types)
+
+
+def close_connections():
+    """Closes every connection of the clients in this process: the connections of `http.client` (on which httplib2
+    builds), the pools of urllib3 (botocore) and the sessions of requests (keystoneauth, swift, Azure, oss2).
+    """
+    types = connection_types()
+    for candidate in gc.get_objects():
+        if not isinstance(candidate, types):
+            continue
+        try:
+            if hasattr(candidate, 'clear') and not hasattr(candidate, 'close'):
+                candidate.clear()
+            else:
+                candidate.close()
+        except Exception:
+            pass
+
+
+def warm_client_factory(operation, clients, report_descriptor):
+    """Returns the `create_iaas_client` of the child: it takes over a warm client of the worker if there is one for the
+    configuration, otherwise it creates the client and reports the arguments of the call to the worker.
+    """
+    create_iaas_client = sys.modules[operation].create_iaas_client
+
+    def create(operation_name, configuration, *arguments):
+        # +-> The worker reads the report once it is closed, i.e. right after the first client was created
+        with os.fdopen(report_descriptor, 'w') as report:
+            warm = clients.get(client_key(operation_name, configuration, arguments))
+            if warm and time.monotonic() - warm['created'] < WARM_CLIENT_TTL:
+                # +-> The worker closed its connections before the fork, this only catches what it could not know of
+                close_connections()
+                # +-> The client keeps the configuration it was created with, the keys of this run are set in place
+                warm['configuration'].update(configuration)
+                return warm['client']
+            client = create_iaas_client(operation_name, configuration, *arguments)
+            try:
+                report.write(json.dumps({'operation': operation_name, 'configuration': configuration,
+                                         'arguments': arguments}, default=str))
+            except (OSError, TypeError, ValueError):
+                pass
+            return client
+    return create
+
+
+def run_operation(operation, arguments, stderr_descriptor, clients=None, report_descriptor=None):
+    """Runs the script's main in the forked child and never returns."""
+    code = 1
+    try:
+        # +-> Like a detached process, so that signals to the worker do not reach the operation
+        os.setsid()
+        os.dup2(stderr_descriptor, 2)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+        sys.argv = ['{}.py'.format(operation)] + arguments
+        if report_descriptor is not None:
+            sys.modules[operation].create_iaas_client = warm_client_factory(operation, clients, report_descriptor)
+        sys.modules[operation].main()
+        code = 0
+    except SystemExit as error:
+        code = error.code if isinstance(error.code, int) else (0 if error.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+class Operation:
+    def __init__(self, name, pid, connection, stderr, process=None):
+        self.name = name
+        self.pid = pid
+        self.connection = connection
+        self.stderr = stderr
+        self.process = process
+
+
+class Worker:
+    def __init__(self, socket_path, parent_pid):
+        self.socket_path = socket_path
+        self.parent_pid = parent_pid
+        self.started = time.monotonic()
+        self.selector = selectors.DefaultSelector()
+        self.operations = {}
+        self.clients = {}
+        self.requests = {}
+        self.warming = None
+        self.stopping = False
+
+    def serve(self):
+        # +-> A socket left behind by an earlier worker is replaced, that worker exits together with its agent
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen()
+        self.selector.register(server, selectors.EVENT_READ, self._accept)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            while not self.stopping and (self.parent_pid is None or os.getppid() == self.parent_pid):
+                for key, _ in self.selector.select(timeout=0.5):
+                    key.data(key.fileobj)
+                self._reap()
+                self._expire_requests()
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _accept(self, server):
+        connection, _ = server.accept()
+        # +-> The agent sends its request right after connecting, it is read as it arrives
+        connection.setblocking(False)
+        self.requests[connection] = [b'', time.monotonic() + REQUEST_TIMEOUT]
+        self.selector.register(connection, selectors.EVENT_READ, self._receive)
+
+    def _receive(self, connection):
+        request = self.requests[connection]
+        try:
+            data = connection.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        request[0] += data
+        if data and b'\n' not in request[0]:
+            return
+        self.selector.unregister(connection)
+        del self.requests[connection]
+        connection.setblocking(True)
+        if b'\n' not in request[0]:
+            connection.close()
+            return
+        self._handle(connection, request[0].split(b'\n', 1)[0])
+
+    def _expire_requests(self):
+        for connection, (_, deadline) in list(self.requests.items()):
+            if time.monotonic() > deadline:
+                self.selector.unregister(connection)
+                del self.requests[connection]
+                connection.close()
+
+    def _handle(self, connection, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if request.get('command') in OPERATIONS:
+                self._start(request['command'], [str(argument) for argument in request.get('arguments', [])],
+                            connection)
+                return
+            if request.get('command') == 'status':
+                self._send(connection, event='status', pid=os.getpid(),
+                           uptime=round(time.monotonic() - self.started, 3), warmClients=len(self.clients),
+                           warming=bool(self.warming and self.warming.is_alive()),
+                           operations=[{'operation': operation.name, 'pid': operation.pid}
+                                       for operation in self.operations.values()])
+            else:
+                self._send(connection, event='error', message='Unknown command: {}'.format(request.get('command')))
+        except Exception as error:
+            self._send(connection, event='error', message=str(error))
+        connection.close()
+
+    def _start(self, name, arguments, connection):
+        if self.warming and self.warming.is_alive():
+            # +-> A fork would inherit the state of the thread creating a client, e.g. the locks it holds
+            self._spawn(name, arguments, connection)
+            return
+        stderr_read, stderr_write = os.pipe()
+        report_read, report_write = os.pipe()
+        # +-> The agent may signal the child as soon as it knows its pid, which is before the child has reset the
+        #     worker's signal handlers; until then the signals are held back
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            os.close(stderr_read)
+            os.close(report_read)
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            for operation in self.operations.values():
+                operation.connection.close()
+            connection.close()
+            run_operation(name, arguments, stderr_write, self.clients, report_write)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+        os.close(stderr_write)
+        os.close(report_write)
+        report = os.fdopen(report_read, 'rb')
+        self.selector.register(report, selectors.EVENT_READ, self._warm)
+        self._track(Operation(name, pid, connection, None), stderr_read)
+
+    def _spawn(self, name, arguments, connection):
+        """Starts the operation as a new process of its script, like the agent does without a worker."""
+        stderr_read, stderr_write = os.pipe()
+        try:
+            process = subprocess.Popen([sys.executable, sys.modules[name].__file__] + arguments,
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr_write,
+                                       start_new_session=True)
+        except OSError:
+            os.close(stderr_read)
+            raise
+        finally:
+            os.close(stderr_write)
+        self._track(Operation(name, process.pid, connection, None, process), stderr_read)
+
+    def _track(self, operation, stderr_read):
+        os.set_blocking(stderr_read, False)
+        operation.stderr = os.fdopen(stderr_read, 'rb', buffering=0)
+        self.operations[operation.pid] = operation
+        self.selector.register(operation.stderr, selectors.EVENT_READ, lambda f: self._forward_stderr(operation))
+        self._send(operation.connection, event='started', pid=operation.pid)
+
+    def _warm(self, report):
+        """Reads the client an operation reported and creates it in a thread, to be taken over by the next operations.
+
+        The report is read once the operation has closed it. A client is only created once per configuration and one
+        at a time; a report that comes in while a client is created is dropped, the next operation reports it again.
+        """
+        data = report.read()
+        self.selector.unregister(report)
+        report.close()
+        if not data or (self.warming and self.warming.is_alive()):
+            return
+        try:
+            request = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return
+        key = client_key(request['operation'], request['configuration'], request['arguments'])
+        if key in self.clients and time.monotonic() - self.clients[key]['created'] < WARM_CLIENT_TTL:
+            return
+        self.warming = threading.Thread(target=self._create_client, args=(key, request), daemon=True)
+        self.warming.start()
+
+    def _create_client(self, key, request):
+        try:
+            operation = request['operation'] if request['operation'] in OPERATIONS else OPERATIONS[0]
+            client = sys.modules[operation].create_iaas_client(request['operation'], request['configuration'],
+                                                               *request['arguments'])
+            # +-> The children inherit the client, but none of its connections
+            close_connections()
+            self.clients[key] = {'client': client, 'configuration': request['configuration'],
+                                 'created': time.monotonic()}
+        except Exception:
+            traceback.print_exc()
+
+    def _forward_stderr(self, operation):
+        """Forwards what is available on the operation's stderr; returns whether there was anything."""
+        data = operation.stderr.read(65536)
+        if data is None:
+            return False
+        if not data:
+            self.selector.unregister(operation.stderr)
+            operation.stderr.close()
+            operation.stderr = None
+            return False
+        self._send(operation.connection, event='stderr', data=data.decode('utf-8', 'replace'))
+        return True
+
+    def _reap(self):
+        for pid, operation in list(self.operations.items()):
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+            if not reaped:
+                continue
+            # +-> Forward what the operation wrote last before telling that it has ended
+            while operation.stderr is not None and self._forward_stderr(operation):
+                pass
+            if operation.stderr is not None:
+                self.selector.unregister(operation.stderr)
+                operation.stderr.close()
+            code = os.waitstatus_to_exitcode(status)
+            self._send(operation.connection, event='exited', code=code if code >= 0 else None,
+                       signal=signal.Signals(-code).name if code < 0 else None)
+            operation.connection.close()
+            del self.operations[pid]
+
+    def _send(self, connection, **message):
+        # +-> The agent may be gone; the operation goes on regardless, like a detached process
+        try:
+            connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        except OSError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--socket', required=True, help='Path of the Unix socket to listen on')
+    parser.add_argument('--iaas', help='Landscape whose SDKs are imported up front')
+    arguments = parser.parse_args()
+    preload(arguments.iaas)
+    Worker(arguments.socket, os.getppid()).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -215,7 +215,8 @@ class AgentApi {
       !_.isArray(args.vms) ||
       !['guid', 'type', 'secret'].every(key => key in args.backup) ||
       _.size(args.vms) < 1 ||
-      _.indexOf(_.map(args.vms, vm => ['cid', 'job', 'index'].every(key => key in vm)), false) !== -1) {
+      _.indexOf(_.map(args.vms, vm => ['cid', 'job', 'index'].every(key => key in vm)), false) !== -1 ||
+      (!_.isUndefined(args.restore_paths) && !(_.isArray(args.restore_paths) && _.every(args.restore_paths, _.isString)))) {
       return next(new BadRequest());
     }
     if (!_.isNull(state.operation)) {
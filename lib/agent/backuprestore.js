@@ -4,9 +4,11 @@ const _ = require('lodash');
 const assert = require('assert');
 const Promise = require('bluebird');
 const fs = Promise.promisifyAll(require('fs'));
+const path = require('path');
 const child_process = require('child_process');
 const config = require('../config');
 const logger = require('../logger');
+const worker = require('./worker');
 const agent = config.agent;
 
 const job = agent.job;
@@ -16,7 +18,9 @@ const paths = {
   backup: process.env.AGENT_PATH_BACKUP_SCRIPT,
   restore: process.env.AGENT_PATH_RESTORE_SCRIPT,
   last_operation: process.env.SF_BACKUP_RESTORE_LAST_OPERATION_DIRECTORY,
-  logs: process.env.SF_BACKUP_RESTORE_LOG_DIRECTORY
+  logs: process.env.SF_BACKUP_RESTORE_LOG_DIRECTORY,
+  // optional, backups and restores are run by the resident worker listening on this socket if set
+  worker_socket: process.env.SF_BACKUP_RESTORE_WORKER_SOCKET
 };
 
 const credHubParams = [
@@ -29,6 +33,30 @@ const credHubParams = [
   'credhub_user_password'
 ];
 
+const archiveParams = [
+  'archive_format',
+  'part_size',
+  'block_size',
+  'parallelism',
+  'tarball_parallelism',
+  'compression',
+  'compression_level',
+  'compression_threads',
+  'restore_mode',
+  'max_chain_length',
+  'iaas_poll_interval',
+  'volume_pool_size',
+  'volume_pool_idle',
+  'read_rate_limit',
+  'upload_rate_limit',
+  'max_load',
+  'max_disk_queue',
+  'nice',
+  'io_class',
+  'stall_timeout',
+  'metrics_directory'
+];
+
 const iaasSpecificParams = {
   openstack: [
     'tenant_id',
@@ -85,6 +113,7 @@ function startBackup(params) {
     .assign(iaasConfiguration.max_retries ? {
       max_retries: iaasConfiguration.max_retries
     } : {})
+    .assign(_.pick(iaasConfiguration, archiveParams))
     .assign(_.pick(iaasConfiguration, credHubParams))
     .assign(_.pick(iaasConfiguration, iaasSpecificParams[iaasConfiguration.name]))
     //can configure the service with either IAAS credentials directly or configure it with credhub
@@ -97,17 +126,7 @@ function startBackup(params) {
     })
     .value();
 
-  const spawnParameters = _(paths.backup)
-    .chain()
-    .concat(pythonParameters)
-    .flatten()
-    .value();
-
-  logger.agent.info(`python3 ${_.join(spawnParameters, ' ')}`);
-
-  return child_process.spawn('python3', spawnParameters, {
-    detached: true
-  });
+  return startOperation('backup', pythonParameters);
 }
 
 function startRestore(params) {
@@ -130,6 +149,12 @@ function startRestore(params) {
     .assign(iaasConfiguration.max_retries ? {
       max_retries: iaasConfiguration.max_retries
     } : {})
+    .assign(_.pick(iaasConfiguration, archiveParams))
+    //restores only the given paths or glob patterns of a backup in the blocks format, the service keeps running
+    .assign(_.isEmpty(params.restore_paths) ? {} : {
+      restore_mode: 'partial',
+      restore_paths: params.restore_paths
+    })
     .assign(_.pick(iaasConfiguration, credHubParams))
     .assign(_.pick(iaasConfiguration, iaasSpecificParams[iaasConfiguration.name]))
     .map((value, key) => {
@@ -140,7 +165,12 @@ function startRestore(params) {
     })
     .value();
 
-  const spawnParameters = _(paths.restore)
+  removeOutput('restore');
+  return startOperation('restore', pythonParameters);
+}
+
+function spawnOperation(operation, pythonParameters) {
+  const spawnParameters = _(paths[operation])
     .chain()
     .concat(pythonParameters)
     .flatten()
@@ -153,6 +183,48 @@ function startRestore(params) {
   });
 }
 
+function startOperation(operation, pythonParameters) {
+  if (!paths.worker_socket) {
+    return spawnOperation(operation, pythonParameters);
+  }
+  // (re)start the worker if it is not running, the operation waits for it or falls back to its own python3 process
+  startWorker();
+  return worker.run(operation, pythonParameters, paths.worker_socket, () => spawnOperation(operation, pythonParameters));
+}
+
+function startWorker() {
+  if (paths.worker_socket) {
+    worker.start(path.join(path.dirname(paths.backup), 'worker.py'), paths.worker_socket, iaasConfiguration.name);
+  }
+}
+
+function removeOutput(operation) {
+  // the output of an operation is merged into the file, which must not carry over the output of the previous one
+  try {
+    fs.unlinkSync(`${paths.logs}/${operation}.output.json`);
+  } catch (err) {
+    if (err.code !== 'ENOENT') {
+      logger.agent.error(`Could not remove the output of the last ${operation}.`);
+      logger.agent.error(err.message);
+    }
+  }
+}
+
+function readOutput(operation) {
+  return fs.readFileAsync(`${paths.logs}/${operation}.output.json`, 'utf8');
+}
+
+function readProgress(operation) {
+  // only exists while the operation runs; written by the script every few seconds and never partially visible
+  return fs
+    .readFileAsync(`${paths.last_operation}/${operation}.progress.json`, 'utf8')
+    .then(JSON.parse)
+    .then(progress => ({
+      progress
+    }))
+    .catchReturn({});
+}
+
 function getLastOperation(operation) {
   const lastOperationStateError = {
     state: 'failed',
@@ -162,9 +234,11 @@ function getLastOperation(operation) {
   return Promise
     .all([
       fs.readFileAsync(`${paths.last_operation}/${operation}.lastoperation.json`, 'utf8'),
-      operation === 'backup' ? fs.readFileAsync(`${paths.logs}/${operation}.output.json`, 'utf8') : Promise.resolve({})
+      // the restore only writes its output (the timings) once it has ended, hence a missing file is not an error
+      operation === 'backup' ? readOutput(operation) : readOutput(operation).catchReturn('{}'),
+      readProgress(operation)
     ])
-    .spread((data, jsonOutput) => _.isEmpty(data) ? lastOperationStateError : (operation === 'backup' ? _.assign(JSON.parse(data), JSON.parse(jsonOutput)) : JSON.parse(data)))
+    .spread((data, jsonOutput, progress) => _.isEmpty(data) ? lastOperationStateError : _.assign(JSON.parse(data), JSON.parse(jsonOutput), progress))
     .catch(err => {
       logger.agent.error(`Could not retrieve the last ${operation} state.`);
       logger.agent.error(err.message);
@@ -204,5 +278,6 @@ module.exports.checkForConfigParameters = checkForConfigParameters;
 module.exports.checkForEnvironmentVariables = checkForEnvironmentVariables;
 module.exports.startBackup = startBackup;
 module.exports.startRestore = startRestore;
+module.exports.startWorker = startWorker;
 module.exports.getLastOperation = getLastOperation;
 module.exports.getLogs = getLogs;
\ No newline at end of file
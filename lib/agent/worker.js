@@ -0,0 +1,191 @@
+'use strict';
+
+const _ = require('lodash');
+const EventEmitter = require('events');
+const net = require('net');
+const stream = require('stream');
+const child_process = require('child_process');
+const logger = require('../logger');
+
+// the worker needs a moment to import everything after it was (re)started
+const CONNECT_ATTEMPTS = 20;
+const CONNECT_DELAY = 250;
+const EXIT_POLL_INTERVAL = 1000;
+
+/**
+ * An operation run by the resident worker; it looks like the child process the agent would spawn otherwise
+ * (pid, stderr, kill, 'exit' event), so the state handling does not need to know the difference.
+ * If the worker cannot be reached, the operation is started by the given fallback instead.
+ */
+class WorkerOperation extends EventEmitter {
+  constructor(socketPath, operation, parameters, fallback) {
+    super();
+    this.pid = undefined;
+    this.stderr = new stream.PassThrough();
+    this.child = null;
+    this.signal = null;
+    this.exited = false;
+    this.operation = operation;
+    this.fallback = fallback;
+    this.connect(socketPath, operation, parameters, fallback, CONNECT_ATTEMPTS);
+  }
+
+  get pending() {
+    return _.isUndefined(this.pid) && !this.exited;
+  }
+
+  // the worker could not be started at all, there is no point in waiting for it
+  abandon(err) {
+    if (this.pending) {
+      logger.agent.warn(`The backup & restore worker is not available (${err.message}), starting the ${this.operation} directly.`);
+      this.adopt(this.fallback());
+    }
+  }
+
+  connect(socketPath, operation, parameters, fallback, attempts) {
+    let buffer = '';
+    const socket = net.createConnection(socketPath);
+    socket.setEncoding('utf8');
+    socket.on('connect', () => socket.write(JSON.stringify({
+      command: operation,
+      arguments: parameters
+    }) + '\n'));
+    socket.on('data', data => {
+      const lines = _.split(buffer + data, '\n');
+      buffer = lines.pop();
+      _.each(lines, line => this.handle(JSON.parse(line)));
+    });
+    socket.on('error', err => {
+      if (!this.pending) {
+        return;
+      }
+      if (attempts > 1) {
+        return setTimeout(() => this.connect(socketPath, operation, parameters, fallback, attempts - 1), CONNECT_DELAY);
+      }
+      logger.agent.warn(`Could not reach the backup & restore worker (${err.message}), starting the ${operation} directly.`);
+      this.adopt(fallback());
+    });
+    socket.on('close', () => {
+      // the worker is gone while the operation goes on, its end can only be noticed by polling
+      if (!this.child && !_.isUndefined(this.pid) && !this.exited) {
+        logger.agent.warn(`Lost the connection to the worker, watching the process (id: ${this.pid}) instead.`);
+        this.watch();
+      }
+    });
+  }
+
+  handle(message) {
+    switch (message.event) {
+    case 'started':
+      this.pid = message.pid;
+      if (this.signal) {
+        this.kill(this.signal);
+      }
+      break;
+    case 'stderr':
+      this.stderr.write(message.data);
+      break;
+    case 'exited':
+      this.exit(message.code, message.signal);
+      break;
+    case 'error':
+      this.stderr.write(message.message);
+      this.exit(1, null);
+      break;
+    }
+  }
+
+  adopt(child) {
+    this.child = child;
+    this.pid = child.pid;
+    child.stderr.pipe(this.stderr);
+    child.once('exit', (code, signal) => this.exit(code, signal));
+    if (this.signal) {
+      child.kill(this.signal);
+    }
+  }
+
+  watch() {
+    const timer = setInterval(() => {
+      try {
+        process.kill(this.pid, 0);
+      } catch (err) {
+        clearInterval(timer);
+        this.exit(null, null);
+      }
+    }, EXIT_POLL_INTERVAL);
+  }
+
+  exit(code, signal) {
+    if (!this.exited) {
+      this.exited = true;
+      this.emit('exit', code, signal);
+    }
+  }
+
+  kill(signal) {
+    signal = signal || 'SIGTERM';
+    if (this.child) {
+      return this.child.kill(signal);
+    }
+    if (_.isUndefined(this.pid)) {
+      // not started yet, the signal is delivered as soon as it is
+      this.signal = signal;
+      return true;
+    }
+    try {
+      return process.kill(this.pid, signal);
+    } catch (err) {
+      return false;
+    }
+  }
+}
+
+/**
+ * The resident worker (backuprestore/worker.py): one python3 process that keeps the library and the SDKs imported and
+ * forks the backups and restores from there, instead of a new python3 process per operation.
+ */
+class Worker {
+  constructor() {
+    this.process = null;
+    this.operations = new Set();
+  }
+
+  start(script, socketPath, landscape) {
+    if (this.process) {
+      return this.process;
+    }
+    const spawnParameters = [script, `--socket=${socketPath}`, `--iaas=${landscape}`];
+    logger.agent.info(`python3 ${_.join(spawnParameters, ' ')}`);
+    const worker = child_process.spawn('python3', spawnParameters, {
+      stdio: ['ignore', 'ignore', 'pipe']
+    });
+    this.process = worker;
+    worker.stderr.on('data', data => logger.agent.error(`Worker STDERR: ${data}`));
+    // e.g. python3 cannot be spawned; without a listener the error would bring down the agent
+    worker.on('error', err => {
+      logger.agent.error(`Could not start the backup & restore worker: ${err.message}`);
+      if (this.process === worker) {
+        this.process = null;
+      }
+      this.operations.forEach(operation => operation.abandon(err));
+    });
+    worker.once('exit', code => {
+      logger.agent.warn(`Worker (id: ${worker.pid}) exited with code ${code}.`);
+      if (this.process === worker) {
+        this.process = null;
+      }
+    });
+    return worker;
+  }
+
+  run(operation, parameters, socketPath, fallback) {
+    logger.agent.info(`worker ${operation} ${_.join(parameters, ' ')}`);
+    const workerOperation = new WorkerOperation(socketPath, operation, parameters, fallback);
+    this.operations.add(workerOperation);
+    workerOperation.once('exit', () => this.operations.delete(workerOperation));
+    return workerOperation;
+  }
+}
+
+module.exports = new Worker();
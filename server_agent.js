@@ -10,6 +10,7 @@ const backuprestore = require('./lib/agent/backuprestore');
 try {
   backuprestore.checkForConfigParameters();
   backuprestore.checkForEnvironmentVariables();
+  backuprestore.startWorker();
   logger.agent.info('Backup and Restore initializational checks were done successfully.');
 } catch (err) {
   logger.agent.error(`Error while trying to perform initializations for backup & restore: '${err}'`);
@@ -0,0 +1,222 @@
+'use strict';
+
+const EventEmitter = require('events');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const proxyquire = require('proxyquire');
+const errors = require('../lib/errors');
+
+const logger = {
+  agent: {
+    info: () => undefined,
+    warn: () => undefined,
+    error: () => undefined
+  },
+  '@noCallThru': true
+};
+
+const config = {
+  agent: {
+    job: {
+      name: 'blueprint',
+      index: 0
+    },
+    provider: {
+      name: 'openstack',
+      container: 'backups',
+      archive_format: 'blocks'
+    },
+    manifest: {
+      jobs: [{
+        networks: [{
+          static_ips: ['10.0.0.1']
+        }]
+      }],
+      properties: {
+        blueprint: {}
+      }
+    }
+  },
+  '@noCallThru': true
+};
+
+const restoreRequest = {
+  backup: {
+    guid: 'backup-guid',
+    type: 'online',
+    secret: 'secret'
+  },
+  vms: [{
+    cid: 'vm-cid',
+    job: 'blueprint',
+    index: 0,
+    iaas_vm_metadata: {
+      vm_id: 'vm-id'
+    }
+  }]
+};
+
+function restoreRequestWith(restorePaths) {
+  return Object.assign({}, restoreRequest, {
+    restore_paths: restorePaths
+  });
+}
+
+describe('agent', () => {
+  describe('AgentApi', () => {
+    describe('#startRestore', () => {
+      let AgentApi;
+      let backuprestore;
+      let state;
+      let res;
+
+      beforeEach(() => {
+        backuprestore = {
+          startRestore: chai.spy(() => new EventEmitter()),
+          '@noCallThru': true
+        };
+        state = {
+          operation: null,
+          updateLastOperation: chai.spy(() => Promise.resolve()),
+          registerProcessOnExit: chai.spy(),
+          '@noCallThru': true
+        };
+        res = {
+          status: chai.spy(() => res),
+          contentType: chai.spy(() => res)
+        };
+        AgentApi = proxyquire('../lib/agent/AgentApi', {
+          'request-promise': {
+            '@noCallThru': true
+          },
+          './credentials': {
+            '@noCallThru': true
+          },
+          './backuprestore': backuprestore,
+          './state': state,
+          '../config': config,
+          '../logger': logger
+        });
+      });
+
+      function startRestore(body) {
+        return new Promise(resolve => {
+          res.send = chai.spy(() => resolve());
+          AgentApi.startRestore({
+            body: body
+          }, res, error => resolve(error));
+        });
+      }
+
+      it('starts a restore of the given paths', () => {
+        const body = restoreRequestWith(['data', 'logs/*.log']);
+        return startRestore(body).then(error => {
+          expect(error).to.equal(undefined);
+          expect(backuprestore.startRestore).to.have.been.called.with(body);
+          expect(state.registerProcessOnExit).to.have.been.called();
+          expect(res.status).to.have.been.called.with(202);
+        });
+      });
+
+      it('starts a restore of everything without paths', () => {
+        return startRestore(restoreRequest).then(error => {
+          expect(error).to.equal(undefined);
+          expect(backuprestore.startRestore).to.have.been.called.with(restoreRequest);
+        });
+      });
+
+      it('refuses paths that are not a list', () => {
+        return startRestore(restoreRequestWith('data')).then(error => {
+          expect(error).to.be.an.instanceof(errors.BadRequest);
+          expect(backuprestore.startRestore).to.not.have.been.called();
+        });
+      });
+
+      it('refuses paths that are not strings', () => {
+        return startRestore(restoreRequestWith(['data', 42])).then(error => {
+          expect(error).to.be.an.instanceof(errors.BadRequest);
+          expect(backuprestore.startRestore).to.not.have.been.called();
+        });
+      });
+
+      it('refuses a restore while another one is running', () => {
+        state.operation = 'restore';
+        return startRestore(restoreRequestWith(['data'])).then(error => {
+          expect(error).to.be.an.instanceof(errors.Conflict);
+          expect(backuprestore.startRestore).to.not.have.been.called();
+        });
+      });
+    });
+  });
+
+  describe('backuprestore', () => {
+    describe('#startRestore', () => {
+      const directory = fs.mkdtempSync(path.join(os.tmpdir(), 'blueprint-agent-'));
+      // without a worker socket every operation is spawned as a python3 process of its own
+      const environment = {
+        AGENT_PATH_BACKUP_SCRIPT: '/var/vcap/packages/backuprestore/backup.py',
+        AGENT_PATH_RESTORE_SCRIPT: '/var/vcap/packages/backuprestore/restore.py',
+        SF_BACKUP_RESTORE_LAST_OPERATION_DIRECTORY: directory,
+        SF_BACKUP_RESTORE_LOG_DIRECTORY: directory,
+        SF_BACKUP_RESTORE_WORKER_SOCKET: undefined
+      };
+      const previousEnvironment = {};
+      let backuprestore;
+      let spawn;
+      let restoreArguments;
+
+      function setEnvironment(variables) {
+        Object.keys(variables).forEach(name => {
+          if (variables[name] === undefined) {
+            delete process.env[name];
+          } else {
+            process.env[name] = variables[name];
+          }
+        });
+      }
+
+      before(() => {
+        Object.keys(environment).forEach(name => previousEnvironment[name] = process.env[name]);
+        setEnvironment(environment);
+      });
+
+      after(() => {
+        setEnvironment(previousEnvironment);
+        fs.rmdirSync(directory);
+      });
+
+      beforeEach(() => {
+        restoreArguments = undefined;
+        spawn = chai.spy((command, args) => {
+          restoreArguments = args;
+          return new EventEmitter();
+        });
+        backuprestore = proxyquire('../lib/agent/backuprestore', {
+          child_process: {
+            spawn: spawn
+          },
+          './worker': {
+            '@noCallThru': true
+          },
+          '../config': config,
+          '../logger': logger
+        });
+      });
+
+      it('restores only the given paths', () => {
+        backuprestore.startRestore(restoreRequestWith(['data', 'logs/*.log']));
+        expect(spawn).to.have.been.called.exactly(1);
+        expect(restoreArguments).to.include('--restore_mode=partial');
+        expect(restoreArguments).to.include('--restore_paths=["data","logs/*.log"]');
+        expect(restoreArguments).to.include('--instance_id=vm-id');
+      });
+
+      it('restores everything without paths', () => {
+        backuprestore.startRestore(restoreRequestWith([]));
+        expect(restoreArguments[0]).to.equal(environment.AGENT_PATH_RESTORE_SCRIPT);
+        expect(restoreArguments).to.not.include('--restore_mode=partial');
+      });
+    });
+  });
+});
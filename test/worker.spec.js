@@ -0,0 +1,184 @@
+'use strict';
+
+const EventEmitter = require('events');
+const net = require('net');
+const os = require('os');
+const path = require('path');
+const fs = require('fs');
+const stream = require('stream');
+const proxyquire = require('proxyquire');
+
+const logger = {
+  agent: {
+    info: () => undefined,
+    warn: () => undefined,
+    error: () => undefined
+  },
+  '@noCallThru': true
+};
+
+class FakeProcess extends EventEmitter {
+  constructor(pid) {
+    super();
+    this.pid = pid;
+    this.stderr = new stream.PassThrough();
+    this.kill = chai.spy(() => true);
+  }
+}
+
+describe('agent', () => {
+  describe('worker', () => {
+    let worker;
+    let spawn;
+    let workerProcess;
+    let server;
+    const socketPath = path.join(os.tmpdir(), `blueprint-worker-${process.pid}.sock`);
+
+    beforeEach(() => {
+      workerProcess = new FakeProcess(100);
+      spawn = chai.spy(() => workerProcess);
+      worker = proxyquire('../lib/agent/worker', {
+        '../logger': logger,
+        child_process: {
+          spawn: spawn
+        }
+      });
+    });
+
+    afterEach(done => {
+      if (!server) {
+        return done();
+      }
+      server.close(() => {
+        server = null;
+        done();
+      });
+    });
+
+    function listen(reply, done) {
+      if (fs.existsSync(socketPath)) {
+        fs.unlinkSync(socketPath);
+      }
+      server = net.createServer(connection => {
+        let buffer = '';
+        connection.setEncoding('utf8');
+        connection.on('data', data => {
+          buffer += data;
+          if (buffer.indexOf('\n') !== -1) {
+            reply(connection, JSON.parse(buffer));
+          }
+        });
+      });
+      server.listen(socketPath, done);
+    }
+
+    function send(connection, messages) {
+      connection.end(messages.map(message => JSON.stringify(message) + '\n').join(''));
+    }
+
+    it('starts the worker once while it is running', () => {
+      worker.start('worker.py', socketPath, 'openstack');
+      worker.start('worker.py', socketPath, 'openstack');
+      expect(spawn).to.have.been.called.exactly(1);
+      expect(spawn).to.have.been.called.with('python3', ['worker.py', `--socket=${socketPath}`, '--iaas=openstack']);
+      workerProcess.emit('exit', 1);
+      worker.start('worker.py', socketPath, 'openstack');
+      expect(spawn).to.have.been.called.exactly(2);
+    });
+
+    it('runs the operation in the worker', done => {
+      let request;
+      listen((connection, message) => {
+        request = message;
+        send(connection, [{
+          event: 'started',
+          pid: 4242
+        }, {
+          event: 'stderr',
+          data: 'Uploading'
+        }, {
+          event: 'exited',
+          code: 0,
+          signal: null
+        }]);
+      }, () => {
+        const fallback = chai.spy();
+        const operation = worker.run('backup', ['--backup_guid=guid'], socketPath, fallback);
+        let stderr = '';
+        operation.stderr.on('data', data => stderr += data);
+        // the stderr of the operation may be passed on after its exit was handled
+        operation.once('exit', (code, signal) => setImmediate(() => {
+          expect(request).to.eql({
+            command: 'backup',
+            arguments: ['--backup_guid=guid']
+          });
+          expect(operation.pid).to.equal(4242);
+          expect(code).to.equal(0);
+          expect(signal).to.equal(null);
+          expect(stderr).to.equal('Uploading');
+          expect(fallback).to.not.have.been.called();
+          expect(worker.operations.size).to.equal(0);
+          done();
+        }));
+      });
+    });
+
+    it('reports an error of the worker as a failed operation', done => {
+      listen(connection => send(connection, [{
+        event: 'error',
+        message: 'Unknown command'
+      }]), () => {
+        const operation = worker.run('backup', [], socketPath, chai.spy());
+        let stderr = '';
+        operation.stderr.on('data', data => stderr += data);
+        operation.once('exit', code => setImmediate(() => {
+          expect(code).to.equal(1);
+          expect(stderr).to.equal('Unknown command');
+          done();
+        }));
+      });
+    });
+
+    it('falls back to a process of its own if the worker cannot be started', done => {
+      const child = new FakeProcess(200);
+      const fallback = chai.spy(() => child);
+      worker.start('worker.py', socketPath + '.missing', 'openstack');
+      const operation = worker.run('restore', [], socketPath + '.missing', fallback);
+      workerProcess.emit('error', new Error('spawn python3 ENOENT'));
+      expect(fallback).to.have.been.called.exactly(1);
+      expect(operation.pid).to.equal(200);
+      expect(worker.process).to.equal(null);
+      operation.once('exit', code => {
+        expect(code).to.equal(3);
+        done();
+      });
+      child.emit('exit', 3, null);
+    });
+
+    it('falls back to a process of its own if the worker cannot be reached', function (done) {
+      this.timeout(10000);
+      const child = new FakeProcess(300);
+      const operation = worker.run('backup', [], socketPath + '.missing', () => child);
+      operation.once('exit', code => {
+        expect(operation.pid).to.equal(300);
+        expect(code).to.equal(0);
+        done();
+      });
+      const timer = setInterval(() => {
+        if (operation.child) {
+          clearInterval(timer);
+          child.emit('exit', 0, null);
+        }
+      }, 100);
+    });
+
+    it('delivers a kill that arrived before the operation started', () => {
+      const child = new FakeProcess(400);
+      worker.start('worker.py', socketPath + '.missing', 'openstack');
+      const operation = worker.run('backup', [], socketPath + '.missing', () => child);
+      expect(operation.kill('SIGINT')).to.equal(true);
+      workerProcess.emit('error', new Error('spawn python3 ENOENT'));
+      expect(child.kill).to.have.been.called.with('SIGINT');
+    });
+  });
+});